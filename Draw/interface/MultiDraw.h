@@ -2,13 +2,37 @@
 #define MULTIDRAW_H
 
 #include "Rtypes.h"
+#include <vector>
 
 class TTree;
 class TTreeFormula;
 class TObjArray;
 
-void MultiDraw(TTree *inTree,
-               TObjArray *Formulae, TObjArray *Weights, TObjArray *Hists,
-               UInt_t ListLen);
+// Fill the histograms from entries [FirstEntry, LastEntry) of the tree, or
+// all of them if LastEntry is negative.
+// The weight of entry j of the draw list is the product of the formulae in
+// Factors indexed by FactorIndices[FactorOffsets[j]] to
+// FactorIndices[FactorOffsets[j+1] - 1]
+void MultiDraw(TTree *inTree, TObjArray *Formulae, TObjArray *Factors,
+               const std::vector<unsigned> &FactorIndices,
+               const std::vector<unsigned> &FactorOffsets,
+               TObjArray *Hists, UInt_t ListLen, UInt_t NThreads,
+               Long64_t FirstEntry = 0, Long64_t LastEntry = -1);
+
+// Signature of the fill functions generated by CompiledDraw.py: fill the
+// histograms in Hists from entries [first, last) of the tree
+typedef void (*MultiDrawFillFn)(TTree *tree, TObjArray *Hists,
+                                Long64_t first, Long64_t last);
+
+// Run a generated fill function over entries [FirstEntry, LastEntry) of the
+// tree (all of them if LastEntry is negative), on NThreads threads
+void MultiDrawKernel(TTree *inTree, TObjArray *Hists, UInt_t NThreads,
+                     MultiDrawFillFn Fill, Long64_t FirstEntry = 0,
+                     Long64_t LastEntry = -1);
+
+// Bounds of at most NRanges entry ranges covering [First, Last), split on
+// cluster boundaries
+std::vector<Long64_t> ClusterAlignedRanges(TTree *inTree, Long64_t First,
+                                           Long64_t Last, UInt_t NRanges);
 
 #endif // MULTIDRAW_H
@@ -1,10 +1,19 @@
 # Analysis.py
 
 from collections import defaultdict, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
 import ROOT
+import fnmatch
 import glob
+import math
 import os
+import time
+import numpy as np
 from Draw.python import MultiDraw
+from Draw.python import ColumnarDraw
+from Draw.python import HistArrays
+from Draw.python import ResourceLedger
 from uncertainties import ufloat
 import ctypes
 import yaml
@@ -27,80 +36,181 @@ def WriteToTFile(obj, file, path):
     ROOT.gDirectory.cd('/')
 
 
+class TFileWriter(object):
+    """Writes objects into a TFile under '/' separated paths. Directories
+    are made once and their handles kept, and the objects are queued and
+    written directory by directory on Flush, instead of walking the path
+    through gDirectory for each of them like WriteToTFile. As there, an
+    object is not written if the path already holds one. The .subnodes
+    directories, which only hold the inputs of the outputs, are skipped
+    unless subnodes is True."""
+    def __init__(self, file, subnodes=True):
+        self.file = file
+        self.subnodes = subnodes
+        self.dirs = {'': file}
+        self.written = set()
+        self.pending = defaultdict(list)
+
+    def Directory(self, path):
+        if path not in self.dirs:
+            parent, _, name = path.rpartition('/')
+            mother = self.Directory(parent)
+            directory = mother.GetDirectory(name)
+            if not directory:
+                directory = mother.mkdir(name)
+            self.dirs[path] = directory
+        return self.dirs[path]
+
+    def Write(self, obj, path):
+        parts = [x for x in path.split('/') if x]
+        dir_path, name = '/'.join(parts[:-1]), parts[-1]
+        if (dir_path, name) in self.written:
+            return
+        self.written.add((dir_path, name))
+        if self.Directory(dir_path).FindKey(name):
+            return
+        obj.SetName(name)
+        self.pending[dir_path].append((name, obj))
+
+    def Flush(self):
+        for dir_path, objects in self.pending.items():
+            directory = self.dirs[dir_path]
+            for name, obj in objects:
+                directory.WriteTObject(obj, name)
+        self.pending.clear()
+
+
 class Shape(object):
+    """A histogram and its rate. The bin contents and sums of squared
+    weights, flow bins included, are kept in numpy arrays and the arithmetic
+    follows TH1::Add, Multiply, Divide and Scale, including the rounding of
+    the contents to the type of the histogram. The TH1 itself is only made
+    when hist is asked for, e.g. by Output."""
     def __init__(self, hist, rate=None):
         self.hist = hist
         if rate is not None:
             self.rate = rate
 
+    def _Cumulate(self, arr):
+        # Summed in the same order as TH1::Integral, which loops over x in
+        # the outermost loop, so that the rate is exactly the same
+        return np.cumsum(arr.reshape(self._cells).T.ravel(), dtype=np.float64)[-1]
+
     def _Int(self):
-        if self._hist.GetDimension() == 1:
-            return self._hist.Integral(
-                0, self._hist.GetNbinsX() + 1
-            )
-        elif self._hist.GetDimension() == 2:
-            return self._hist.Integral(
-                0, self._hist.GetNbinsX() + 1,
-                0, self._hist.GetNbinsY() + 1
-            )
-        elif self._hist.GetDimension() == 3:
-            return self._hist.Integral(
-                0, self._hist.GetNbinsX() + 1,
-                0, self._hist.GetNbinsY() + 1,
-                0, self._hist.GetNbinsZ() + 1
-            )
+        return float(self._Cumulate(self._content))
 
     def _IntErr(self):
-        err = ctypes.c_double()
-        if self._hist.GetDimension() == 1:
-            val = self._hist.IntegralAndError(
-                0, self._hist.GetNbinsX() + 1, err
-            )
-        elif self._hist.GetDimension() == 2:
-            val = self._hist.IntegralAndError(
-                0, self._hist.GetNbinsX() + 1,
-                0, self._hist.GetNbinsY() + 1, err
-            )
-        elif self._hist.GetDimension() == 3:
-            val = self._hist.IntegralAndError(
-                0, self._hist.GetNbinsX() + 1,
-                0, self._hist.GetNbinsY() + 1,
-                0, self._hist.GetNbinsZ() + 1, err
-            )
-        return ufloat(val, err.value)
+        return ufloat(float(self._Cumulate(self._content)), math.sqrt(self._Cumulate(self._sumw2)))
+
+    def _Modified(self):
+        self._hist = None
 
     @property
     def hist(self):
-        # print 'Getting hist for %s' % self.__repr__()
+        if self._hist is None:
+            self._hist = HistArrays.FromArrays(self._template, self._content, self._sumw2, self._entries)
         return self._hist
 
     @hist.setter
     def hist(self, hist):
-        # print 'Setting hist for %s ' % self.__repr__()
-        self._hist = hist.Clone()
+        # The histogram is only ever cloned, so it can be shared with the
+        # caller and between shapes
+        self._template = hist
+        content, sumw2 = HistArrays.Views(hist)
+        self._content = content.copy()
+        self._sumw2 = sumw2.copy() if sumw2 is not None else np.abs(content).astype(np.float64)
+        self._cells = HistArrays.Cells(hist)
+        self._entries = hist.GetEntries()
+        self._hist = None
         self._rate = self._IntErr()
 
+    @property
+    def content(self):
+        """Bin contents, flow bins included, indexed by global bin number.
+        Changes to it are picked up the next time hist is made."""
+        self._Modified()
+        return self._content
+
+    @property
+    def sumw2(self):
+        """Sums of squared weights, like content"""
+        self._Modified()
+        return self._sumw2
+
+    @property
+    def nbins(self):
+        """Number of bins along (x, y, z), 1 for the axes the histogram
+        doesn't have, like TH1::GetNbinsY()"""
+        return tuple(n - 2 for n in self._cells[::-1]) + (1,) * (3 - len(self._cells))
+
+    def GetBin(self, x, y=0, z=0):
+        """Global bin number, like TH1::GetBin"""
+        bin = 0
+        for n, i in zip(self._cells, (z, y, x)[3 - len(self._cells):]):
+            bin = bin * n + i
+        return bin
+
     @property
     def rate(self):
-        # print 'Getting rate for %s ' % self.__repr__()
         return self._rate
 
     @rate.setter
     def rate(self, rate):
-        # print 'Setting rate to {:.3f}'.format(rate)
         self._rate = rate
         integral = self._Int()
         if integral == 0.:
             print('Error, histogram integral is zero')
             return
-        self._hist.Scale(rate.n / integral)
+        self.Scale(rate.n / integral)
+
+    def Scale(self, c1):
+        """Scale the contents, but not the rate, like TH1::Scale"""
+        self._content[:] = c1 * self._content.astype(np.float64)
+        self._sumw2 *= (c1 * c1)
+        self._Modified()
 
     def copy(self):
-        return Shape(self.hist.Clone(), self.rate)
+        cpy = Shape.__new__(Shape)
+        cpy._template = self._template
+        cpy._content = self._content.copy()
+        cpy._sumw2 = self._sumw2.copy()
+        cpy._cells = self._cells
+        cpy._entries = self._entries
+        cpy._hist = None
+        cpy.rate = self.rate
+        return cpy
+
+    def _Add(self, other, c1):
+        # TH1::AddBinContent converts to the type of the histogram first
+        self._content += (c1 * other._content.astype(np.float64)).astype(self._content.dtype)
+        self._sumw2 += c1 * c1 * other._sumw2
+        # TH1::Add recomputes the statistics when subtracting
+        if c1 < 0 or self._entries is None or other._entries is None:
+            self._entries = None
+        else:
+            self._entries = abs(self._entries + c1 * other._entries)
+        self._Modified()
+
+    def _Multiply(self, other):
+        c0 = self._content.astype(np.float64)
+        c1 = other._content.astype(np.float64)
+        self._sumw2[:] = self._sumw2 * c1 * c1 + other._sumw2 * c0 * c0
+        self._content[:] = c0 * c1
+        self._Modified()
+
+    def _Divide(self, other):
+        c0 = self._content.astype(np.float64)
+        c1 = other._content.astype(np.float64)
+        c1sq = c1 * c1
+        nonzero = c1 != 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self._sumw2[:] = np.where(nonzero, (self._sumw2 * c1sq + other._sumw2 * c0 * c0) / (c1sq * c1sq), 0.)
+            self._content[:] = np.where(nonzero, c0 / c1, 0.)
+        self._Modified()
 
     def __iadd__(self, other):
         if isinstance(other, Shape):
-            self.hist.Add(other.hist)
+            self._Add(other, 1.)
             self.rate += other.rate
         else:
             self.rate += other
@@ -108,7 +218,7 @@ class Shape(object):
 
     def __isub__(self, other):
         if isinstance(other, Shape):
-            self.hist.Add(other.hist, -1)
+            self._Add(other, -1.)
             self.rate -= other.rate
         else:
             self.rate -= other
@@ -116,7 +226,7 @@ class Shape(object):
 
     def __imul__(self, other):
         if isinstance(other, Shape):
-            self.hist.Multiply(other.hist)
+            self._Multiply(other)
             self.rate *= other.rate
         else:
             self.rate *= other
@@ -124,7 +234,7 @@ class Shape(object):
 
     def __itruediv__(self, other):
         if isinstance(other, Shape):
-            self.hist.Divide(other.hist)
+            self._Divide(other)
             self.rate /= other.rate
         else:
             self.rate /= other
@@ -159,23 +269,76 @@ class Shape(object):
 
 
 class TTreeEvaluator:
-    def __init__(self, tree_name, filename):
+    def __init__(self, tree_name, filename, entry_range=None):
         self.tree_name = tree_name
         self.filename = filename
+        # (first, last) to only draw those entries, None for all of them
+        self.entry_range = entry_range
         self.tree = None  # initially none -> we'll open it later
         self.file = None
 
+    def Shards(self, n):
+        """Split into at most n evaluators, each drawing a cluster-aligned
+        range of entries, whose histograms add up to those of this one"""
+        self.PrepareTree()
+        ranges = MultiDraw.ClusterAlignedRanges(self.tree, n)
+        self.file.Close()
+        return [TTreeEvaluator(self.tree_name, self.filename, r) for r in ranges]
+
     def PrepareTree(self):
         self.file = ROOT.TFile(self.filename)
         self.tree = self.file.Get(self.tree_name)
 
-    def Draw(self, draw_list, compiled=False):
+    def Entries(self):
+        """Number of entries Draw reads"""
+        if self.entry_range is not None:
+            return self.entry_range[1] - self.entry_range[0]
+        self.PrepareTree()
+        entries = self.tree.GetEntries()
+        self.file.Close()
+        return entries
+
+    def Draw(self, draw_list, compiled=False, threads=1):
+        start = time.time()
+        # Count the bytes read by every TFile, so that the files opened by
+        # the worker threads are included
+        bytes_start = ROOT.TFile.GetFileBytesRead()
         self.PrepareTree()
-        otree = MultiDraw.MultiDraw(self.tree, draw_list, Compiled=compiled)
+        otree = MultiDraw.MultiDraw(self.tree, draw_list, Compiled=compiled, Threads=threads,
+                                    EntryRange=self.entry_range)
         self.file.Close()
+        print('%s: %.2fs, %.1f MB read' % (
+            os.path.basename(self.filename), time.time() - start,
+            (ROOT.TFile.GetFileBytesRead() - bytes_start) / 1024. ** 2))
         return otree
 
 
+class ColumnarEvaluator:
+    """Drop-in replacement for TTreeEvaluator that fills histograms with
+    the numpy engine in ColumnarDraw rather than MultiDraw"""
+    def __init__(self, tree_name, filename, entry_range=None):
+        self.tree_name = tree_name
+        self.filename = filename
+        self.entry_range = entry_range
+
+    def Shards(self, n):
+        ranges = ColumnarDraw.SplitEntries(self.filename, self.tree_name, n)
+        return [ColumnarEvaluator(self.tree_name, self.filename, r) for r in ranges]
+
+    def Entries(self):
+        """Number of entries Draw reads"""
+        if self.entry_range is not None:
+            return self.entry_range[1] - self.entry_range[0]
+        return ColumnarDraw.EntryOffsets(self.filename, self.tree_name)[-1]
+
+    def Draw(self, draw_list, compiled=False, threads=1):
+        start = time.time()
+        hists = ColumnarDraw.DrawColumns(self.filename, self.tree_name, draw_list, workers=threads,
+                                         entry_range=self.entry_range)
+        print('%s: %.2fs (columnar)' % (os.path.basename(self.filename), time.time() - start))
+        return [ColumnarDraw.ToROOT(h) for h in hists]
+
+
 class BaseNode:
     def __init__(self, name, WriteSubnodes=True):
         self.name = name
@@ -205,16 +368,35 @@ class BaseNode:
         return self.name
 
     def Output(self, file, prefix=''):
+        """Write the node and, if WriteSubnodes, its subnodes into file,
+        which is either a TFile or a TFileWriter. The caller of the latter
+        has to Flush it."""
+        if not isinstance(file, TFileWriter):
+            writer = TFileWriter(file)
+            self.Output(writer, prefix)
+            writer.Flush()
+            return
+        # Nodes that were not needed by the last Run have no shape to write
+        if 'shape' in vars(self) and self.shape is None:
+            return
         objects = self.Objects()
         for key, val in objects.items():
-            WriteToTFile(val, file, '%s/%s' % (prefix, key))
-        if self.WriteSubnodes:
+            file.Write(val, '%s/%s' % (prefix, key))
+        # The subnodes of a plain ListNode are outputs, not inputs
+        if self.WriteSubnodes and (file.subnodes or type(self) is ListNode):
             for node in self.SubNodes():
                 node.Output(file, '%s/%s' % (prefix, self.OutputPrefix(node)))
 
-    def Run(self):
+    def Run(self, done=None):
+        # Factories share identical sub-graphs between parents, so keep track
+        # of which nodes have already run to only run each of them once
+        if done is None:
+            done = set()
+        if id(self) in done:
+            return
+        done.add(id(self))
         for node in self.SubNodes():
-            node.Run()
+            node.Run(done)
         self.RunSelf()
 
     def RunSelf(self):
@@ -288,7 +470,14 @@ class SummedNode(ListNode):
         self.shape = None
 
     def RunSelf(self):
-        self.shape = sum([node.shape for node in self.nodes.values()])
+        # Add up in place rather than with sum(), which copies the running
+        # total at every step
+        self.shape = None
+        for node in self.nodes.values():
+            if self.shape is None:
+                self.shape = node.shape.copy()
+            else:
+                self.shape += node.shape
 
     def Objects(self):
         return {self.name: self.shape.hist}
@@ -336,35 +525,34 @@ class FF_Node(BaseNode):
         self.flatten_y = flatten_y
 
     def RunSelf(self):
+        qcd_frac, w_frac, top_frac = self.QCD_frac.shape, self.W_frac.shape, self.Top_frac.shape
         if self.flatten_y:
-            for y_bin in range(1, self.QCD_frac.shape.hist.GetNbinsY()+1):
-                # set fraction to average across the given y (BDT bin for Higgs CP)
-                avg_QCD = sum(self.QCD_frac.shape.hist.GetBinContent(x_bin, y_bin) for x_bin in range(1, self.QCD_frac.shape.hist.GetNbinsX()+1))/ self.QCD_frac.shape.hist.GetNbinsX()
-                avg_Wj = sum(self.W_frac.shape.hist.GetBinContent(x_bin, y_bin) for x_bin in range(1, self.W_frac.shape.hist.GetNbinsX()+1))/ self.W_frac.shape.hist.GetNbinsX()
-                avg_Top = sum(self.Top_frac.shape.hist.GetBinContent(x_bin, y_bin) for x_bin in range(1, self.Top_frac.shape.hist.GetNbinsX()+1))/ self.Top_frac.shape.hist.GetNbinsX()
-                for x_bin in range(1, self.QCD_frac.shape.hist.GetNbinsX()+1):
-                    self.QCD_frac.shape.hist.SetBinContent(x_bin, y_bin, avg_QCD)
-                    self.W_frac.shape.hist.SetBinContent(x_bin, y_bin, avg_Wj)
-                    self.Top_frac.shape.hist.SetBinContent(x_bin, y_bin, avg_Top)
-
-        total_jet = self.QCD_frac.shape + self.W_frac.shape + self.Top_frac.shape
-        self.shape = self.QCD_node.shape * self.QCD_frac.shape / total_jet + self.W_node.shape * self.W_frac.shape/total_jet + self.Top_node.shape * self.Top_frac.shape / total_jet
-
-        for x in range(1, self.shape.hist.GetNbinsX() + 1):
-            for y in range(1, self.shape.hist.GetNbinsY() + 1):
-                if self.shape.hist.GetNbinsY() == 1:
-                    global_bin = x
-                else:
-                    global_bin = self.shape.hist.GetBin(x, y)
-                # check that the total jet bin content is not zero to avoid division by zero
-                if total_jet.hist.GetBinContent(global_bin) == 0:
-                    self.shape.hist.SetBinError(global_bin, 0)
-                    continue
-                else: # set bin error to sum of the weighted components' bin errors
-                    w_err_qcd = self.QCD_node.shape.hist.GetBinError(global_bin) * self.QCD_frac.shape.hist.GetBinContent(global_bin) / total_jet.hist.GetBinContent(global_bin)
-                    w_err_w = self.W_node.shape.hist.GetBinError(global_bin) * self.W_frac.shape.hist.GetBinContent(global_bin) / total_jet.hist.GetBinContent(global_bin)
-                    w_err_top = self.Top_node.shape.hist.GetBinError(global_bin) * self.Top_frac.shape.hist.GetBinContent(global_bin) / total_jet.hist.GetBinContent(global_bin)
-                    self.shape.hist.SetBinError(global_bin, w_err_qcd+w_err_w+w_err_top)
+            # set fraction to average across the given y (BDT bin for Higgs CP)
+            nx, ny, _ = qcd_frac.nbins
+            bins = np.broadcast_to(qcd_frac.GetBin(np.arange(1, nx+1)[None, :], np.arange(1, ny+1)[:, None]), (ny, nx))
+            for frac in (qcd_frac, w_frac, top_frac):
+                # Summed one bin after the other like the builtin sum, which
+                # also turns a total of -0 into 0
+                avg = (np.cumsum(frac.content[bins].astype(np.float64), axis=1)[:, -1] + 0.) / nx
+                frac.content[bins] = avg[:, None]
+
+        total_jet = qcd_frac + w_frac + top_frac
+        self.shape = self.QCD_node.shape * qcd_frac / total_jet + self.W_node.shape * w_frac/total_jet + self.Top_node.shape * top_frac / total_jet
+
+        nx, ny, _ = self.shape.nbins
+        if ny == 1:
+            bins = np.arange(1, nx + 1)
+        else:
+            bins = self.shape.GetBin(np.arange(1, nx + 1)[:, None], np.arange(1, ny + 1)[None, :]).ravel()
+        total = total_jet.content[bins].astype(np.float64)
+        # set bin error to sum of the weighted components' bin errors, or to
+        # zero where the total jet bin content is zero
+        with np.errstate(divide='ignore', invalid='ignore'):
+            w_err_qcd = np.sqrt(self.QCD_node.shape.sumw2[bins]) * qcd_frac.content[bins].astype(np.float64) / total
+            w_err_w = np.sqrt(self.W_node.shape.sumw2[bins]) * w_frac.content[bins].astype(np.float64) / total
+            w_err_top = np.sqrt(self.Top_node.shape.sumw2[bins]) * top_frac.content[bins].astype(np.float64) / total
+            err = w_err_qcd+w_err_w+w_err_top
+        self.shape.sumw2[bins] = np.where(total == 0, 0., err * err)
 
 
     def Objects(self):
@@ -381,33 +569,218 @@ class FF_Node(BaseNode):
             node.AddRequests(manifest)
 
 
+def OutputNodes(node):
+    """The nodes whose histograms are the outputs of the tree: everything
+    held by the plain ListNodes, which only group their contents"""
+    if type(node) is not ListNode:
+        return [node]
+    return [x for sub in node.SubNodes() for x in OutputNodes(sub)]
+
+
+def EvaluationOrder(nodes):
+    """The given nodes and everything they depend on, each once, ordered so
+    that every node comes after all of its subnodes"""
+    order = []
+    seen = set()
+
+    def Visit(node):
+        if id(node) in seen:
+            return
+        seen.add(id(node))
+        for sub in node.SubNodes():
+            Visit(sub)
+        order.append(node)
+
+    for node in nodes:
+        Visit(node)
+    return order
+
+
+def DrawSample(evaluator_class, tree_name, filename, entry_range, draw_list, compiled, threads):
+    """Draw one sample, or one range of its entries, in a worker process.
+    Only the histograms are sent back, as pickled ROOT objects, along with
+    the private memory of the worker once they are drawn"""
+    evaluator = evaluator_class(tree_name, filename, entry_range)
+    res = evaluator.Draw(draw_list, compiled=compiled, threads=threads)
+    return [x for x in res if isinstance(x, ROOT.TH1)], ResourceLedger.PrivateMemoryMB()
+
+
 class Analysis(object):
-    def __init__(self):
+    def __init__(self, n_workers=1):
         self.trees = {}
         self.nodes = ListNode('')
         self.info = {}
         self.remaps = {}
         self.compiled = False
+        self.threads = 1
+        # 'root' for MultiDraw, 'columnar' for ColumnarDraw
+        self.backend = 'root'
+        # Number of processes drawing samples in parallel
+        self.n_workers = n_workers
+        # Number of entry ranges each sample is split into, each drawn
+        # separately and summed before becoming a Shape
+        self.shards = 1
+        # HistCache to look up histograms in before drawing them, or None
+        self.hist_cache = None
+        # Nodes built by the factories, keyed by everything that went into
+        # them, so that identical sub-graphs are only built and run once
+        self.node_cache = {}
         self.WriteSubnodes = True
-
-    def Run(self):
+        # Entries read and histograms filled by the last Run, e.g. for the
+        # resource ledger of the jobs. Counting the entries opens every
+        # input again, so it is only done if count_events is True
+        self.count_events = False
+        self.events_read = 0
+        self.hists_filled = 0
+        # Largest private memory in MB of a worker process drawing samples
+        self.worker_memory_mb = 0.
+        # False if the subnodes will not be written by Output, e.g. to a
+        # TFileWriter with subnodes=False, so their shapes can be dropped
+        self.output_subnodes = True
+
+    def Run(self, targets=None):
+        """Draw the histograms and evaluate the nodes. targets is an optional
+        list of fnmatch patterns of output node names, e.g. ['JetFakes*'], in
+        which case only the matching outputs are evaluated, along with
+        whatever they depend on. Anything else is not drawn, has no shape
+        afterwards and is not written by Output."""
+        outputs = OutputNodes(self.nodes)
+        if targets is not None:
+            outputs = [node for node in outputs if any(fnmatch.fnmatch(node.name, x) for x in targets)]
+            print('Evaluating %i of the outputs for %s' % (len(outputs), ', '.join(targets)))
         manifest = []
-        self.nodes.AddRequests(manifest)
-        if len(manifest) != len(set(manifest)):
-            raise ValueError('Duplicate requests in manifest!')
+        for node in outputs:
+            node.AddRequests(manifest)
+        # A node shared by several parents adds its requests once per parent
+        manifest = list(OrderedDict.fromkeys(manifest))
+        # Nodes asking for the same (sample, variable, selection) share a
+        # single draw, and each gets its own copy of the histogram
         drawdict = defaultdict(list)
         outdict = defaultdict(list)
+        positions = {}
         for entry in manifest:
-            drawdict[entry[0]].append(entry[1:3])
-            outdict[entry[0]].append(entry[3:5])
-
+            if entry[0:3] not in positions:
+                positions[entry[0:3]] = len(drawdict[entry[0]])
+                drawdict[entry[0]].append(entry[1:3])
+                outdict[entry[0]].append([])
+            outdict[entry[0]][positions[entry[0:3]]].append(entry[3:5])
+        print('Drawing %i histograms for %i requests (%i draws saved)' % (
+            len(positions), len(manifest), len(manifest) - len(positions)))
+
+        # Only draw the histograms that aren't already in the cache
+        hists = {}
+        todo = defaultdict(list)
         for sample in drawdict:
-            print(sample)
-            res = self.trees[sample].Draw(drawdict[sample], compiled=self.compiled)
-            res = [x for x in res if isinstance(x, ROOT.TH1)]
+            hists[sample] = [None] * len(drawdict[sample])
+            evaluator = self.trees[sample]
+            for i, (variable, selection) in enumerate(drawdict[sample]):
+                if self.hist_cache is not None:
+                    hists[sample][i] = self.hist_cache.Get(
+                        evaluator.filename, evaluator.tree_name, variable, selection, self.DrawBackend(evaluator))
+                if hists[sample][i] is None:
+                    todo[sample].append(i)
+        if self.hist_cache is not None:
+            print('Histogram cache: %i hits, %i to draw' % (
+                sum(len(x) for x in drawdict.values()) - sum(len(x) for x in todo.values()),
+                sum(len(x) for x in todo.values())))
+        draw_lists = {sample: [drawdict[sample][i] for i in todo[sample]] for sample in todo}
+
+        tasks = []
+        for sample in draw_lists:
+            if self.shards > 1:
+                tasks += [(sample, evaluator) for evaluator in self.trees[sample].Shards(self.shards)]
+            else:
+                tasks.append((sample, self.trees[sample]))
+        if self.n_workers > 1 and len(tasks) > 1:
+            results = self.DrawParallel(tasks, draw_lists)
+        else:
+            results = self.DrawSerial(tasks, draw_lists)
+        # Sum the shards of each sample
+        drawn = {}
+        for sample, res in results:
+            if sample not in drawn:
+                drawn[sample] = res
+            else:
+                for hist, part in zip(drawn[sample], res):
+                    hist.Add(part)
+        for sample, res in drawn.items():
+            evaluator = self.trees[sample]
+            for i, hist in zip(todo[sample], res):
+                hists[sample][i] = hist
+                if self.hist_cache is not None:
+                    self.hist_cache.Put(evaluator.filename, evaluator.tree_name, *drawdict[sample][i],
+                                        self.DrawBackend(evaluator), hist)
+        if self.hist_cache is not None and drawn:
+            self.hist_cache.Evict()
+        if self.count_events:
+            self.events_read = sum(evaluator.Entries() for _, evaluator in tasks)
+        self.hists_filled = sum(len(x) for x in draw_lists.values())
+
+        for sample, res in hists.items():
             for i, hist in enumerate(res):
-                setattr(outdict[sample][i][0], outdict[sample][i][1], Shape(hist))
-        self.nodes.Run()
+                # Shape copies the contents, so the nodes don't share them
+                for node, attr in outdict[sample][i]:
+                    setattr(node, attr, Shape(hist))
+        del hists, drawn
+        self.Evaluate(outputs)
+
+    def DrawBackend(self, evaluator):
+        """Name of what fills the histograms of evaluator, which don't come
+        out exactly the same from each of them"""
+        if isinstance(evaluator, ColumnarEvaluator):
+            return 'columnar'
+        return 'compiled' if self.compiled else 'root'
+
+    def Evaluate(self, outputs):
+        """Run the nodes the outputs depend on, each once and after all of
+        its subnodes. The shape of a node that is neither an output nor
+        written under one is dropped as soon as the last node using it has
+        run, to keep the memory down."""
+        order = EvaluationOrder(outputs)
+        keep = set()
+        stack = list(outputs)
+        while stack:
+            node = stack.pop()
+            if id(node) in keep:
+                continue
+            keep.add(id(node))
+            if node.WriteSubnodes and self.output_subnodes:
+                stack += node.SubNodes()
+        consumers = defaultdict(int)
+        for node in order:
+            for sub in node.SubNodes():
+                consumers[id(sub)] += 1
+        for node in order:
+            node.RunSelf()
+            for sub in node.SubNodes():
+                consumers[id(sub)] -= 1
+                if consumers[id(sub)] == 0 and id(sub) not in keep:
+                    sub.shape = None
+
+    def DrawSerial(self, tasks, drawdict):
+        for sample, evaluator in tasks:
+            print(sample)
+            res = evaluator.Draw(drawdict[sample], compiled=self.compiled, threads=self.threads)
+            yield sample, [x for x in res if isinstance(x, ROOT.TH1)]
+
+    def DrawParallel(self, tasks, drawdict):
+        """Draw the samples in a pool of n_workers processes, biggest files
+        first so that the longest draws don't start last. Fork is used
+        rather than spawn since the driver scripts have no __main__ guard
+        and would be re-run by every spawned worker."""
+        tasks = sorted(tasks, key=lambda x: os.path.getsize(x[1].filename), reverse=True)
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(max_workers=self.n_workers, mp_context=context) as executor:
+            futures = {}
+            for sample, evaluator in tasks:
+                future = executor.submit(DrawSample, type(evaluator), evaluator.tree_name, evaluator.filename,
+                                         evaluator.entry_range, drawdict[sample], self.compiled, self.threads)
+                futures[future] = sample
+            for future in as_completed(futures):
+                print('Finished %s' % futures[future])
+                hists, memory = future.result()
+                self.worker_memory_mb = max(self.worker_memory_mb, memory)
+                yield futures[future], hists
 
     def AddSamples(self, dir, tree, fallback=None,sample_name=None):
         files = glob.glob(dir)
@@ -428,7 +801,10 @@ class Analysis(object):
                 newname = name
                 if name in self.remaps:
                     newname = self.remaps[name]
-                self.trees[newname] = TTreeEvaluator(tree, f)
+                if self.backend == 'columnar':
+                    self.trees[newname] = ColumnarEvaluator(tree, f)
+                else:
+                    self.trees[newname] = TTreeEvaluator(tree, f)
             testf.Close()
 
     def writeSubnodes(self,WriteSubnodes):
@@ -480,13 +856,41 @@ class Analysis(object):
         if add_name is not None:
             name += add_name
             sample += add_name
-        return BasicNode(name, sample, var, sel, factors=myfactors,WriteSubnodes=self.WriteSubnodes)
+        key = ('BasicNode', name, sample, var, sel, tuple(myfactors), self.WriteSubnodes)
+        if key not in self.node_cache:
+            self.node_cache[key] = BasicNode(name, sample, var, sel, factors=myfactors,WriteSubnodes=self.WriteSubnodes)
+        return self.node_cache[key]
 
     def SummedFactory(self, name, samples, var='', sel='', factors=[], scaleToLumi=True,add_name=None):
-        res = SummedNode(name)
-        for sa in samples:
-            res.AddNode(self.BasicFactory(sa, sa, var, sel, factors, scaleToLumi,add_name))
-        return res
+        return self.SummedNodeFactory(name, [self.BasicFactory(sa, sa, var, sel, factors, scaleToLumi,add_name) for sa in samples])
+
+    def SummedNodeFactory(self, name, nodes):
+        """SummedNode of the given nodes, shared with any earlier call with
+        the same name and the same nodes"""
+        key = ('SummedNode', name, tuple(id(node) for node in nodes))
+        if key not in self.node_cache:
+            res = SummedNode(name)
+            for node in nodes:
+                res.AddNode(node)
+            self.node_cache[key] = res
+        return self.node_cache[key]
+
+
+class SubAnalysis(object):
+    """One of several sets of outputs run by the same Analysis, e.g. one
+    datacard of many made together. It has its own nodes, written as if
+    they were at the top of the file like those of an Analysis, and uses
+    the samples, info and factories of the Analysis for everything else, so
+    that all of them share the draws and any identical sub-graphs. The
+    nodes are run by Analysis.Run."""
+    def __init__(self, analysis, name):
+        self.analysis = analysis
+        self.nodes = ListNode(name)
+        self.nodes.add_output_prefix = False
+        analysis.nodes.AddNode(self.nodes)
+
+    def __getattr__(self, attr):
+        return getattr(self.analysis, attr)
 
 
 class HttWOSSSNode(BaseNode):
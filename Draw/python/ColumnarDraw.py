@@ -0,0 +1,418 @@
+# ColumnarDraw.py
+
+# Columnar alternative to MultiDraw. Only the branches a draw list needs are
+# read, in chunks, with uproot (or with pyarrow if there is a .parquet file
+# next to the .root file). The TTreeFormula-style strings are translated into
+# numpy expressions, and every histogram is filled with np.bincount. Apart
+# from ToROOT, which converts the results into the TH1D/TH2F/TH3F that
+# MultiDraw would have returned, nothing here needs ROOT.
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from Draw.python.Formula import Tokenize, IsFunctionCall, ParseVariable, Factorize
+
+# Entries per chunk when reading ROOT files. Parquet files are read one row
+# group at a time
+step_size = 500000
+
+_FUNCTIONS = {
+    'abs': 'np.abs',
+    'fabs': 'np.abs',
+    'sqrt': 'np.sqrt',
+    'exp': 'np.exp',
+    'log': 'np.log',
+    'log10': 'np.log10',
+    'pow': 'np.power',
+    'min': 'np.minimum',
+    'max': 'np.maximum',
+    'sin': 'np.sin',
+    'cos': 'np.cos',
+    'tan': 'np.tan',
+    'asin': 'np.arcsin',
+    'acos': 'np.arccos',
+    'atan': 'np.arctan',
+    'atan2': 'np.arctan2',
+    'sinh': 'np.sinh',
+    'cosh': 'np.cosh',
+    'tanh': 'np.tanh',
+    'TMath::Abs': 'np.abs',
+    'TMath::Sqrt': 'np.sqrt',
+    'TMath::Exp': 'np.exp',
+    'TMath::Log': 'np.log',
+    'TMath::Log10': 'np.log10',
+    'TMath::Power': 'np.power',
+    'TMath::Min': 'np.minimum',
+    'TMath::Max': 'np.maximum',
+    'TMath::Sin': 'np.sin',
+    'TMath::Cos': 'np.cos',
+    'TMath::Tan': 'np.tan',
+    'TMath::ASin': 'np.arcsin',
+    'TMath::ACos': 'np.arccos',
+    'TMath::ATan': 'np.arctan',
+    'TMath::ATan2': 'np.arctan2',
+    'TMath::SinH': 'np.sinh',
+    'TMath::CosH': 'np.cosh',
+    'TMath::TanH': 'np.tanh',
+}
+_CONSTANTS = {
+    'pi': 'np.pi',
+    'true': '1.',
+    'false': '0.',
+}
+
+
+# Helpers available to the translated expressions. TTreeFormula works in
+# double precision throughout, and returns 0 for a division by zero
+def _num(x):
+    return np.asarray(x, dtype=np.float64)
+
+
+def _int(x):
+    return np.asarray(x).astype(np.int64)
+
+
+def _div(a, b):
+    a, b = np.broadcast_arrays(_num(a), _num(b))
+    return np.divide(a, b, out=np.zeros(a.shape), where=(b != 0))
+
+
+def _mod(a, b):
+    a, b = np.broadcast_arrays(_int(a), _int(b))
+    return _num(np.fmod(a, b, out=np.zeros(a.shape, dtype=np.int64), where=(b != 0)))
+
+
+def _where(c, a, b):
+    return np.where(_num(c) != 0, a, b)
+
+
+_NAMESPACE = {'np': np, '_num': _num, '_int': _int, '_div': _div, '_mod': _mod, '_where': _where}
+
+
+class _Translator(object):
+    """Recursive descent parser for TTreeFormula expressions, following C
+    operator precedence, that builds the equivalent numpy expression"""
+
+    def __init__(self, expr):
+        self.expr = expr
+        self.tokens = Tokenize(expr)
+        self.pos = 0
+        self.branches = set()
+
+    def Error(self, msg):
+        return ValueError('%s in "%s"' % (msg, self.expr))
+
+    def Peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos][1]
+        return None
+
+    def Next(self):
+        tok = self.tokens[self.pos]
+        self.pos += 1
+        return tok
+
+    def Expect(self, text):
+        if self.Peek() != text:
+            raise self.Error('Expected "%s"' % text)
+        self.pos += 1
+
+    def Translate(self):
+        out = self.Ternary()
+        if self.pos != len(self.tokens):
+            raise self.Error('Unexpected "%s"' % self.Peek())
+        return out
+
+    def Ternary(self):
+        cond = self.Binary(0)
+        if self.Peek() != '?':
+            return cond
+        self.pos += 1
+        a = self.Ternary()
+        self.Expect(':')
+        b = self.Ternary()
+        return '_where(%s, %s, %s)' % (cond, a, b)
+
+    # Binary operators from loosest to tightest binding, and how to write
+    # each of them in numpy
+    _LEVELS = [
+        {'||': '_num(np.logical_or(%s, %s))'},
+        {'&&': '_num(np.logical_and(%s, %s))'},
+        {'|': '_num(_int(%s) | _int(%s))'},
+        {'^': '_num(_int(%s) ^ _int(%s))'},
+        {'&': '_num(_int(%s) & _int(%s))'},
+        {'==': '_num(%s == %s)', '!=': '_num(%s != %s)'},
+        {'<': '_num(%s < %s)', '>': '_num(%s > %s)', '<=': '_num(%s <= %s)', '>=': '_num(%s >= %s)'},
+        {'<<': '_num(_int(%s) << _int(%s))', '>>': '_num(_int(%s) >> _int(%s))'},
+        {'+': '(%s + %s)', '-': '(%s - %s)'},
+        {'*': '(%s * %s)', '/': '_div(%s, %s)', '%': '_mod(%s, %s)'},
+    ]
+
+    def Binary(self, level):
+        if level == len(self._LEVELS):
+            return self.Unary()
+        ops = self._LEVELS[level]
+        out = self.Binary(level + 1)
+        while self.Peek() in ops:
+            op = self.Next()[1]
+            out = ops[op] % (out, self.Binary(level + 1))
+        return out
+
+    def Unary(self):
+        op = self.Peek()
+        if op == '!':
+            self.pos += 1
+            return '_num(np.logical_not(%s))' % self.Unary()
+        if op == '-':
+            self.pos += 1
+            return '(-%s)' % self.Unary()
+        if op == '+':
+            self.pos += 1
+            return self.Unary()
+        if op == '~':
+            self.pos += 1
+            return '_num(~_int(%s))' % self.Unary()
+        return self.Primary()
+
+    def Primary(self):
+        if self.pos >= len(self.tokens):
+            raise self.Error('Unexpected end of expression')
+        i = self.pos
+        kind, text = self.Next()
+        if kind == 'number':
+            return repr(float(text))
+        if text == '(':
+            out = self.Ternary()
+            self.Expect(')')
+            return out
+        if kind != 'name':
+            raise self.Error('Unexpected "%s"' % text)
+        if IsFunctionCall(self.tokens, i):
+            self.Expect('(')
+            args = []
+            while self.Peek() != ')':
+                args.append(self.Ternary())
+                if self.Peek() == ',':
+                    self.pos += 1
+            self.Expect(')')
+            if text == 'TMath::Pi' and not args:
+                return 'np.pi'
+            if text not in _FUNCTIONS:
+                raise self.Error('Unsupported function "%s"' % text)
+            return '%s(%s)' % (_FUNCTIONS[text], ', '.join(args))
+        if text in _CONSTANTS:
+            return _CONSTANTS[text]
+        if '$' in text or '.' in text or '::' in text:
+            raise self.Error('Unsupported variable "%s"' % text)
+        if self.Peek() == '[':
+            raise self.Error('Array indexing is not supported')
+        self.branches.add(text)
+        return '_b[%r]' % text
+
+
+_compiled = {}
+
+
+def Translate(expr):
+    """Translate a TTreeFormula expression into a compiled numpy expression
+    of the branch arrays in _b. Returns (code, branches). Raises ValueError
+    for anything that cannot be translated."""
+    if expr not in _compiled:
+        translator = _Translator(expr)
+        source = translator.Translate()
+        _compiled[expr] = (compile(source, expr, 'eval'), translator.branches)
+    return _compiled[expr]
+
+
+def Evaluate(expr, columns, n):
+    """Evaluate expr over n entries of the branch arrays in columns"""
+    code, _ = Translate(expr)
+    namespace = dict(_NAMESPACE)
+    namespace['_b'] = columns
+    with np.errstate(all='ignore'):
+        return np.broadcast_to(_num(eval(code, namespace)), (n,))
+
+
+class ColumnarHist(object):
+    """Sum of weights and of squared weights of a 1D/2D/3D histogram,
+    including under- and overflows, stored as flat arrays in ROOT's global
+    bin order"""
+
+    def __init__(self, name, title, exprs, edges, weight, titles):
+        self.name = name
+        self.title = title
+        # Expressions and bin edges in axis order, x first
+        self.exprs = exprs
+        self.edges = [np.asarray(e, dtype=np.float64) for e in edges]
+        self.weight = weight
+        self.titles = titles
+        ncells = int(np.prod([len(e) + 1 for e in self.edges]))
+        self.sumw = np.zeros(ncells)
+        self.sumw2 = np.zeros(ncells)
+        self.entries = 0
+
+    def Add(self, other):
+        self.sumw += other.sumw
+        self.sumw2 += other.sumw2
+        self.entries += other.entries
+
+
+def ParseDrawList(draw_list):
+    """Empty ColumnarHists for a MultiDraw-style list of variables or
+    (variable, weight) tuples"""
+    hists = []
+    for entry in draw_list:
+        if type(entry) is tuple:
+            var, weight = entry
+        else:
+            var, weight = entry, '1'
+        exprs, binnings, titles = ParseVariable(var)
+        name = var.split(';')[0]
+        hists.append(ColumnarHist(name + ':' + weight, name, exprs[::-1], binnings[::-1], weight, titles))
+    return hists
+
+
+def FillChunk(hists, columns, n):
+    """Fill empty copies of hists from n entries of the given branch arrays.
+    Every distinct variable, weight factor and binning is only computed once."""
+    values, bins, weights = {}, {}, {}
+    factors, factor_indices = Factorize([h.weight for h in hists])
+
+    def Value(expr):
+        if expr not in values:
+            values[expr] = Evaluate(expr, columns, n)
+        return values[expr]
+
+    out = []
+    for hist, idx in zip(hists, factor_indices):
+        idx = tuple(idx)
+        if idx not in weights:
+            w = np.ones(n)
+            for f in idx:
+                w = w * Value(factors[f])
+            weights[idx] = w
+        w = weights[idx]
+        global_bin = np.zeros(n, dtype=np.int64)
+        stride = 1
+        for expr, edges in zip(hist.exprs, hist.edges):
+            key = (expr, edges.tobytes())
+            if key not in bins:
+                # Bin 0 is the underflow and len(edges) the overflow, as in
+                # ROOT. NaNs end up in the overflow, as they do with TAxis
+                bins[key] = np.searchsorted(edges, Value(expr), side='right')
+            global_bin += stride * bins[key]
+            stride *= len(edges) + 1
+        filled = (w != 0)
+        result = ColumnarHist(hist.name, hist.title, hist.exprs, hist.edges, hist.weight, hist.titles)
+        result.sumw = np.bincount(global_bin[filled], weights=w[filled], minlength=len(hist.sumw))
+        result.sumw2 = np.bincount(global_bin[filled], weights=w[filled] ** 2, minlength=len(hist.sumw))
+        result.entries = int(np.count_nonzero(filled))
+        out.append(result)
+    return out
+
+
+def _ParquetPath(filename):
+    parquet = os.path.splitext(filename)[0] + '.parquet'
+    if os.path.exists(parquet):
+        return parquet
+    return None
+
+
+def EntryOffsets(filename, tree_name):
+    """Entries at which the input can be split without cutting through a
+    row group (parquet) or a basket of any branch (ROOT), starting with 0
+    and ending with the number of entries"""
+    parquet = _ParquetPath(filename)
+    if parquet is not None:
+        import pyarrow.parquet as pq
+        metadata = pq.ParquetFile(parquet).metadata
+        sizes = [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+        return [0] + list(np.cumsum(sizes, dtype=np.int64))
+    import uproot
+    with uproot.open(filename) as f:
+        return list(f[tree_name].common_entry_offsets())
+
+
+def SplitEntries(filename, tree_name, n_ranges):
+    """Split the input into at most n_ranges (first, last) entry ranges of
+    similar size, on the boundaries given by EntryOffsets"""
+    offsets = EntryOffsets(filename, tree_name)
+    n_entries = offsets[-1]
+    target = n_entries // max(n_ranges, 1)
+    bounds = [0]
+    for offset in offsets[1:-1]:
+        if len(bounds) == n_ranges:
+            break
+        if offset - bounds[-1] >= target:
+            bounds.append(offset)
+    bounds.append(n_entries)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _ReadChunks(filename, tree_name, branches, entry_range=None):
+    """List of functions, each returning (columns, n) for one chunk of the
+    entries in entry_range (all entries if None)"""
+    parquet = _ParquetPath(filename)
+    if parquet is not None:
+        import pyarrow.parquet as pq
+        offsets = EntryOffsets(filename, tree_name)
+        first, last = entry_range if entry_range is not None else (0, offsets[-1])
+
+        def ReadGroup(i):
+            table = pq.ParquetFile(parquet).read_row_group(i, columns=branches)
+            columns = {b: table.column(b).to_numpy().astype(np.float64) for b in branches}
+            return columns, table.num_rows
+        # Ranges from SplitEntries always start on a row group
+        return [lambda i=i: ReadGroup(i) for i in range(len(offsets) - 1)
+                if first <= offsets[i] < last]
+
+    import uproot
+    if entry_range is not None:
+        first, last = entry_range
+    else:
+        with uproot.open(filename) as f:
+            first, last = 0, f[tree_name].num_entries
+
+    def ReadRange(start, stop):
+        with uproot.open(filename) as f:
+            arrays = f[tree_name].arrays(branches, entry_start=start, entry_stop=stop, library='np')
+        return {b: arrays[b].astype(np.float64) for b in branches}, stop - start
+    return [lambda start=start: ReadRange(start, min(start + step_size, last))
+            for start in range(first, last, step_size)]
+
+
+def DrawColumns(filename, tree_name, draw_list, workers=1, entry_range=None):
+    """Columnar equivalent of tree.MultiDraw(draw_list), returning a list of
+    ColumnarHists. Chunks are processed on up to workers threads. If
+    entry_range is given, only the entries [first, last) are used."""
+    hists = ParseDrawList(draw_list)
+    branches = set()
+    for hist in hists:
+        for expr in hist.exprs + [hist.weight]:
+            branches |= Translate(expr)[1]
+    branches = sorted(branches)
+
+    def Process(read):
+        columns, n = read()
+        return FillChunk(hists, columns, n)
+
+    chunks = _ReadChunks(filename, tree_name, branches, entry_range)
+    with ThreadPoolExecutor(max_workers=max(1, int(workers))) as executor:
+        for filled in executor.map(Process, chunks):
+            for hist, part in zip(hists, filled):
+                hist.Add(part)
+    return hists
+
+
+def ToROOT(hist):
+    """Convert a ColumnarHist into the TH1D, TH2F or TH3F MultiDraw makes"""
+    import ROOT
+    from Draw.python import HistArrays
+    cls = {1: ROOT.TH1D, 2: ROOT.TH2F, 3: ROOT.TH3F}[len(hist.edges)]
+    h = HistArrays.Make(hist.name, hist.title, hist.edges, cls=cls)
+    HistArrays.Fill(h, hist.sumw, hist.sumw2, hist.entries)
+    # Titles are written z, y, x like the variables
+    axes = [h.GetXaxis(), h.GetYaxis(), h.GetZaxis()]
+    for axis, title in zip(axes, hist.titles[::-1]):
+        axis.SetTitle(title)
+    return h
@@ -0,0 +1,335 @@
+# CompiledDraw.py
+
+# Compiled alternative to the TTreeFormula interpreter used by MultiDraw.
+# The whole draw list of a sample is translated into one C++ function that
+# reads the branches it needs straight into typed buffers and evaluates all
+# variables and weights as plain C++. The function is compiled with ACLiC
+# and cached on disk, keyed by a hash of the generated source, so each
+# distinct draw list is only ever compiled once. Processes compiling the same
+# kernel take turns, under a lock file next to it in the cache.
+
+import fcntl
+import hashlib
+import os
+import ROOT
+from Draw.python.Formula import Tokenize, IsFunctionCall, Factorize
+
+file_directory = os.path.dirname(__file__)
+include_path = os.path.join(os.path.dirname(file_directory), 'interface')
+kernel_dir = os.environ.get(
+    'TIDAL_KERNEL_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'TIDAL', 'kernels')
+)
+
+# TTreeFormula functions and constants and their C++ equivalents. Everything
+# goes through TMath so that e.g. abs() never resolves to the integer version
+_FUNCTIONS = {
+    'abs': 'TMath::Abs',
+    'fabs': 'TMath::Abs',
+    'sqrt': 'TMath::Sqrt',
+    'exp': 'TMath::Exp',
+    'log': 'TMath::Log',
+    'log10': 'TMath::Log10',
+    'pow': 'TMath::Power',
+    'min': 'TMath::Min',
+    'max': 'TMath::Max',
+    'sin': 'TMath::Sin',
+    'cos': 'TMath::Cos',
+    'tan': 'TMath::Tan',
+    'asin': 'TMath::ASin',
+    'acos': 'TMath::ACos',
+    'atan': 'TMath::ATan',
+    'atan2': 'TMath::ATan2',
+    'sinh': 'TMath::SinH',
+    'cosh': 'TMath::CosH',
+    'tanh': 'TMath::TanH',
+}
+_CONSTANTS = {
+    'pi': 'TMath::Pi()',
+    'true': 'true',
+    'false': 'false',
+}
+_LEAF_TYPES = {
+    'Bool_t', 'Char_t', 'UChar_t', 'Short_t', 'UShort_t', 'Int_t', 'UInt_t',
+    'Long_t', 'ULong_t', 'Long64_t', 'ULong64_t', 'Float_t', 'Double_t',
+}
+
+_loaded_kernels = {}
+
+
+# Operators that only work on integers in C++, which TTreeFormula applies to
+# doubles
+_INTEGER_OPS = {'%', '^', '&', '|', '<<', '>>', '~'}
+
+
+class _CppTranslator(object):
+    """Recursive descent parser for TTreeFormula expressions, following C
+    operator precedence, that builds the equivalent C++ expression. As in
+    TTreeFormula, a division by zero gives 0 (tf_div)."""
+
+    def __init__(self, expr, tree, branches):
+        self.expr = expr
+        self.tree = tree
+        self.branches = branches
+        self.tokens = Tokenize(expr)
+        self.pos = 0
+
+    def Error(self, msg):
+        return ValueError('%s in "%s"' % (msg, self.expr))
+
+    def Peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos][1]
+        return None
+
+    def Next(self):
+        tok = self.tokens[self.pos]
+        self.pos += 1
+        return tok
+
+    def Expect(self, text):
+        if self.Peek() != text:
+            raise self.Error('Expected "%s"' % text)
+        self.pos += 1
+
+    def Translate(self):
+        out = self.Ternary()
+        if self.pos != len(self.tokens):
+            raise self.Error('Unexpected "%s"' % self.Peek())
+        return out
+
+    def Ternary(self):
+        cond = self.Binary(0)
+        if self.Peek() != '?':
+            return cond
+        self.pos += 1
+        a = self.Ternary()
+        self.Expect(':')
+        b = self.Ternary()
+        return '(%s ? %s : %s)' % (cond, a, b)
+
+    # Binary operators from loosest to tightest binding
+    _LEVELS = [
+        {'||'}, {'&&'}, {'|'}, {'^'}, {'&'}, {'==', '!='}, {'<', '>', '<=', '>='},
+        {'<<', '>>'}, {'+', '-'}, {'*', '/', '%'},
+    ]
+
+    def Binary(self, level):
+        if level == len(self._LEVELS):
+            return self.Unary()
+        ops = self._LEVELS[level]
+        out = self.Binary(level + 1)
+        while self.Peek() in ops:
+            op = self.Next()[1]
+            if op in _INTEGER_OPS:
+                raise self.Error('Unsupported operator "%s"' % op)
+            rhs = self.Binary(level + 1)
+            out = 'tf_div(%s, %s)' % (out, rhs) if op == '/' else '(%s %s %s)' % (out, op, rhs)
+        return out
+
+    def Unary(self):
+        op = self.Peek()
+        if op in ('!', '-'):
+            self.pos += 1
+            return '(%s%s)' % (op, self.Unary())
+        if op == '+':
+            self.pos += 1
+            return self.Unary()
+        if op in _INTEGER_OPS:
+            raise self.Error('Unsupported operator "%s"' % op)
+        return self.Primary()
+
+    def Primary(self):
+        if self.pos >= len(self.tokens):
+            raise self.Error('Unexpected end of expression')
+        i = self.pos
+        kind, text = self.Next()
+        if kind == 'number':
+            # TTreeFormula evaluates everything in double precision, so make
+            # sure integer literals never trigger integer division
+            if not any(c in text for c in '.eE'):
+                text += '.'
+            return text
+        if text == '(':
+            out = self.Ternary()
+            self.Expect(')')
+            return '(%s)' % out
+        if kind != 'name':
+            raise self.Error('Unexpected "%s"' % text)
+        if IsFunctionCall(self.tokens, i):
+            if text in _FUNCTIONS:
+                func = _FUNCTIONS[text]
+            elif text.startswith('TMath::'):
+                func = text
+            else:
+                raise self.Error('Unsupported function "%s"' % text)
+            self.Expect('(')
+            args = []
+            while self.Peek() != ')':
+                args.append(self.Ternary())
+                if self.Peek() == ',':
+                    self.pos += 1
+            self.Expect(')')
+            return '%s(%s)' % (func, ', '.join(args))
+        if text in _CONSTANTS:
+            return _CONSTANTS[text]
+        if '$' in text or '.' in text or '::' in text:
+            raise self.Error('Unsupported variable "%s"' % text)
+        if self.Peek() == '[':
+            raise self.Error('Array indexing is not supported')
+        leaf = self.tree.GetLeaf(text)
+        if not leaf:
+            raise self.Error('No leaf "%s" in tree' % text)
+        if leaf.GetLeafCount() or leaf.GetLenStatic() > 1:
+            raise self.Error('Array leaf "%s" is not supported' % text)
+        if leaf.GetTypeName() not in _LEAF_TYPES:
+            raise self.Error('Leaf "%s" has unsupported type %s' % (text, leaf.GetTypeName()))
+        self.branches[text] = leaf.GetTypeName()
+        return text
+
+
+def ToCpp(expr, tree, branches):
+    """Translate a TTreeFormula expression into C++. Every branch that is
+    read is added to branches as name -> leaf type. Raises ValueError for
+    anything the compiled backend cannot handle (aliases, arrays, special
+    TTreeFormula variables, unknown functions, integer operators)."""
+    return _CppTranslator(expr, tree, branches).Translate()
+
+
+def GenerateSource(tree, formulae, weights, hists):
+    """Generate the C++ source of a kernel filling hists from the parallel
+    lists of variable and weight expressions, following the same
+    conventions as MultiDraw.cc (2D/3D histograms sit at the last of their
+    two/three variables). Returns the source with @NAME@ left in place of
+    the kernel name, and the names of the branches it reads."""
+    branches = {}
+    var_exprs = {}
+    var_index = []
+    for formula in formulae:
+        if formula not in var_exprs:
+            var_exprs[formula] = (len(var_exprs), ToCpp(formula, tree, branches))
+        var_index.append(var_exprs[formula][0])
+    # As in MultiDraw, weights are products of shared factors, each computed
+    # at most once per entry and only if no earlier factor was zero
+    factors, factor_indices = Factorize(weights)
+    factor_exprs = [ToCpp(f, tree, branches) for f in factors]
+    weight_factors = {}
+    weight_index = []
+    for idx in factor_indices:
+        weight_factors.setdefault(tuple(idx), len(weight_factors))
+        weight_index.append(weight_factors[tuple(idx)])
+
+    lines = [
+        '#include "MultiDraw.h"',
+        '#include "TBranch.h"',
+        '#include "TH1D.h"',
+        '#include "TH2F.h"',
+        '#include "TH3F.h"',
+        '#include "TMath.h"',
+        '#include "TObjArray.h"',
+        '#include "TTree.h"',
+        '',
+        '// TTreeFormula gives 0 for a division by zero. Guarded, as cling sees',
+        '// the sources of all kernels loaded',
+        '#ifndef TIDAL_TF_DIV',
+        '#define TIDAL_TF_DIV',
+        'static inline double tf_div(double a, double b) { return b == 0. ? 0. : a / b; }',
+        '#endif',
+        '',
+        'void @NAME@_Fill(TTree *_tree, TObjArray *_hists, Long64_t _first, Long64_t _last) {',
+    ]
+    for name, leaf_type in sorted(branches.items()):
+        lines.append('  %s buf_%s = 0;' % (leaf_type, name))
+        lines.append('  TBranch *br_%s = nullptr;' % name)
+        lines.append('  _tree->SetBranchAddress("%s", &buf_%s, &br_%s);' % (name, name, name))
+    for idx, hist in enumerate(hists):
+        for cls in ('TH1D', 'TH2F', 'TH3F'):
+            if isinstance(hist, getattr(ROOT, cls)):
+                lines.append('  %s *_h_%i = static_cast<%s *>(_hists->At(%i));' % (cls, idx, cls, idx))
+    lines += [
+        '  const double _treeWeight = _tree->GetWeight();',
+        '  for (Long64_t _i = _first; _i < _last; ++_i) {',
+        '    Long64_t _local = _tree->LoadTree(_i);',
+        '    if (_local < 0) break;',
+    ]
+    for name in sorted(branches):
+        lines.append('    br_%s->GetEntry(_local);' % name)
+    for name in sorted(branches):
+        lines.append('    const double %s = buf_%s;' % (name, name))
+    for idx, expr in sorted(var_exprs.values()):
+        lines.append('    const double _var_%i = (%s);' % (idx, expr))
+    for f in range(len(factors)):
+        lines.append('    double _f_%i = 0.;' % f)
+        lines.append('    bool _done_%i = false;' % f)
+    for idx_factors, idx in sorted(weight_factors.items(), key=lambda x: x[1]):
+        lines.append('    double _wt_%i = _treeWeight;' % idx)
+        lines.append('    do {')
+        for f in idx_factors:
+            lines.append('      if (!_done_%i) { _f_%i = (%s); _done_%i = true; }' % (f, f, factor_exprs[f], f))
+            lines.append('      _wt_%i *= _f_%i;' % (idx, f))
+            lines.append('      if (!_wt_%i) break;' % idx)
+        lines.append('    } while (false);')
+    for idx, hist in enumerate(hists):
+        w = '_wt_%i' % weight_index[idx]
+        if isinstance(hist, ROOT.TH3F) and idx >= 2:
+            args = '_var_%i, _var_%i, _var_%i' % (var_index[idx], var_index[idx - 1], var_index[idx - 2])
+        elif isinstance(hist, ROOT.TH2F) and idx >= 1:
+            args = '_var_%i, _var_%i' % (var_index[idx], var_index[idx - 1])
+        elif isinstance(hist, ROOT.TH1D):
+            args = '_var_%i' % var_index[idx]
+        else:
+            continue
+        lines.append('    if (%s) _h_%i->Fill(%s, %s);' % (w, idx, args, w))
+    lines += [
+        '  }',
+        '  _tree->ResetBranchAddresses();',
+        '}',
+        '',
+        'void @NAME@(TTree *tree, TObjArray *Hists, UInt_t NThreads, Long64_t FirstEntry, Long64_t LastEntry) {',
+        '  MultiDrawKernel(tree, Hists, NThreads, &@NAME@_Fill, FirstEntry, LastEntry);',
+        '}',
+        '',
+    ]
+    return '\n'.join(lines), sorted(branches)
+
+
+def GetKernel(tree, formulae, weights, hists):
+    """Return the compiled kernel for this draw list, building it if it is
+    not already in the on-disk cache. Returns None if the draw list cannot
+    be compiled, in which case the caller should fall back to TTreeFormula.
+    The names of the branches the kernel reads are returned alongside it."""
+    try:
+        source, branches = GenerateSource(tree, formulae, weights, hists)
+    except ValueError as err:
+        print('Compiled draw not possible, falling back to TTreeFormula:', err)
+        return None, None
+
+    name = 'MultiDrawKernel_' + hashlib.sha1(source.encode()).hexdigest()[:16]
+    if name in _loaded_kernels:
+        return _loaded_kernels[name], branches
+
+    os.makedirs(kernel_dir, exist_ok=True)
+    source_path = os.path.join(kernel_dir, name + '.C')
+    if ('-I%s' % include_path) not in ROOT.gSystem.GetIncludePath():
+        ROOT.gSystem.AddIncludePath('-I%s' % include_path)
+
+    # The forked workers of a job, and jobs sharing the cache, build the
+    # same kernels. The lock keeps them from loading a library another one
+    # is still writing, and the cache is only checked once it is held
+    with open(os.path.join(kernel_dir, name + '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(source_path):
+            # Write then rename so that a killed job never leaves a partial file
+            tmp_path = '%s.%i.tmp' % (source_path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                f.write(source.replace('@NAME@', name))
+            os.replace(tmp_path, source_path)
+        # ACLiC only recompiles if the source is newer than the library
+        compiled = ROOT.gSystem.CompileMacro(source_path, 'kO', '', kernel_dir)
+    if not compiled:
+        print('Compilation of %s failed, falling back to TTreeFormula' % source_path)
+        return None, None
+
+    kernel = getattr(ROOT, name)
+    _loaded_kernels[name] = kernel
+    return kernel, branches
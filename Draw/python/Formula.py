@@ -0,0 +1,201 @@
+# Formula.py
+
+# Helpers for picking apart the TTreeFormula-style strings built by nodes.py
+# and systematics.py, e.g. "((weight))* (iso_1<0.15 && pt_2>20)* (os)"
+
+import re
+import numpy as np
+
+_TOKEN_RE = re.compile(r"""
+    (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<name>[A-Za-z_][A-Za-z0-9_$.]*(?:::[A-Za-z_][A-Za-z0-9_]*)*)
+  | (?P<op>&&|\|\||==|!=|<=|>=|<<|>>|[-+*/%<>!&|^~?:(),\[\]])
+  | (?P<space>\s+)
+""", re.VERBOSE)
+
+
+# Operators binding more loosely than '*', or that make '*' non-associative
+# with its neighbours. A product containing any of these at the top level
+# is left whole by SplitProduct
+_NON_PRODUCT_OPS = {
+    '+', '-', '/', '%', '<', '>', '<=', '>=', '==', '!=', '&&', '||',
+    '&', '|', '^', '<<', '>>', '?', ':', ',',
+}
+_BOOLEAN_OPS = {'<', '>', '<=', '>=', '==', '!=', '&&', '||'}
+
+
+def split_vals(vals):
+    """Converts a string '1:3|1,4,5' into a list [1, 2, 3, 4, 5]"""
+    res = set()
+    first = vals.split(',')
+    for f in first:
+        second = re.split('[:|]', f)
+        # print second
+        if len(second) == 1:
+            res.add(float(second[0]))
+        if len(second) == 3:
+            x1 = float(second[0])
+            while x1 < float(second[1]) + 1E-5:
+                res.add(x1)
+                x1 += float(second[2])
+    return sorted([x for x in res])
+
+
+def ParseBinning(arg, is_variable):
+    """Bin edges for "[e0,e1,...]" (is_variable) or "(nbins,lo,hi)" binning"""
+    if is_variable:
+        return split_vals(arg)
+    str_binning = [x.strip() for x in arg.split(',')]
+    if len(str_binning) != 3:
+        raise ValueError('Cannot parse binning "(%s)"' % arg)
+    step = (float(str_binning[2]) - float(str_binning[1])) / float(str_binning[0])
+    return list(np.arange(float(str_binning[1]), float(str_binning[2]) + step / 2, step))
+
+
+def ParseVariable(var):
+    """Split a draw-list variable into its expressions, binnings and axis
+    titles. Variables look like "expr(binning)" or "expr[binning]" in 1D,
+    "y,x[binning_y],(binning_x)" in 2D and "z,y,x(...),(...),(...)" in 3D,
+    optionally followed by ";title;..." parts. Expressions and binnings are
+    returned in the order they appear, so the last of each is the x axis."""
+    split_var = var.split(';')
+    rest = split_var[0]
+    binnings = []
+    while True:
+        rest = rest.strip()
+        if rest.endswith(')'):
+            pos_open, pos_close = rest.rfind('('), len(rest) - 1
+        elif rest.endswith(']'):
+            pos_open, pos_close = rest.rfind('['), len(rest) - 1
+        else:
+            pos_open = pos_close = -1
+        if pos_open == -1:
+            raise ValueError('Cannot find the binning of "%s"' % var)
+        binnings.insert(0, ParseBinning(rest[pos_open + 1:pos_close], rest[-1] == ']'))
+        rest = rest[:pos_open].strip()
+        # Another binning follows if the expressions end in a comma
+        if not rest.endswith(',') or len(binnings) == 3:
+            break
+        rest = rest[:-1]
+    if len(binnings) == 1:
+        exprs = [rest]
+    else:
+        exprs = rest.split(',')
+    return exprs, binnings, split_var[1:]
+
+
+def TokenSpans(expr):
+    """Like Tokenize, but each token is (kind, text, start, end) with the
+    position of the token in expr."""
+    tokens = []
+    pos = 0
+    while pos < len(expr):
+        match = _TOKEN_RE.match(expr, pos)
+        if match is None:
+            raise ValueError('Cannot parse "%s" at position %i: "%s"' % (expr, pos, expr[pos:]))
+        kind = match.lastgroup
+        if kind != 'space':
+            tokens.append((kind, match.group(kind), match.start(), match.end()))
+        pos = match.end()
+    return tokens
+
+
+def Tokenize(expr):
+    """Split an expression into a list of (kind, text) tuples, where kind is
+    one of 'number', 'name' or 'op'. Whitespace is dropped."""
+    return [(kind, text) for kind, text, _, _ in TokenSpans(expr)]
+
+
+def IsFunctionCall(tokens, i):
+    """True if the name token at position i is called, e.g. abs( ... )"""
+    return i + 1 < len(tokens) and tokens[i + 1] == ('op', '(')
+
+
+def _TopLevel(tokens):
+    """Yield (index, token) for the tokens of a TokenSpans list that are not
+    inside any brackets"""
+    depth = 0
+    for i, tok in enumerate(tokens):
+        if tok[1] in ('(', '['):
+            depth += 1
+        elif tok[1] in (')', ']'):
+            depth -= 1
+        elif depth == 0:
+            yield i, tok
+
+
+def StripParens(expr):
+    """Remove any brackets enclosing the whole of expr, e.g. "((wt))" -> "wt" """
+    expr = expr.strip()
+    while expr.startswith('(') and expr.endswith(')'):
+        depth = 0
+        for i, c in enumerate(expr):
+            depth += (c == '(') - (c == ')')
+            if depth == 0:
+                break
+        if i != len(expr) - 1:
+            break
+        expr = expr[1:-1].strip()
+    return expr
+
+
+def SplitProduct(expr):
+    """Split expr into the factors of its top-level product, flattening
+    nested products, e.g. "((wt))* (os)* (a*b)" -> ["wt", "os", "a", "b"].
+    An expression that is not a pure product is returned as a single factor."""
+    expr = StripParens(expr)
+    try:
+        tokens = TokenSpans(expr)
+    except ValueError:
+        return [expr]
+    top = list(_TopLevel(tokens))
+    if any(tok[1] in _NON_PRODUCT_OPS for _, tok in top if tok[0] == 'op'):
+        return [expr]
+    stars = [i for i, tok in top if tok[1] == '*']
+    if not stars:
+        return [expr]
+    factors = []
+    begin = 0
+    for end in stars + [len(tokens)]:
+        if end == begin:
+            # Leading, trailing or doubled '*': not something we understand
+            return [expr]
+        text = expr[tokens[begin][2]:tokens[end - 1][3]]
+        factors += SplitProduct(text)
+        begin = end + 1
+    return factors
+
+
+def IsBoolean(expr):
+    """True if expr looks like a selection rather than a weight, i.e. its
+    outermost operation is a comparison, a logical operation or a negation"""
+    expr = StripParens(expr)
+    try:
+        tokens = TokenSpans(expr)
+    except ValueError:
+        return False
+    if tokens and tokens[0][1] == '!':
+        return True
+    return any(tok[1] in _BOOLEAN_OPS for _, tok in _TopLevel(tokens) if tok[0] == 'op')
+
+
+def Factorize(weights):
+    """Split each weight in the list into product factors, shared between
+    all weights. Returns (factors, indices), where factors is the list of
+    distinct factor strings and indices[i] lists the factors of weights[i].
+    Selection-like factors go first so that the product can stop early at
+    the first one that is zero; the order is otherwise kept. A weight of
+    "1" has no factors."""
+    factors, lookup, indices = [], {}, []
+    for weight in weights:
+        # A factor of one changes nothing, so don't bother evaluating it
+        split = [f for f in SplitProduct(weight) if f not in ('1', '1.', '1.0')]
+        split = [f for f in split if IsBoolean(f)] + [f for f in split if not IsBoolean(f)]
+        idx = []
+        for f in split:
+            if f not in lookup:
+                lookup[f] = len(factors)
+                factors.append(f)
+            idx.append(lookup[f])
+        indices.append(idx)
+    return factors, indices
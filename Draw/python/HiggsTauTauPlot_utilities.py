@@ -2,6 +2,11 @@ from uncertainties import ufloat
 import ROOT
 from array import array
 import fnmatch as fn
+import functools
+import numpy as np
+from Draw.python import HistArrays
+# FindRebinning is imported from here by HiggsTauTauPlot
+from Draw.python.Rebinning import FindRebinning, RebinMap
 
 ROOT.TH1.SetDefaultSumw2(True)
 
@@ -22,6 +27,8 @@ def PrintSummary(
     for node in nodes:
         if channel == "em" and node.name == "W":
             continue
+        if node.shape is None:
+            continue
         if node.shape.rate.n == 0:
             per_err = 0
         else:
@@ -82,6 +89,8 @@ def GetTotals(ana, nodename="", add_name="", samples_dict={}, outfile="outfile.r
             continue
         if node.name not in processes:
             continue
+        if node.shape is None:
+            continue
         if first_hist:
             total_bkg = ana.nodes[nodename].nodes[node.name].shape.hist.Clone()
             first_hist = False
@@ -99,6 +108,8 @@ def FixBins(ana, nodename="", outfile="output.root"):
     for node in nodes:
         if "data_obs" in node.name:
             continue
+        if node.shape is None:
+            continue
         hist = outfile.Get(nodename + "/" + node.name)
         outfile.cd(nodename)
         # Fix empty histogram
@@ -120,148 +131,98 @@ def Get1DBinNumFrom3D(h3d, xbin, ybin, zbin):
     return (zbin - 1) * Nxbins * Nybins + (ybin - 1) * Nxbins + xbin - 1
 
 
+@functools.lru_cache(maxsize=None)
+def UnrollMap2D(Nxbins, Nybins, inc_y_of=True):
+    """
+    Index map used by UnrollHist2D for a 2D histogram with Nxbins x Nybins
+    bins: the global bins of the 2D histogram, the bins of the unrolled
+    histogram they go to and the number of unrolled bins. The map only
+    depends on the numbers of bins, so it is shared between histograms
+    """
+    n = 1 if inc_y_of else 0
+    i, j = np.meshgrid(np.arange(1, Nxbins + 1), np.arange(1, Nybins + 1 + n), indexing="ij")
+    src = j * (Nxbins + 2) + i
+    # same numbering as Get1DBinNumFrom2D
+    dst = (j - 1) * Nxbins + i - 1 + 1
+    return src.ravel(), dst.ravel(), (Nybins + n) * Nxbins
+
+
+@functools.lru_cache(maxsize=None)
+def UnrollMap3D(Nxbins, Nybins, Nzbins, inc_y_of=False, inc_z_of=True):
+    """
+    Index map used by UnrollHist3D, like UnrollMap2D
+    """
+    ny = 1 if inc_y_of else 0
+    nz = 1 if inc_z_of else 0
+    i, j, k = np.meshgrid(
+        np.arange(1, Nxbins + 1), np.arange(1, Nybins + 1 + ny), np.arange(1, Nzbins + 1 + nz), indexing="ij"
+    )
+    src = (k * (Nybins + 2) + j) * (Nxbins + 2) + i
+    # same numbering as Get1DBinNumFrom3D
+    dst = (k - 1) * Nxbins * Nybins + (j - 1) * Nxbins + i - 1 + 1
+    src, dst = src.ravel(), dst.ravel()
+    # With the y over-flow included some bins are written twice, and as in
+    # a loop over i, j and k it is the last write that counts
+    _, last = np.unique(dst[::-1], return_index=True)
+    keep = len(dst) - 1 - last
+    return src[keep], dst[keep], (Nzbins + nz) * (Nybins + ny) * Nxbins
+
+
+def _FillUnrolled(hist, h1d, src, dst, Nbins):
+    HistArrays.Content(h1d)[dst] = HistArrays.Content(hist)[src]
+    # errors are set, so the sums of squared weights become GetBinError ** 2
+    HistArrays.Sumw2(h1d)[dst] = HistArrays.Errors(hist)[src] ** 2
+    h1d.ResetStats()
+    # one SetBinContent per bin looped over
+    h1d.SetEntries(Nbins)
+    return h1d
+
+
 def UnrollHist2D(h2d, inc_y_of=True):
     """
     Unroll a 2D histogram h2d into a 1d histogram
     inc_y_of = True includes the y over-flow bins
     """
-    if inc_y_of:
-        n = 1
-    else:
-        n = 0
-    Nbins = (h2d.GetNbinsY() + n) * (h2d.GetNbinsX())
+    src, dst, Nbins = UnrollMap2D(h2d.GetNbinsX(), h2d.GetNbinsY(), inc_y_of)
     if isinstance(h2d, ROOT.TH2D):
         h1d = ROOT.TH1D(h2d.GetName(), "", Nbins, 0, Nbins)
     else:
         h1d = ROOT.TH1F(h2d.GetName(), "", Nbins, 0, Nbins)
-    for i in range(1, h2d.GetNbinsX() + 1):
-        for j in range(1, h2d.GetNbinsY() + 1 + n):
-            glob_bin = Get1DBinNumFrom2D(h2d, i, j)
-            content = h2d.GetBinContent(i, j)
-            error = h2d.GetBinError(i, j)
-            h1d.SetBinContent(glob_bin + 1, content)
-            h1d.SetBinError(glob_bin + 1, error)
-    return h1d
+    return _FillUnrolled(h2d, h1d, src, dst, Nbins)
 
 
 def UnrollHist3D(h3d, inc_y_of=False, inc_z_of=True):
-    if inc_y_of:
-        ny = 1
-    else:
-        ny = 0
-    if inc_z_of:
-        nz = 1
-    else:
-        nz = 0
-
-    Nbins = (h3d.GetNbinsZ() + nz) * (h3d.GetNbinsY() + ny) * (h3d.GetNbinsX())
+    src, dst, Nbins = UnrollMap3D(h3d.GetNbinsX(), h3d.GetNbinsY(), h3d.GetNbinsZ(), inc_y_of, inc_z_of)
     h1d = ROOT.TH1D(h3d.GetName(), "", Nbins, 0, Nbins)
-    for i in range(1, h3d.GetNbinsX() + 1):
-        for j in range(1, h3d.GetNbinsY() + 1 + ny):
-            for k in range(1, h3d.GetNbinsZ() + 1 + nz):
-                glob_bin = Get1DBinNumFrom3D(h3d, i, j, k)
-                content = h3d.GetBinContent(i, j, k)
-                error = h3d.GetBinError(i, j, k)
-                h1d.SetBinContent(glob_bin + 1, content)
-                h1d.SetBinError(glob_bin + 1, error)
-    return h1d
+    return _FillUnrolled(h3d, h1d, src, dst, Nbins)
 
 
-def FindRebinning(hist, BinThreshold=100, BinUncertFraction=0.5):
-    # hist.Print("all")
-    # getting binning
-    binning = []
-    for i in range(1, hist.GetNbinsX() + 2):
-        binning.append(hist.GetBinLowEdge(i))
-
-    # remove outer 0 bins
-    still_zero = True
-    for i in range(1, hist.GetNbinsX()):
-        if not (hist.GetBinContent(i) == 0 and hist.GetBinError(i) == 0):
-            still_zero = False
-        if still_zero:
-            binning.remove(min(binning, key=lambda x: abs(x - hist.GetBinLowEdge(i))))
-        else:
-            break
-    hist = RebinHist(hist, binning)
-
-    still_zero = True
-    for i in reversed(range(2, hist.GetNbinsX() + 1)):
-        if not (hist.GetBinContent(i) == 0 and hist.GetBinError(i) == 0):
-            still_zero = False
-        if still_zero:
-            binning.remove(
-                min(binning, key=lambda x: abs(x - hist.GetBinLowEdge(i + 1)))
-            )
-        else:
-            break
-    hist = RebinHist(hist, binning)
-
-    # left to right
-    finished = False
-    k = 0
-    while not finished and k < 1000:
-        k += 1
-        for i in range(1, hist.GetNbinsX()):
-            if hist.GetBinContent(i) > 0:
-                uncert_frac = hist.GetBinError(i) / hist.GetBinContent(i)
-            else:
-                uncert_frac = BinUncertFraction + 1
-            # print hist.GetBinLowEdge(i), uncert_frac, BinUncertFraction,  hist.GetBinContent(i), BinThreshold
-            if uncert_frac > BinUncertFraction and hist.GetBinContent(i) < BinThreshold:
-                # binning.remove(hist.GetBinLowEdge(i+1))
-                binning.remove(
-                    min(binning, key=lambda x: abs(x - hist.GetBinLowEdge(i + 1)))
-                )
-                hist = RebinHist(hist, binning)
-                break
-            elif i + 1 == hist.GetNbinsX():
-                finished = True
-
-    # right to left
-    finished = False
-    k = 0
-    while not finished and k < 1000:
-        k += 1
-        for i in reversed(range(2, hist.GetNbinsX() + 1)):
-            if hist.GetBinContent(i) > 0:
-                uncert_frac = hist.GetBinError(i) / hist.GetBinContent(i)
-            else:
-                uncert_frac = BinUncertFraction + 1
-            # print hist.GetBinLowEdge(i), uncert_frac, BinUncertFraction,  hist.GetBinContent(i), BinThreshold
-            if uncert_frac > BinUncertFraction and hist.GetBinContent(i) < BinThreshold:
-                #        binning.remove(hist.GetBinLowEdge(i))
-                binning.remove(
-                    min(binning, key=lambda x: abs(x - hist.GetBinLowEdge(i)))
-                )
-                hist = RebinHist(hist, binning)
-                break
-            elif i == 2:
-                finished = True
-
-    #  hist.Print("all")
-    return binning
+def UnrollDirectory(directory, inc_y_of=True):
+    """
+    Unroll every 2D histogram in a directory, sharing the index map between
+    all histograms with the same binning
+    Returns a list of (2D histogram, unrolled histogram)
+    """
+    res = []
+    for key in directory.GetListOfKeys():
+        hist = directory.Get(key.GetName())
+        if isinstance(hist, ROOT.TH2):
+            res.append((hist, UnrollHist2D(hist, inc_y_of)))
+    return res
 
 
 def RebinHist(hist, binning):
-    # getting initial binning
-    initial_binning = []
-    for i in range(1, hist.GetNbinsX() + 2):
-        initial_binning.append(hist.GetBinLowEdge(i))
-
+    # old bins are mapped to new bins once per original binning, then added
+    # up in order of the old bins
+    old_bins, new_bins = RebinMap(hist, binning)
     new_binning = array("f", map(float, binning))
     hout = ROOT.TH1D(hist.GetName(), "", len(new_binning) - 1, new_binning)
-    for i in range(1, hout.GetNbinsX() + 1):
-        for j in range(1, hist.GetNbinsX() + 1):
-            if hist.GetBinCenter(j) > hout.GetBinLowEdge(i) and hist.GetBinCenter(
-                j
-            ) < hout.GetBinLowEdge(i + 1):
-                new_content = hout.GetBinContent(i) + hist.GetBinContent(j)
-                new_error = (hout.GetBinError(i) ** 2 + hist.GetBinError(j) ** 2) ** 0.5
-                hout.SetBinContent(i, new_content)
-                hout.SetBinError(i, new_error)
+    content = np.zeros(hout.GetNcells())
+    sumw2 = np.zeros(hout.GetNcells())
+    np.add.at(content, new_bins, HistArrays.Content(hist)[old_bins].astype(np.float64))
+    np.add.at(sumw2, new_bins, HistArrays.Errors(hist)[old_bins] ** 2)
     # hout.Print("all")
-    return hout
+    return HistArrays.Fill(hout, content, sumw2, entries=len(old_bins))
 
 
 def RenameDatacards(outfile, nodename):
@@ -304,47 +265,29 @@ def Total_Uncertainty(h0, hists=[]):
     hout.SetName(h0.GetName() + "_full_uncerts")
     hup.SetName(h0.GetName() + "_full_uncerts_up")
     hdown.SetName(h0.GetName() + "_full_uncerts_down")
+    # bins 1 to the overflow, done as arrays over all of them at once
+    bins = slice(1, h0.GetNbinsX() + 2)
+    x0 = HistArrays.Content(h0)[bins].astype(np.float64)
+    stat = HistArrays.Errors(h0)[bins]
     if len(hists) == 0:
-        for i in range(1, h0.GetNbinsX() + 2):
-            x0 = h0.GetBinContent(i)
-            up = h0.GetBinError(i)
-            down = h0.GetBinError(i)
-            hup.SetBinContent(i, x0 + up)
-            hdown.SetBinContent(i, x0 - down)
-            c = (x0 + up + x0 - down) / 2
-            u = (up + down) / 2
-            hout.SetBinContent(i, c)
-            hout.SetBinError(i, u)
-        return (hout, hup, hdown)
-
-    for i in range(1, h0.GetNbinsX() + 2):
-        x0 = h0.GetBinContent(i)
-        uncerts_up = [0.0]
-        uncerts_down = [0.0]
+        up = stat
+        down = stat
+    else:
+        up = np.zeros_like(x0)
+        down = np.zeros_like(x0)
         for h in hists:
-            x = h.GetBinContent(i)
-            if x > x0:
-                uncerts_up.append(x - x0)
-            if x < x0:
-                uncerts_down.append(x0 - x)
-        up = 0.0
-        down = 0.0
-        for u in uncerts_up:
-            up += u**2
-        for u in uncerts_down:
-            down += u**2
+            diff = HistArrays.Content(h)[bins].astype(np.float64) - x0
+            up += np.where(diff > 0, diff, 0.0) ** 2
+            down += np.where(diff < 0, -diff, 0.0) ** 2
 
         # add the statistical uncertainty
-        up += h0.GetBinError(i) ** 2
-        down += h0.GetBinError(i) ** 2
-
-        up = up**0.5
-        down = down**0.5
-
-        hup.SetBinContent(i, x0 + up)
-        hdown.SetBinContent(i, x0 - down)
-        c = (x0 + up + x0 - down) / 2
-        u = (up + down) / 2
-        hout.SetBinContent(i, c)
-        hout.SetBinError(i, u)
+        up = np.sqrt(up + stat**2)
+        down = np.sqrt(down + stat**2)
+
+    HistArrays.Content(hup)[bins] = x0 + up
+    HistArrays.Content(hdown)[bins] = x0 - down
+    HistArrays.Content(hout)[bins] = (x0 + up + x0 - down) / 2
+    HistArrays.Sumw2(hout)[bins] = ((up + down) / 2) ** 2
+    for h in (hout, hup, hdown):
+        h.ResetStats()
     return (hout, hup, hdown)
@@ -0,0 +1,119 @@
+# HistArrays.py
+
+# numpy views of the bin contents and sums of squared weights of ROOT
+# histograms, sharing the memory of the histogram rather than copying it one
+# GetBinContent at a time, and histograms made from numpy arrays. The arrays
+# always include the under- and overflow bins and are indexed by global bin
+# number, so bin (x, y) of a TH2 is at y * (nx + 2) + x, and Cells gives the
+# shape to reshape them to, e.g. content.reshape(Cells(hist))[y, x].
+
+import numpy as np
+import ROOT
+
+# numpy types of the bin contents of TH1D, TH1F, TH1I, ... by their array base
+_ARRAY_TYPES = [('TArrayD', np.float64), ('TArrayF', np.float32), ('TArrayI', np.int32),
+                ('TArrayS', np.int16), ('TArrayC', np.int8)]
+
+
+def _View(buffer, dtype, n):
+    # PyROOT doesn't know the length of the array behind the pointer
+    buffer.reshape((n,))
+    return np.frombuffer(buffer, dtype=dtype, count=n)
+
+
+def ContentType(hist):
+    """numpy type of the bin contents of hist"""
+    return next(t for cls, t in _ARRAY_TYPES if isinstance(hist, getattr(ROOT, cls)))
+
+
+def Cells(hist):
+    """Number of bins along (z, y, x), flow bins included, for the axes the
+    histogram has"""
+    cells = (hist.GetNbinsZ() + 2, hist.GetNbinsY() + 2, hist.GetNbinsX() + 2)
+    return cells[3 - hist.GetDimension():]
+
+
+def AxisEdges(axis):
+    """Bin edges of a TAxis, as TAxis::GetBinLowEdge gives them"""
+    n = axis.GetNbins()
+    xbins = axis.GetXbins()
+    if xbins.GetSize():
+        return _View(xbins.GetArray(), np.float64, n + 1).copy()
+    return axis.GetXmin() + np.arange(n + 1) * ((axis.GetXmax() - axis.GetXmin()) / n)
+
+
+def AxisCenters(axis):
+    """Bin centres of a TAxis, as TAxis::GetBinCenter gives them"""
+    n = axis.GetNbins()
+    xbins = axis.GetXbins()
+    if xbins.GetSize():
+        edges = _View(xbins.GetArray(), np.float64, n + 1)
+        return edges[:-1] + 0.5 * (edges[1:] - edges[:-1])
+    width = (axis.GetXmax() - axis.GetXmin()) / n
+    return axis.GetXmin() + np.arange(n) * width + 0.5 * width
+
+
+def Content(hist):
+    """View of the bin contents of hist. Writing to it changes the bins but
+    not the statistics, see ResetStats."""
+    return _View(hist.GetArray(), ContentType(hist), hist.GetNcells())
+
+
+def Sumw2(hist):
+    """View of the sums of squared weights of hist, which are made from the
+    contents first if the histogram has none"""
+    if not hist.GetSumw2N():
+        hist.Sumw2()
+    return _View(hist.GetSumw2().GetArray(), np.float64, hist.GetNcells())
+
+
+def Views(hist):
+    """(Content, Sumw2) of hist, with None for the sums of squared weights
+    if the histogram has none"""
+    return Content(hist), Sumw2(hist) if hist.GetSumw2N() else None
+
+
+def Errors(hist):
+    """Bin errors as GetBinError gives them, as a new array"""
+    content, sumw2 = Views(hist)
+    if sumw2 is None:
+        return np.sqrt(np.abs(content.astype(np.float64)))
+    return np.sqrt(sumw2)
+
+
+def Fill(hist, content, sumw2=None, entries=None):
+    """Set all bins of hist from arrays over the global bins. The statistics
+    are recomputed from the new contents and the number of entries set to
+    entries if given."""
+    Content(hist)[:] = content
+    if sumw2 is not None:
+        Sumw2(hist)[:] = sumw2
+    hist.ResetStats()
+    if entries is not None:
+        hist.SetEntries(entries)
+    return hist
+
+
+def FromArrays(template, content, sumw2=None, entries=None):
+    """Clone of template, with the same name, title and axes, holding the
+    given bins"""
+    hist = template.Clone()
+    return Fill(hist, content, sumw2, entries)
+
+
+def Make(name, title, edges, content=None, sumw2=None, cls=None):
+    """New histogram with variable bins, one list of edges per axis in x, y,
+    z order, by default a TH1D, TH2D or TH3D, optionally filled from
+    arrays"""
+    from array import array
+    if cls is None:
+        cls = [ROOT.TH1D, ROOT.TH2D, ROOT.TH3D][len(edges) - 1]
+    bin_args = []
+    for axis_edges in edges:
+        bin_args += [len(axis_edges) - 1, array('d', axis_edges)]
+    hist = cls(name, title, *bin_args)
+    hist.SetDirectory(0)
+    hist.Sumw2()
+    if content is not None:
+        Fill(hist, content, sumw2)
+    return hist
@@ -0,0 +1,105 @@
+# HistCache.py
+
+# On-disk cache of drawn histograms, so that re-running the plotting after a
+# change that doesn't affect the inputs (plotting, node logic) doesn't have
+# to redraw everything from the ntuples. Each histogram is stored in its own
+# ROOT file named by a hash of everything that determines its contents: the
+# identity of the input file (path, size and modification time), the tree
+# name, the variable with its binning, the selection and the backend that
+# drew it, as the backends don't agree to the last bit. The least recently
+# used entries are removed once the cache grows beyond max_size bytes.
+
+import hashlib
+import json
+import os
+import ROOT
+
+# Bump this whenever a change to the drawing code changes its output, so
+# that old entries are no longer used
+_CACHE_VERSION = 1
+
+
+class HistCache(object):
+    def __init__(self, directory, max_size=2 * 1024 ** 3):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # Bytes in the cache, counted on the first Put and then kept up to
+        # date by this process, so that Evict only has to look at the
+        # entries once the cache is full
+        self.size = None
+
+    def Key(self, filename, tree_name, variable, selection, backend):
+        stat = os.stat(filename)
+        identity = [_CACHE_VERSION, os.path.abspath(filename), stat.st_size, stat.st_mtime_ns,
+                    tree_name, variable, selection, backend]
+        return hashlib.sha1(json.dumps(identity).encode()).hexdigest()
+
+    def Path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.root')
+
+    def Get(self, filename, tree_name, variable, selection, backend):
+        """The cached histogram, or None if there isn't one"""
+        path = self.Path(self.Key(filename, tree_name, variable, selection, backend))
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        f = ROOT.TFile(path)
+        hist = f.Get('hist')
+        if not hist:
+            f.Close()
+            self.misses += 1
+            return None
+        hist = hist.Clone()
+        hist.SetDirectory(0)
+        f.Close()
+        # The modification time doubles as the last time the entry was used
+        os.utime(path)
+        self.hits += 1
+        return hist
+
+    def Put(self, filename, tree_name, variable, selection, backend, hist):
+        path = self.Path(self.Key(filename, tree_name, variable, selection, backend))
+        if self.size is None:
+            self.size = sum(x[1] for x in self.Entries())
+        old_size = os.path.getsize(path) if os.path.exists(path) else 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so that concurrent jobs never read a partial file
+        tmp_path = '%s.%i.tmp.root' % (path, os.getpid())
+        f = ROOT.TFile(tmp_path, 'RECREATE')
+        f.WriteTObject(hist, 'hist')
+        f.Close()
+        os.replace(tmp_path, path)
+        self.size += os.path.getsize(path) - old_size
+
+    def Entries(self):
+        """(last use, size, path) of every entry in the cache"""
+        entries = []
+        for sub in os.listdir(self.directory) if os.path.isdir(self.directory) else []:
+            for name in os.listdir(os.path.join(self.directory, sub)):
+                path = os.path.join(self.directory, sub, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def Evict(self):
+        """Remove the least recently used entries until the cache is below
+        max_size. Nothing is done until the writes of this process take the
+        cache over max_size."""
+        if self.size is None or self.size <= self.max_size:
+            return
+        entries = self.Entries()
+        total = sum(x[1] for x in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.size = total
@@ -1,40 +1,33 @@
 # MultiDraw.py
 
 import ROOT
-import re
 import string
 import random
 from array import array
-import numpy as np
 import os
+from Draw.python.Formula import Factorize, ParseVariable, split_vals
+
+# Size of the TTreeCache used when reading the branches of a draw list
+read_cache_size = 30 * 1024 * 1024
 
 file_directory = os.path.dirname(__file__)
 lib_path = os.path.join(os.path.dirname(file_directory), 'lib/libMultiDraw.so')
 ROOT.gSystem.Load(lib_path)
 ROOT.gInterpreter.Declare('''
-        extern void MultiDraw(TTree *inTree,
-            TObjArray *Formulae, TObjArray *Weights, TObjArray *Hists,
-            UInt_t ListLen);
+        extern void MultiDraw(TTree *inTree, TObjArray *Formulae, TObjArray *Factors,
+            const std::vector<unsigned> &FactorIndices,
+            const std::vector<unsigned> &FactorOffsets,
+            TObjArray *Hists, UInt_t ListLen, UInt_t NThreads,
+            Long64_t FirstEntry, Long64_t LastEntry);
+        typedef void (*MultiDrawFillFn)(TTree *tree, TObjArray *Hists,
+            Long64_t first, Long64_t last);
+        extern void MultiDrawKernel(TTree *inTree, TObjArray *Hists,
+            UInt_t NThreads, MultiDrawFillFn Fill, Long64_t FirstEntry, Long64_t LastEntry);
+        extern std::vector<Long64_t> ClusterAlignedRanges(TTree *inTree,
+            Long64_t First, Long64_t Last, UInt_t NRanges);
 ''')
 
 
-def split_vals(vals):
-    """Converts a string '1:3|1,4,5' into a list [1, 2, 3, 4, 5]"""
-    res = set()
-    first = vals.split(',')
-    for f in first:
-        second = re.split('[:|]', f)
-        # print second
-        if len(second) == 1:
-            res.add(float(second[0]))
-        if len(second) == 3:
-            x1 = float(second[0])
-            while x1 < float(second[1]) + 1E-5:
-                res.add(x1)
-                x1 += float(second[2])
-    return sorted([x for x in res])
-
-
 def randomword(length):
     return ''.join(random.choice(string.lowercase) for i in range(length))
 
@@ -56,22 +49,54 @@ def MakeTObjArray(theList, takeOwnership=True):
     return result
 
 
-def GetBinningArgs(arg, is_variable):
-    if is_variable:
-        binning = split_vals(arg)
-        return [len(binning) - 1, array('d', binning)]
-    else:
-        str_binning = [x.strip() for x in arg.split(',')]
-        binning = []
-        if len(str_binning) == 3:
-            step = (float(str_binning[2]) - float(str_binning[1])) / float(str_binning[0])
-            binning = np.arange(float(str_binning[1]), float(str_binning[2]) + step / 2,step)
-            return [len(binning) - 1, array('d',binning)]
-        else:
-            return None
-
-
-def MultiDraw(self, Formulae, Compiled=False):
+def FormulaBranches(formula):
+    """Names of the branches a compiled TTreeFormula reads, including the
+    counter branches of variable length arrays"""
+    branches = set()
+    for i in range(formula.GetNcodes()):
+        leaf = formula.GetLeaf(i)
+        if not leaf:
+            continue
+        branches.add(leaf.GetBranch().GetMother().GetName())
+        if leaf.GetLeafCount():
+            branches.add(leaf.GetLeafCount().GetBranch().GetMother().GetName())
+    return branches
+
+
+def PruneBranches(tree, branches, cache_size=read_cache_size):
+    """Disable every branch of the tree except the given ones, and set up a
+    TTreeCache that prefetches exactly those. Does nothing if the tree has
+    aliases, since we can't tell which branches they need."""
+    if tree.GetListOfAliases():
+        return
+    tree.SetBranchStatus('*', 0)
+    for name in branches:
+        tree.SetBranchStatus(name, 1)
+    tree.SetCacheSize(cache_size)
+    for name in branches:
+        tree.AddBranchToCache(name, True)
+    tree.StopCacheLearningPhase()
+
+
+def ClusterAlignedRanges(tree, n_ranges, first=0, last=None):
+    """Split the entries [first, last) of the tree into at most n_ranges
+    (first, last) ranges that start and end on cluster boundaries"""
+    from ROOT import ClusterAlignedRanges as _ClusterAlignedRanges
+    if last is None:
+        last = tree.GetEntries()
+    bounds = list(_ClusterAlignedRanges(tree, first, last, n_ranges))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def GetBinningArgs(edges):
+    return [len(edges) - 1, array('d', edges)]
+
+
+def MultiDraw(self, Formulae, Compiled=False, Threads=1, EntryRange=None):
+    """Fill a histogram for every variable (or (variable, weight) tuple) in
+    Formulae from a single loop over the tree, or over the entries
+    [first, last) if EntryRange is given"""
+    first, last = EntryRange if EntryRange is not None else (0, -1)
     results, formulae, weights, formulaeStr, weightsStr = [], [], [], [], []
 
     # lastFormula, lastWeight = None, None
@@ -91,58 +116,15 @@ def MultiDraw(self, Formulae, Compiled=False):
         origFormula = split_var[0]
         print("Formula: ", origFormula, weight)
 
-        var_binned_x = False
-        var_binned_y = False
-        var_binned_z = False
-        is_2d = False
-        is_3d = False
-
-        if origFormula[-1] == ')':
-            pos_open = origFormula.rfind('(')
-            pos_close = origFormula.rfind(')')
-        if origFormula[-1] == ']':
-            var_binned_x = True
-            pos_open = origFormula.rfind('[')
-            pos_close = origFormula.rfind(']')
-        if pos_open == -1 or pos_close == -1 or pos_open > pos_close:
-            raise RuntimeError('You bus')
-        bin_args_x = GetBinningArgs(origFormula[pos_open + 1:pos_close], var_binned_x)
-        formula = origFormula[:pos_open].strip()
-
-        # Check if this is a 2D histogram with syntax
-        # [var_y],[var_x][binning_y],[binning_x]
-        if formula[-1] == ',':
-            is_2d = True
-            if formula[-2] == ')':
-                pos_open_y = formula.rfind('(')
-                pos_close_y = formula.rfind(')')
-            if formula[-2] == ']':
-                var_binned_y = True
-                pos_open_y = formula.rfind('[')
-                pos_close_y = formula.rfind(']')
-            if pos_open_y == -1 or pos_close_y == -1 or pos_open_y > pos_close_y:
-                raise RuntimeError('You bus')
-            bin_args_y = GetBinningArgs(formula[pos_open_y + 1:pos_close_y], var_binned_y)
-            formula = origFormula[:pos_open_y].strip()
-            # Check if this is a 3D histogram with syntax
-            # [var_y],[var_x],[var_z][binning_y],[binning_x],[binning_z]
-            if formula[-1] == ',':
-                is_3d = True
-                if formula[-2] == ')':
-                    pos_open_z = formula.rfind('(')
-                    pos_close_z = formula.rfind(')')
-                if formula[-2] == ']':
-                    var_binned_z = True
-                    pos_open_z = formula.rfind('[')
-                    pos_close_z = formula.rfind(']')
-                if pos_open_z == -1 or pos_close_z == -1 or pos_open_z > pos_close_z:
-                    raise RuntimeError('You bus')
-                bin_args_z = GetBinningArgs(formula[pos_open_z + 1:pos_close_z], var_binned_z)
-                formula = formula[:pos_open_z].split(',')
-            else:
-                formula = formula[:pos_open_y].split(',')
-        else:
-            formula = [formula]
+        formula, binnings, _ = ParseVariable(origFormula)
+        is_2d = len(binnings) > 1
+        is_3d = len(binnings) > 2
+        # Binnings are in the order they are written, which is z, y, x
+        bin_args_x = GetBinningArgs(binnings[-1])
+        if is_2d:
+            bin_args_y = GetBinningArgs(binnings[-2])
+        if is_3d:
+            bin_args_z = GetBinningArgs(binnings[-3])
 
         ROOT.TH1.AddDirectory(False)
         if not is_2d and not is_3d:
@@ -168,33 +150,63 @@ def MultiDraw(self, Formulae, Compiled=False):
             results.append(ROOT.TObject())
         results.append(hist)
 
-        # The following two 'if' clauses check that the next formula is different
-        # to the previous one. If it is not, we add an ordinary TObject.
-        # Then, the dynamic cast in MultiDraw.cxx fails, giving 'NULL', and
-        # The previous value is used. This saves the recomputing of identical
-        # values
-
         for form in formula:
-            f = ROOT.TTreeFormula("formula%i" % i, form, self)
-            f.SetTitle(form)
-            if not f.GetTree():
-                raise RuntimeError("TTreeFormula didn't compile: " + form)
-            f.SetQuickLoad(True)
-            formulae.append(f)
             formulaeStr.append(form)
-
-            f = ROOT.TTreeFormula("weight%i" % i, weight, self)
-            f.SetTitle(weight)
-            if not f.GetTree():
-                raise RuntimeError("TTreeFormula didn't compile: " + weight)
-            f.SetQuickLoad(True)
-            weights.append(f)
             weightsStr.append(weight)
 
-    from ROOT import MultiDraw as _MultiDraw
     from time import time
     start = time()
 
+    if Compiled:
+        # Evaluate the whole draw list in one generated C++ function rather
+        # than through TTreeFormula, if everything in it can be translated
+        from Draw.python.CompiledDraw import GetKernel
+        kernel, branches = GetKernel(self, formulaeStr, weightsStr, results)
+        if kernel is not None:
+            PruneBranches(self, branches)
+            kernel(self, MakeTObjArray(results, takeOwnership=False), max(1, int(Threads)), first, last)
+            print("Took %.2fs" % (time() - start), " " * 20)
+            return results
+
+    # The C++ side checks whether a formula has the same title as an earlier
+    # one, and if so reuses the earlier value rather than recomputing it
+    for i, form in enumerate(formulaeStr):
+        f = ROOT.TTreeFormula("formula%i" % i, form, self)
+        f.SetTitle(form)
+        if not f.GetTree():
+            raise RuntimeError("TTreeFormula didn't compile: " + form)
+        f.SetQuickLoad(True)
+        formulae.append(f)
+
+    # Weights are mostly products of the same few factors (wt, sel, os,
+    # category...), so each distinct factor gets one formula, evaluated at
+    # most once per entry, and each weight is a list of factor indices
+    factorsStr, factorIndices = Factorize(weightsStr)
+    for i, factor in enumerate(factorsStr):
+        f = ROOT.TTreeFormula("factor%i" % i, factor, self)
+        f.SetTitle(factor)
+        if not f.GetTree():
+            raise RuntimeError("TTreeFormula didn't compile: " + factor)
+        f.SetQuickLoad(True)
+        weights.append(f)
+    flatIndices = ROOT.std.vector('unsigned int')()
+    offsets = ROOT.std.vector('unsigned int')()
+    offsets.push_back(0)
+    for idx in factorIndices:
+        for f in idx:
+            flatIndices.push_back(f)
+        offsets.push_back(flatIndices.size())
+    print("Evaluating %i distinct weight factors for %i weights" % (len(factorsStr), len(set(weightsStr))))
+
+    # Only read what the formulae need. Worker threads copy the branch
+    # status and cache settings of this tree
+    branches = set()
+    for formula in formulae + weights:
+        branches |= FormulaBranches(formula)
+    PruneBranches(self, branches)
+
+    from ROOT import MultiDraw as _MultiDraw
+
     # Ensure that formulae are told when tree changes
     fManager = ROOT.TTreeFormulaManager()
     for formula in formulae + weights:
@@ -204,12 +216,19 @@ def MultiDraw(self, Formulae, Compiled=False):
     fManager.Sync()
     self.SetNotify(fManager)
 
-    # Draw everything!
+    # Draw everything! With Threads > 1 the entries are split into
+    # cluster-aligned ranges, each filled by its own thread into private
+    # histogram copies that are summed into results at the end
     _MultiDraw(self,
                MakeTObjArray(formulae),
                MakeTObjArray(weights),
+               flatIndices,
+               offsets,
                MakeTObjArray(results, takeOwnership=False),
-               len(formulae))
+               len(formulae),
+               max(1, int(Threads)),
+               first,
+               last)
 
     print("Took %.2fs" % (time() - start), " " * 20)
     return results
@@ -0,0 +1,101 @@
+# Rebinning.py
+
+# Rebinning of 1D histograms. FindRebinningArrays works on plain arrays of
+# the bin edges, contents and sums of squared weights (without the flow
+# bins), FindRebinning is the version taking a histogram that is used by
+# HiggsTauTauPlot and by the ip_corrections scripts. RebinMap maps the bins
+# of a histogram onto a new binning, once for all histograms sharing the
+# original binning. Only the functions taking histograms need ROOT.
+
+import math
+import numpy as np
+
+_rebin_maps = {}
+
+
+def FindRebinningArrays(edges, content, sumw2, BinThreshold=100, BinUncertFraction=0.5):
+    """Merge neighbouring bins until none has both a relative uncertainty
+    above BinUncertFraction (or a content that is not positive) and a
+    content below BinThreshold. Empty bins at both ends are dropped first,
+    then bins are merged into the next one from left to right, and then
+    into the previous one from right to left. As in the original iterative
+    version the last bin is never merged into the next one, nor the first
+    one into the previous one. Every bin is visited once per direction, as
+    merging a bin never changes the bins already passed.
+    Returns the new edges, contents and sums of squared weights."""
+    edges = [float(x) for x in edges]
+    content = np.asarray(content, dtype=np.float64)
+    sumw2 = np.asarray(sumw2, dtype=np.float64)
+    n = len(content)
+
+    def Bad(group):
+        c, s = group[0], group[1]
+        uncert_frac = math.sqrt(s) / c if c > 0 else BinUncertFraction + 1
+        return uncert_frac > BinUncertFraction and c < BinThreshold
+
+    def Merge(left, right):
+        return (left[0] + right[0], left[1] + right[1], left[2], right[3])
+
+    # remove outer bins with zero content and error
+    empty = (content == 0) & (sumw2 == 0)
+    first, last = 0, n
+    while first < n - 1 and empty[first]:
+        first += 1
+    while last - first > 1 and empty[last - 1]:
+        last -= 1
+
+    # left to right, each group is (content, sumw2, first edge, last edge)
+    groups = []
+    current = None
+    for j in range(first, last):
+        group = (content[j], sumw2[j], j, j + 1)
+        current = group if current is None else Merge(current, group)
+        if j == last - 1 or not Bad(current):
+            groups.append(current)
+            current = None
+
+    # right to left
+    merged = []
+    current = groups[-1]
+    for group in reversed(groups[:-1]):
+        if Bad(current):
+            current = Merge(group, current)
+        else:
+            merged.append(current)
+            current = group
+    merged.append(current)
+    merged.reverse()
+
+    new_edges = [edges[g[2]] for g in merged] + [edges[merged[-1][3]]]
+    return new_edges, np.array([g[0] for g in merged]), np.array([g[1] for g in merged])
+
+
+def FindRebinning(hist, BinThreshold=100, BinUncertFraction=0.5):
+    """Bin edges for hist found by FindRebinningArrays"""
+    from Draw.python import HistArrays
+    nbins = hist.GetNbinsX()
+    edges = [hist.GetBinLowEdge(i) for i in range(1, nbins + 2)]
+    content = HistArrays.Content(hist)[1:nbins + 1]
+    sumw2 = HistArrays.Errors(hist)[1:nbins + 1] ** 2
+    binning, _, _ = FindRebinningArrays(edges, content, sumw2, BinThreshold, BinUncertFraction)
+    return binning
+
+
+def RebinMap(hist, binning):
+    """The bins of hist (1 to nbins) that go into the histogram with the new
+    bin edges binning, and the bins they go to. A bin goes to the new bin
+    its centre is strictly inside of, with the edges as the float values
+    RebinHist gives to TH1D, and nowhere if there is none."""
+    from Draw.python import HistArrays
+    axis = hist.GetXaxis()
+    key = (axis.GetNbins(), axis.GetXmin(), axis.GetXmax(),
+           HistArrays.AxisEdges(axis).tobytes(), tuple(binning))
+    if key not in _rebin_maps:
+        edges = np.array(binning, dtype=np.float32).astype(np.float64)
+        centers = HistArrays.AxisCenters(axis)
+        new_bins = np.searchsorted(edges, centers, side='right')
+        inside = (new_bins >= 1) & (new_bins < len(edges))
+        inside[inside] &= edges[new_bins[inside] - 1] != centers[inside]
+        old_bins = np.flatnonzero(inside) + 1
+        _rebin_maps[key] = (old_bins, new_bins[inside])
+    return _rebin_maps[key]
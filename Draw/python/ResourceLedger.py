@@ -0,0 +1,92 @@
+# ResourceLedger.py
+
+# Ledger of the resources used by HiggsTauTauPlot.py jobs, from which
+# makeDatacards.py sizes the condor requests of their next runs. Each job
+# appends one line of JSON with its name, wall time, peak memory, and the
+# numbers of events it read and histograms it filled. The processes the job
+# forks to draw in parallel share its pages they don't write to, and condor
+# counts the memory of all of them, so max_rss_mb, which the requests are
+# sized from, is the peak of the job plus the number of workers times the
+# largest private memory of a drawing process.
+# A single short line appended in one write doesn't interleave with those of
+# other jobs, so jobs running at the same time can share a ledger.
+
+from collections import defaultdict
+import json
+import math
+import os
+import resource
+import socket
+import time
+
+
+def PeakMemoryMB():
+    """Peak resident memory of this process in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def PrivateMemoryMB():
+    """Memory of this process not shared with any other in MB, which for a
+    forked worker is what it allocated or wrote to since the fork. The peak
+    resident memory is returned where /proc/self/smaps_rollup is missing."""
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            return sum(int(line.split()[1]) for line in f if line.startswith('Private_')) / 1024.
+    except (IOError, OSError):
+        return PeakMemoryMB()
+
+
+def Record(path, job, **values):
+    """Append an entry for job with the given values to the ledger"""
+    entry = dict(values, job=job, host=socket.gethostname(), time=time.time())
+    line = json.dumps(entry, sort_keys=True) + '\n'
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode())
+    finally:
+        os.close(fd)
+
+
+def Load(path):
+    """The entries of the ledger by job name, oldest first"""
+    entries = defaultdict(list)
+    if not os.path.exists(path):
+        return entries
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Cut short by a job killed while writing it
+                continue
+            entries[entry['job']].append(entry)
+    return entries
+
+
+def Predict(entries, n_last=3, memory_margin=1.3, runtime_margin=1.5):
+    """(memory in MB, runtime in s) to request for a job from the largest of
+    its last n_last entries with some margin, or None if it never ran. Both
+    are rounded up, so that the requests don't change with every run."""
+    if not entries:
+        return None
+    last = entries[-n_last:]
+    memory = max(1000., max(x['max_rss_mb'] for x in last) * memory_margin)
+    runtime = max(600., max(x['wall_time'] for x in last) * runtime_margin)
+    return int(math.ceil(memory / 500.) * 500), int(math.ceil(runtime / 600.) * 600)
+
+
+def Pack(runtimes, max_runtime):
+    """Group the jobs in runtimes, a dict of job -> runtime, into packs whose
+    runtimes add up to at most max_runtime, first fit, longest first"""
+    packs = []
+    totals = []
+    for job in sorted(runtimes, key=lambda x: runtimes[x], reverse=True):
+        for i, total in enumerate(totals):
+            if total + runtimes[job] <= max_runtime:
+                packs[i].append(job)
+                totals[i] += runtimes[job]
+                break
+        else:
+            packs.append([job])
+            totals.append(runtimes[job])
+    return packs
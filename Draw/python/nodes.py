@@ -103,29 +103,31 @@ def GetVVJNode(ana, add_name ='', samples=[], plot='', wt='', sel='', cat='', vv
 def GetSubtractNode(ana, add_name, plot, plot_unmodified, wt, sel, cat_name, categories, categories_unmodified, method, qcd_factor, get_os, samples_dict, gen_sels_dict, includeW=False, w_shift=None):
     cat = categories[cat_name]
     cat_data = categories_unmodified[cat_name]
-    subtract_node = Analysis.SummedNode('total_bkg'+add_name)
+    # The same subtraction is asked for by several estimates, so the node is
+    # shared between all calls with the same components
+    subtract_nodes = []
     if includeW:
         w_wt = wt
         w_node = GetWNode(ana, "", samples_dict['wjets_samples'], plot, wt, sel, cat, "", get_os)
-        subtract_node.AddNode(w_node)
+        subtract_nodes.append(w_node)
     ttt_node = GetTTTNode(ana, "", samples_dict['top_samples'], plot, wt, sel, cat, gen_sels_dict['top_sels'], get_os)
     ttj_node = GetTTJNode(ana, "", samples_dict['top_samples'], plot, wt, sel, cat, gen_sels_dict['top_sels'], get_os)
     vvt_node = GetVVTNode(ana, "", samples_dict['vv_samples'], plot, wt, sel, cat, gen_sels_dict['vv_sels'], get_os)
     vvj_node = GetVVJNode(ana, "", samples_dict['vv_samples'], plot, wt, sel, cat, gen_sels_dict['vv_sels'], get_os)
-    subtract_node.AddNode(ttt_node)
-    subtract_node.AddNode(ttj_node)
-    subtract_node.AddNode(vvt_node)
-    subtract_node.AddNode(vvj_node)
+    subtract_nodes.append(ttt_node)
+    subtract_nodes.append(ttj_node)
+    subtract_nodes.append(vvt_node)
+    subtract_nodes.append(vvj_node)
 
     ztt_node = GetZTTNode(ana, "", samples_dict['ztt_samples'], plot, wt, sel, cat, gen_sels_dict['z_sels'], get_os)
-    subtract_node.AddNode(ztt_node)
+    subtract_nodes.append(ztt_node)
 
     zl_node = GetZLNode(ana, "", samples_dict['ztt_samples']+samples_dict["zll_samples"], plot, wt, sel, cat, gen_sels_dict['z_sels'], get_os)
     zj_node = GetZJNode(ana, "", samples_dict['ztt_samples']+samples_dict["zll_samples"], plot, wt, sel, cat, gen_sels_dict['z_sels'], get_os)
-    subtract_node.AddNode(zl_node)
-    subtract_node.AddNode(zj_node)
+    subtract_nodes.append(zl_node)
+    subtract_nodes.append(zj_node)
 
-    return subtract_node
+    return ana.SummedNodeFactory('total_bkg'+add_name, subtract_nodes)
 
 def GetFakeFractionNode(ana, add_name, plot, plot_unmodified, wt, sel, cat_name, categories, categories_unmodified, method, qcd_factor, get_os, samples_dict, gen_sels_dict):
     if get_os:
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from Draw.python.ColumnarDraw import Evaluate, FillChunk, ParseDrawList, Translate, _div
+
+
+def test_div_by_zero_is_zero():
+    np.testing.assert_array_equal(_div([1., 2., 3.], [2., 0., -1.]), [0.5, 0., -3.])
+
+
+@pytest.mark.parametrize('expr, expected', [
+    ('a+b*2', [3., 6., 9.]),
+    ('a/(b-2)', [-1., 0., 3.]),
+    ('(a>1 && b<3) || !c', [0., 1., 0.]),
+    ('a>1 ? b : -b', [-1., 2., 3.]),
+    ('abs(-a) + TMath::Max(a, b)', [2., 4., 6.]),
+    ('pow(a, 2) - sqrt(b*b)', [0., 2., 6.]),
+    ('c % 2 + (c << 1)', [3., 0., 7.]),
+])
+def test_evaluate(expr, expected):
+    columns = {'a': np.array([1., 2., 3.]), 'b': np.array([1., 2., 3.]), 'c': np.array([1., 0., 3.])}
+    np.testing.assert_allclose(Evaluate(expr, columns, 3), expected)
+
+
+def test_translate_branches():
+    _, branches = Translate('(pt_1>20)*wt*TMath::Pi()*cos(phi)')
+    assert branches == {'pt_1', 'wt', 'phi'}
+
+
+@pytest.mark.parametrize('expr', ['a[0]', 'a.b', 'Unknown(a)', 'a+', '(a'])
+def test_translate_unsupported(expr):
+    with pytest.raises(ValueError):
+        Translate(expr)
+
+
+def test_fill_1d_matches_histogram():
+    rng = np.random.default_rng(1)
+    x = rng.normal(50., 30., 1000)
+    wt = rng.uniform(0.5, 1.5, 1000)
+    hist, = FillChunk(ParseDrawList([('x(10,0,100)', 'wt')]), {'x': x, 'wt': wt}, 1000)
+    edges = np.arange(0., 101., 10.)
+    sumw, _ = np.histogram(x, edges, weights=wt)
+    sumw2, _ = np.histogram(x, edges, weights=wt ** 2)
+    np.testing.assert_allclose(hist.sumw[1:-1], sumw)
+    np.testing.assert_allclose(hist.sumw2[1:-1], sumw2)
+    np.testing.assert_allclose(hist.sumw[0], wt[x < 0].sum())
+    np.testing.assert_allclose(hist.sumw[-1], wt[x >= 100].sum())
+
+
+def test_fill_2d_matches_histogram():
+    rng = np.random.default_rng(2)
+    x, y = rng.uniform(-1., 11., (2, 1000))
+    hist, = FillChunk(ParseDrawList(['y,x[0,5,10],[0,2,4,10]']), {'x': x, 'y': y}, 1000)
+    sumw, _, _ = np.histogram2d(x, y, [[0, 2, 4, 10], [0, 5, 10]])
+    # Global bins run over x first, with a flow bin on each side of each axis
+    np.testing.assert_allclose(hist.sumw.reshape(4, 5)[1:-1, 1:-1], sumw.T)
+    assert hist.sumw.sum() == 1000
+
+
+def test_fill_edges_follow_root():
+    # As with TAxis::FindBin, the lower edge is inclusive and a value on the
+    # upper edge of the last bin goes into the overflow
+    hist, = FillChunk(ParseDrawList(['x[0,1,2]']), {'x': np.array([0., 1., 2.])}, 3)
+    np.testing.assert_array_equal(hist.sumw, [0., 1., 1., 1.])
+
+
+def test_fill_skips_zero_weights():
+    hist, = FillChunk(ParseDrawList([('x[0,1]', 'x>0.5')]), {'x': np.array([0.2, 0.7, 0.9])}, 3)
+    assert hist.entries == 2
+    np.testing.assert_array_equal(hist.sumw, [0., 2., 0.])
@@ -0,0 +1,43 @@
+from array import array
+
+import pytest
+
+ROOT = pytest.importorskip('ROOT')
+
+from Draw.python.CompiledDraw import ToCpp
+
+# The branch buffers have to outlive the tree
+_buffers = [array('d', [0.]), array('i', [0]), array('f', [0., 0.])]
+
+
+@pytest.fixture(scope='module')
+def tree():
+    tree = ROOT.TTree('test_compiled_draw', '')
+    tree.Branch('pt_1', _buffers[0], 'pt_1/D')
+    tree.Branch('n', _buffers[1], 'n/I')
+    tree.Branch('arr', _buffers[2], 'arr[2]/F')
+    return tree
+
+
+@pytest.mark.parametrize('expr, expected', [
+    ('pt_1/n', 'tf_div(pt_1, n)'),
+    ('(pt_1>20)*n/(pt_1-1)', 'tf_div((((pt_1 > 20.)) * n), ((pt_1 - 1.)))'),
+    ('abs(pt_1)*TMath::Pi()', '(TMath::Abs(pt_1) * TMath::Pi())'),
+    ('n>1 ? pt_1 : -pt_1', '((n > 1.) ? pt_1 : (-pt_1))'),
+])
+def test_to_cpp(tree, expr, expected):
+    branches = {}
+    assert ToCpp(expr, tree, branches) == expected
+    assert set(branches) <= {'pt_1', 'n'}
+
+
+def test_to_cpp_branches(tree):
+    branches = {}
+    ToCpp('pt_1*(n>0)', tree, branches)
+    assert branches == {'pt_1': 'Double_t', 'n': 'Int_t'}
+
+
+@pytest.mark.parametrize('expr', ['n%2', 'n^2', 'n<<1', 'arr', 'missing', 'foo(pt_1)', 'n[0]', 'pt_1+'])
+def test_to_cpp_unsupported(tree, expr):
+    with pytest.raises(ValueError):
+        ToCpp(expr, tree, {})
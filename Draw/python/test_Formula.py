@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from Draw.python.Formula import Factorize, ParseVariable, SplitProduct, StripParens
+
+
+def test_split_product():
+    assert SplitProduct("((wt))* (os)* (a*b)") == ["wt", "os", "a", "b"]
+    assert SplitProduct("a*b[0]") == ["a", "b[0]"]
+    assert SplitProduct("a*(b+c)") == ["a", "b+c"]
+
+
+def test_split_product_keeps_non_products_whole():
+    for expr in ["a+b", "(a*b)/c", "a*b>1", "x?a*b:c"]:
+        assert SplitProduct(expr) == [StripParens(expr)]
+
+
+def test_factorize():
+    factors, indices = Factorize([
+        "wt*(os)*(iso_1<0.15)", "wt*(os)", "1", "(1)*wt"])
+    # Boolean factors come first, factors of 1 are dropped and shared
+    # factors are only listed once
+    assert factors == ["iso_1<0.15", "wt", "os"]
+    assert indices == [[0, 1, 2], [1, 2], [], [1]]
+
+
+def test_parse_variable_1d():
+    exprs, binnings, titles = ParseVariable("m_vis(4,0,100)")
+    assert exprs == ["m_vis"]
+    np.testing.assert_allclose(binnings[0], [0, 25, 50, 75, 100])
+    assert titles == []
+
+
+def test_parse_variable_2d():
+    exprs, binnings, titles = ParseVariable("pt_2,pt_1[0,20,40],[0,50,100];p_{T};Events")
+    # In order of appearance, so the x axis comes last
+    assert exprs == ["pt_2", "pt_1"]
+    assert binnings == [[0, 20, 40], [0, 50, 100]]
+    assert titles == ["p_{T}", "Events"]
+
+
+def test_parse_variable_without_binning():
+    with pytest.raises(ValueError):
+        ParseVariable("m_vis")
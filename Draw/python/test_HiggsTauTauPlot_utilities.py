@@ -0,0 +1,43 @@
+import pytest
+
+pytest.importorskip('ROOT')
+pytest.importorskip('uncertainties')
+
+from Draw.python.HiggsTauTauPlot_utilities import UnrollMap2D, UnrollMap3D
+
+
+def Unrolled(src, dst):
+    return dict(zip(dst.tolist(), src.tolist()))
+
+
+@pytest.mark.parametrize('inc_y_of', [True, False])
+@pytest.mark.parametrize('Nx, Ny', [(1, 1), (3, 2), (4, 5)])
+def test_unroll_map_2d(Nx, Ny, inc_y_of):
+    # The loops of the original UnrollHist2D, with global bins as in TH1::GetBin
+    n = 1 if inc_y_of else 0
+    expected = {}
+    for i in range(1, Nx + 1):
+        for j in range(1, Ny + 1 + n):
+            expected[(j - 1) * Nx + i - 1 + 1] = j * (Nx + 2) + i
+    src, dst, Nbins = UnrollMap2D(Nx, Ny, inc_y_of)
+    assert Unrolled(src, dst) == expected
+    assert Nbins == (Ny + n) * Nx
+
+
+@pytest.mark.parametrize('inc_y_of, inc_z_of', [(False, True), (True, True), (False, False), (True, False)])
+@pytest.mark.parametrize('Nx, Ny, Nz', [(1, 1, 1), (3, 2, 4), (2, 5, 3)])
+def test_unroll_map_3d(Nx, Ny, Nz, inc_y_of, inc_z_of):
+    # The loops of the original UnrollHist3D. With the y over-flow some bins
+    # are written more than once and the last write counts
+    ny = 1 if inc_y_of else 0
+    nz = 1 if inc_z_of else 0
+    expected = {}
+    for i in range(1, Nx + 1):
+        for j in range(1, Ny + 1 + ny):
+            for k in range(1, Nz + 1 + nz):
+                glob_bin = (k - 1) * Nx * Ny + (j - 1) * Nx + i - 1
+                expected[glob_bin + 1] = (k * (Ny + 2) + j) * (Nx + 2) + i
+    src, dst, Nbins = UnrollMap3D(Nx, Ny, Nz, inc_y_of, inc_z_of)
+    assert len(dst) == len(set(dst.tolist()))
+    assert Unrolled(src, dst) == expected
+    assert Nbins == (Nz + nz) * (Ny + ny) * Nx
@@ -0,0 +1,95 @@
+import math
+
+import numpy as np
+import pytest
+
+from Draw.python.Rebinning import FindRebinningArrays, RebinMap
+
+
+def IterativeRebinning(edges, content, sumw2, BinThreshold, BinUncertFraction):
+    """The original FindRebinning, restarting after every merge, written
+    for lists of bins instead of histograms"""
+    bins = [[c, s, lo, hi] for c, s, lo, hi in zip(content, sumw2, edges[:-1], edges[1:])]
+
+    def Bad(b):
+        uncert_frac = math.sqrt(b[1]) / b[0] if b[0] > 0 else BinUncertFraction + 1
+        return uncert_frac > BinUncertFraction and b[0] < BinThreshold
+
+    def Merge(i):
+        left, right = bins[i], bins.pop(i + 1)
+        bins[i] = [left[0] + right[0], left[1] + right[1], left[2], right[3]]
+
+    def Empty(b):
+        return b[0] == 0 and b[1] == 0
+
+    for _ in range(len(bins) - 1):
+        if not Empty(bins[0]):
+            break
+        bins.pop(0)
+    while len(bins) > 1 and Empty(bins[-1]):
+        bins.pop()
+
+    finished = False
+    while not finished and len(bins) > 1:
+        for i in range(len(bins) - 1):
+            if Bad(bins[i]):
+                Merge(i)
+                break
+            elif i + 2 == len(bins):
+                finished = True
+
+    finished = False
+    while not finished and len(bins) > 1:
+        for i in reversed(range(1, len(bins))):
+            if Bad(bins[i]):
+                Merge(i - 1)
+                break
+            elif i == 1:
+                finished = True
+
+    return [b[2] for b in bins] + [bins[-1][3]], [b[0] for b in bins], [b[1] for b in bins]
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_matches_iterative(seed):
+    rng = np.random.default_rng(seed)
+    n = rng.integers(1, 40)
+    edges = np.cumsum(np.concatenate([[0.], rng.integers(1, 5, n)])).tolist()
+    counts = rng.poisson(rng.uniform(0., 20.), n) * (rng.uniform(size=n) > 0.2)
+    weight = rng.uniform(0.1, 3.)
+    content, sumw2 = counts * weight, counts * weight ** 2
+    threshold = rng.uniform(0., 100.)
+    fraction = rng.uniform(0.05, 0.6)
+    new_edges, new_content, new_sumw2 = FindRebinningArrays(edges, content, sumw2, threshold, fraction)
+    ref_edges, ref_content, ref_sumw2 = IterativeRebinning(edges, content, sumw2, threshold, fraction)
+    assert new_edges == ref_edges
+    np.testing.assert_allclose(new_content, ref_content)
+    np.testing.assert_allclose(new_sumw2, ref_sumw2)
+
+
+def test_drops_outer_empty_bins():
+    edges, content, _ = FindRebinningArrays(range(7), [0, 0, 500, 0, 400, 0], [0, 0, 500, 0, 400, 0])
+    assert edges == [2, 3, 5]
+    np.testing.assert_array_equal(content, [500, 400])
+
+
+def test_all_empty():
+    edges, content, _ = FindRebinningArrays(range(4), [0, 0, 0], [0, 0, 0])
+    assert edges == [2, 3]
+    np.testing.assert_array_equal(content, [0])
+
+
+@pytest.mark.parametrize('binning', [[0., 2., 5., 10.], [1., 3.3, 7.], [-5., 0.5, 20.], [2., 3.]])
+def test_rebin_map(binning):
+    ROOT = pytest.importorskip('ROOT')
+    from array import array
+    hist = ROOT.TH1D('test_rebin_map', '', 10, 0., 10.)
+    hout = ROOT.TH1D('test_rebin_map_out', '', len(binning) - 1, array('f', binning))
+    # The nested loops of the original RebinHist
+    expected = []
+    for j in range(1, hist.GetNbinsX() + 1):
+        for i in range(1, hout.GetNbinsX() + 1):
+            if hout.GetBinLowEdge(i) < hist.GetBinCenter(j) < hout.GetBinLowEdge(i + 1):
+                expected.append((j, i))
+    old_bins, new_bins = RebinMap(hist, binning)
+    assert list(zip(old_bins, new_bins)) == expected
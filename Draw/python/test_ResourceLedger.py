@@ -0,0 +1,48 @@
+import json
+
+from Draw.python import ResourceLedger
+
+
+def test_record_and_load(tmp_path):
+    path = str(tmp_path / 'ledger.jsonl')
+    ResourceLedger.Record(path, 'tt_2022', max_rss_mb=1200., wall_time=100.)
+    ResourceLedger.Record(path, 'mt_2022', max_rss_mb=800., wall_time=50.)
+    ResourceLedger.Record(path, 'tt_2022', max_rss_mb=1500., wall_time=200.)
+    entries = ResourceLedger.Load(path)
+    assert sorted(entries) == ['mt_2022', 'tt_2022']
+    assert [x['max_rss_mb'] for x in entries['tt_2022']] == [1200., 1500.]
+
+
+def test_load_skips_cut_off_line(tmp_path):
+    path = tmp_path / 'ledger.jsonl'
+    entry = json.dumps({'job': 'tt_2022', 'max_rss_mb': 1200., 'wall_time': 100.})
+    path.write_text(entry + '\n' + entry[:20])
+    assert len(ResourceLedger.Load(str(path))['tt_2022']) == 1
+
+
+def test_load_missing_ledger(tmp_path):
+    assert ResourceLedger.Load(str(tmp_path / 'missing.jsonl')) == {}
+
+
+def test_predict():
+    assert ResourceLedger.Predict([]) is None
+    entries = [{'max_rss_mb': 5000., 'wall_time': 8000.}] + [{'max_rss_mb': 2000., 'wall_time': 1000.}] * 3
+    # Only the last 3 entries count, rounded up to 500 MB and 600 s
+    assert ResourceLedger.Predict(entries) == (3000, 1800)
+    # With at least 1000 MB and 600 s
+    assert ResourceLedger.Predict([{'max_rss_mb': 10., 'wall_time': 1.}]) == (1000, 600)
+
+
+def test_pack():
+    runtimes = {'a': 300, 'b': 700, 'c': 500, 'd': 200, 'e': 1500}
+    packs = ResourceLedger.Pack(runtimes, 1000)
+    assert packs == [['e'], ['b', 'a'], ['c', 'd']]
+    assert sorted(sum(packs, [])) == sorted(runtimes)
+
+
+def test_private_memory():
+    before = ResourceLedger.PrivateMemoryMB()
+    # written to, so that the pages are actually allocated
+    buffer = bytearray(b'x' * 50 * 1024 ** 2)
+    assert ResourceLedger.PrivateMemoryMB() - before > 40.
+    del buffer
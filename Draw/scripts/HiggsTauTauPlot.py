@@ -11,11 +11,16 @@ import argparse
 from collections import OrderedDict
 from prettytable import PrettyTable
 import copy
+import json
 import numpy as np
 import ROOT
 import re
+import time
 from Draw.python import Analysis
 from Draw.python import Plotting
+from Draw.python import HistCache
+from Draw.python import ResourceLedger
+from Draw.python.Formula import ParseVariable
 from Draw.python.nodes import (
     BuildCutString,
     GenerateZTT,
@@ -33,7 +38,7 @@ from Draw.python.HiggsTauTauPlot_utilities import (
     FixBins,
     FindRebinning,
     RebinHist,
-    UnrollHist2D,
+    UnrollDirectory,
     RenameDatacards,
     Total_Uncertainty
 )
@@ -42,6 +47,8 @@ from Draw.python.PlotHistograms import HTT_Histogram
 
 ROOT.TH1.SetDefaultSumw2(True)
 
+start_time = time.time()
+
 parser = argparse.ArgumentParser()
 # ------------------------------------------------------------------------------------------------------------------------
 # Main Options:
@@ -129,12 +136,71 @@ parser.add_argument("--nodename", help="Override the nodename")
 parser.add_argument(
     "--auto_rebin", action="store_true", help="Automatically rebin histograms"
 )
+parser.add_argument(
+    "--threads", type=int, default=1, help="Number of threads used to fill the histograms of each sample"
+)
+parser.add_argument(
+    "--compiled", action="store_true", help="Evaluate variables and weights with compiled C++ kernels instead of TTreeFormula"
+)
+parser.add_argument(
+    "--workers", type=int, default=1, help="Number of processes drawing samples in parallel"
+)
+parser.add_argument(
+    "--shards", type=int, default=1, help="Number of entry ranges each sample is split into, drawn separately by the workers"
+)
+parser.add_argument(
+    "--hist_cache", default="", help="Directory of a cache of drawn histograms, looked up before drawing from the ntuples and filled with what is drawn (no cache by default)"
+)
+parser.add_argument(
+    "--hist_cache_size", type=float, default=2, help="Size in GB above which the least recently used histograms are removed from the --hist_cache"
+)
+parser.add_argument(
+    "--max_pass_memory", type=float, default=2000, help="Memory budget in MB for the histograms drawn in one pass over the input trees"
+)
+parser.add_argument(
+    "--write_subnodes", action="store_true", help="Also write the .subnodes directories holding the inputs of each estimate"
+)
+parser.add_argument(
+    "--targets", default=None, help="Comma separated patterns of the output histograms to make, e.g. 'JetFakes*'. Only the histograms these need are drawn (default: all)"
+)
+parser.add_argument(
+    "--backend", default="root", choices=["root", "columnar"], help="Fill histograms with MultiDraw (root) or with uproot and numpy (columnar)"
+)
+parser.add_argument(
+    "--resource_ledger", default=None, help="Append the wall time, peak memory, events read and histograms filled by this job to this ledger (see ResourceLedger)"
+)
+parser.add_argument(
+    "--job_name", default=None, help="Name of this job in the resource ledger (default: the first output file)"
+)
+parser.add_argument(
+    "--jobs", default=None, help="JSON file with a list of datacards to make together, each a dict of the per-datacard options (see job_options) that differ from the command line. The trees are read once per pass for all of them"
+)
 
 # ------------------------------------------------------------------------------------------------------------------------
 args = parser.parse_args()
 
 masses = args.masses.split(",")
 
+# Options that can differ between the datacards of a --jobs file, everything
+# else (samples, systematics, method, ...) is shared by all of them
+job_options = [
+    "var", "category", "sel", "set_alias", "add_weight", "datacard_name", "nodename",
+    "blind", "auto_rebin", "do_unrolling", "rename_procs",
+]
+if args.jobs:
+    with open(args.jobs) as f:
+        job_list = json.load(f)
+    jobs = []
+    for options in job_list:
+        unknown = set(options) - set(job_options)
+        if unknown:
+            raise ValueError(
+                "Options {} can't be set per datacard, only {}".format(sorted(unknown), job_options)
+            )
+        jobs.append(argparse.Namespace(**dict(vars(args), **options)))
+else:
+    jobs = [args]
+
 available_channels = ["ee", "mm", "em", "mt", "et", "tt"]
 
 if args.channel not in available_channels:
@@ -163,6 +229,17 @@ table.add_row(["Blind", args.blind])
 table.add_row(["Masses", args.masses])
 table.add_row(["Datacard Name", args.datacard_name])
 table.add_row(["Auto Rebin", args.auto_rebin])
+table.add_row(["Threads", args.threads])
+table.add_row(["Workers", args.workers])
+table.add_row(["Shards", args.shards])
+table.add_row(["Histogram Cache", args.hist_cache])
+table.add_row(["Compiled", args.compiled])
+table.add_row(["Backend", args.backend])
+table.add_row(["Max Pass Memory (MB)", args.max_pass_memory])
+table.add_row(["Write Subnodes", args.write_subnodes])
+table.add_row(["Targets", args.targets if args.targets else "all"])
+table.add_row(["Resource Ledger", args.resource_ledger])
+table.add_row(["Jobs", f"{len(jobs)} from {args.jobs}" if args.jobs else 1])
 
 method = int(args.method)
 
@@ -448,40 +525,47 @@ elif args.channel == "et":
             categories[f'aminus_e_a1_{obj}_{opt}'] = f"(alphaAngle_e_a1_FASTMTT_MassConstraint_{obj} {opt_cut} {np.pi/4} && ({categories['tau_ea1']}))"
 
 
-# if args.set_alias is not None then overwrite the categories with the selection provided
-
-if args.set_alias is not None:
-    for i in args.set_alias:
-        cat_to_overwrite = i.split(":")[0]
-        cat_to_overwrite = cat_to_overwrite.replace('"', "")
-        overwrite_with = i.split(":")[1]
-        overwrite_with = overwrite_with.replace('"', "")
-        start_index = overwrite_with.find("{")
-        end_index = overwrite_with.find("}")
-        while start_index > 0:
-            replace_with = overwrite_with[start_index : end_index + 1]
-            replace_with = replace_with.replace("{", "")
-            replace_with = replace_with.replace("}", "")
-            replace_string = categories[replace_with]
-            overwrite_with = (
-                overwrite_with[0:start_index]
-                + replace_string
-                + overwrite_with[end_index + 1 :]
-            )
+# The categories of each datacard are a copy of these, in which set_alias
+# overwrites the categories (or the additional selection) it names
+
+
+def ApplyAliases(job):
+    """Set job.categories to the categories with the set_alias options of
+    job applied, which may also overwrite job.sel"""
+    job.categories = copy.deepcopy(categories)
+    if job.set_alias is not None:
+        for i in job.set_alias:
+            cat_to_overwrite = i.split(":")[0]
+            cat_to_overwrite = cat_to_overwrite.replace('"', "")
+            overwrite_with = i.split(":")[1]
+            overwrite_with = overwrite_with.replace('"', "")
             start_index = overwrite_with.find("{")
             end_index = overwrite_with.find("}")
+            while start_index > 0:
+                replace_with = overwrite_with[start_index : end_index + 1]
+                replace_with = replace_with.replace("{", "")
+                replace_with = replace_with.replace("}", "")
+                replace_string = job.categories[replace_with]
+                overwrite_with = (
+                    overwrite_with[0:start_index]
+                    + replace_string
+                    + overwrite_with[end_index + 1 :]
+                )
+                start_index = overwrite_with.find("{")
+                end_index = overwrite_with.find("}")
+
+            print(
+                'Overwriting alias: "'
+                + cat_to_overwrite
+                + '" with selection: "'
+                + overwrite_with
+                + '"'
+            )
+            if cat_to_overwrite == "sel":
+                job.sel = overwrite_with
+            else:
+                job.categories[cat_to_overwrite] = overwrite_with
 
-        print(
-            'Overwriting alias: "'
-            + cat_to_overwrite
-            + '" with selection: "'
-            + overwrite_with
-            + '"'
-        )
-        if cat_to_overwrite == "sel":
-            args.sel = overwrite_with
-        else:
-            categories[cat_to_overwrite] = overwrite_with
 
 # ------------------------------------------------------------------------------------------------------------------------
 # Define the samples (Data and MC (Background & Signal))
@@ -848,6 +932,7 @@ def RunPlotting(
     qcd_factor=1.0,
     method=1,
     nodes_to_skip=[],
+    var="",
 ):
     """
     RunPlotting handles how each process is added to the analysis
@@ -864,6 +949,7 @@ def RunPlotting(
     wt: weight to be applied
     do_data: boolean to decide if data should be added
     qcd_factor: factor to be applied to QCD
+    var: the variable of the datacard, as given by --var
     """
 
     cat = categories["cat"]
@@ -990,7 +1076,7 @@ def RunPlotting(
             get_os=not args.do_ss,
         )
     elif "JetFakes" not in nodes_to_skip and method in [3,4,6]:  # Jet Fakes
-        if method == 6 and "BDT_pred_score,aco" in args.var:
+        if method == 6 and "BDT_pred_score,aco" in var:
             print("WARNING: For CP datacards with variable names matching: `BDT_pred_score,aco*`, jet fake fractions are computed per BDT bin")
             flatten_y = True
         else:
@@ -1034,43 +1120,65 @@ def RunPlotting(
 # ------------------------------------------------------------------------------------------------------------------------
 
 # ------------------------------------------------------------------------------------------------------------------------
-# Defining name of the output file
-is_2d = False
-is_3d = False
-var_name = args.var.split("[")[0]
-var_name = var_name.split("(")[0]
-var_name = var_name.replace("/", "_over_")
-if var_name.count(",") == 1:
-    is_2d = True
-    var_name = var_name.split(",")[0] + "_vs_" + var_name.split(",")[1]
-if var_name.count(",") == 2:
-    is_3d = True
-    var_name = (
-        var_name.split(",")[0]
-        + "_vs_"
-        + var_name.split(",")[1]
-        + "_vs_"
-        + var_name.split(",")[2]
-    )
+# Defining name of the output file, the node and the categories of each datacard
+
+
+def SetupJob(job):
+    """Add the name of the output file (output_name), the name of the node
+    holding the histograms (node_name), the dimension of the variable
+    (is_2d, is_3d), the categories and the additional selection of the
+    datacard made by job as its attributes"""
+    job.is_2d = False
+    job.is_3d = False
+    var_name = job.var.split("[")[0]
+    var_name = var_name.split("(")[0]
+    var_name = var_name.replace("/", "_over_")
+    if var_name.count(",") == 1:
+        job.is_2d = True
+        var_name = var_name.split(",")[0] + "_vs_" + var_name.split(",")[1]
+    if var_name.count(",") == 2:
+        job.is_3d = True
+        var_name = (
+            var_name.split(",")[0]
+            + "_vs_"
+            + var_name.split(",")[1]
+            + "_vs_"
+            + var_name.split(",")[2]
+        )
 
-category_name = args.category
-if args.datacard_name:
-    output_name = f"{args.output_folder}/datacard_{args.datacard_name}_{category_name}_{args.channel}_{args.era}.root"
-else:
-    output_name = f"{args.output_folder}/datacard_{var_name}_{category_name}_{args.channel}_{args.era}.root"
+    category_name = job.category
+    if job.datacard_name:
+        job.output_name = f"{args.output_folder}/datacard_{job.datacard_name}_{category_name}_{args.channel}_{args.era}.root"
+    else:
+        job.output_name = f"{args.output_folder}/datacard_{var_name}_{category_name}_{args.channel}_{args.era}.root"
 
-if args.nodename:
-    nodename = args.channel + "_" + args.category + args.nodename
-else:
-    nodename = args.channel + "_" + args.category
+    if job.nodename:
+        job.node_name = args.channel + "_" + job.category + job.nodename
+    else:
+        job.node_name = args.channel + "_" + job.category
 
-if args.do_ss:
-    output_name = output_name.replace(".root", "_ss.root")
+    if args.do_ss:
+        job.output_name = job.output_name.replace(".root", "_ss.root")
 
-if args.bypass_plotter:
-    outfile = ROOT.TFile(output_name, "UPDATE")
-else:
-    outfile = ROOT.TFile(output_name, "RECREATE")
+    ApplyAliases(job)
+    job.categories["cat"] = (
+        "(" + job.categories[job.category] + ")*(" + job.categories["baseline"] + ")"
+    )
+
+
+for job in jobs:
+    SetupJob(job)
+output_names = [job.output_name for job in jobs]
+if len(set(output_names)) != len(output_names):
+    raise ValueError("Several datacards would be written to the same output file")
+
+for job in jobs:
+    if args.bypass_plotter:
+        job.outfile = ROOT.TFile(job.output_name, "UPDATE")
+    else:
+        job.outfile = ROOT.TFile(job.output_name, "RECREATE")
+    # All passes write through the same writer, which keeps the directories open
+    job.writer = Analysis.TFileWriter(job.outfile, subnodes=args.write_subnodes)
 # ------------------------------------------------------------------------------------------------------------------------
 
 # ------------------------------------------------------------------------------------------------------------------------
@@ -1084,77 +1192,115 @@ elif args.channel == "et":
 else:
     qcd_factor = 1.0
 
-weight = "(weight)"
-if args.add_weight:
-    weight += "*" + args.add_weight
-# weight += "/(w_Tau_e_FakeRate*w_Tau_mu_FakeRate)"
-# set systematics:
-# - 1st index sets folder name contaning systematic samples
-# - 2nd index sets string to be appended to output histograms
-# - 3rd index specifies the weight to be applied
-# - 4th lists nodes that should be skipped
-# - 5th specifies if this is a FF systematic (string specifying which one)
-# - 6th specifies if variable to plot needs to be changed
-systematics = OrderedDict()
-if args.channel == "mt":
-    systematics["nominal"] = ("nominal", "", f"({weight})", [], None, None)
-elif args.channel == "et":
-    systematics["nominal"] = ("nominal", "", f"({weight})", [], None, None)
-elif args.channel in ["ee", "mm"]:
-    systematics["nominal"] = ("nominal", "", f"({weight})", [], None, None)
-elif args.channel == "tt":
-    systematics["nominal"] = ("nominal", "", f"({weight})", [], None, None)
-
-if args.run_systematics and not args.do_aiso: # we dont run systematics for anti-iso region
-    enabled_systematics = {
-        systematic: getattr(args, "systematic_" + systematic)
-        for systematic, _ in systematic_options
-        if getattr(args, "systematic_" + systematic) is not None
-    }
-
-    for syst in enabled_systematics.keys():
-        if syst == enabled_systematics[syst]:
-            specific_systematic_name = ""
-        else:
-            specific_systematic_name = enabled_systematics[syst]
-
-        systematics_dict = generate_systematics_dict(
-            specific_era=args.era,
-            specific_channel=args.channel,
-            specific_systematic=syst,
-            specific_name=specific_systematic_name,
-            variable_to_plot=args.var,
-        )
 
-        for available_systematic in systematics_dict.keys():
-            systematics[available_systematic] = systematics_dict[available_systematic]
-
-    # loop over systematics and replace weight_to_replace with weight
-    for syst in systematics.keys():
-        systematics[syst] = (
-            systematics[syst][0],
-            systematics[syst][1],
-            systematics[syst][2].replace("weight_to_replace", weight),
-            systematics[syst][3],
-            systematics[syst][4],
-            systematics[syst][5],
-        )
-# ------------------------------------------------------------------------------------------------------------------------
+def JobSystematics(job):
+    """The systematics to run for the datacard made by job, which depend on
+    its variable and additional weight"""
+    weight = "(weight)"
+    if job.add_weight:
+        weight += "*" + job.add_weight
+    # weight += "/(w_Tau_e_FakeRate*w_Tau_mu_FakeRate)"
+    # set systematics:
+    # - 1st index sets folder name contaning systematic samples
+    # - 2nd index sets string to be appended to output histograms
+    # - 3rd index specifies the weight to be applied
+    # - 4th lists nodes that should be skipped
+    # - 5th specifies if this is a FF systematic (string specifying which one)
+    # - 6th specifies if variable to plot needs to be changed
+    systematics = OrderedDict()
+    if args.channel == "mt":
+        systematics["nominal"] = ("nominal", "", f"({weight})", [], None, None)
+    elif args.channel == "et":
+        systematics["nominal"] = ("nominal", "", f"({weight})", [], None, None)
+    elif args.channel in ["ee", "mm"]:
+        systematics["nominal"] = ("nominal", "", f"({weight})", [], None, None)
+    elif args.channel == "tt":
+        systematics["nominal"] = ("nominal", "", f"({weight})", [], None, None)
+
+    if args.run_systematics and not args.do_aiso: # we dont run systematics for anti-iso region
+        enabled_systematics = {
+            systematic: getattr(args, "systematic_" + systematic)
+            for systematic, _ in systematic_options
+            if getattr(args, "systematic_" + systematic) is not None
+        }
 
-categories["cat"] = (
-    "(" + categories[args.category] + ")*(" + categories["baseline"] + ")"
-)
+        for syst in enabled_systematics.keys():
+            if syst == enabled_systematics[syst]:
+                specific_systematic_name = ""
+            else:
+                specific_systematic_name = enabled_systematics[syst]
+
+            systematics_dict = generate_systematics_dict(
+                specific_era=args.era,
+                specific_channel=args.channel,
+                specific_systematic=syst,
+                specific_name=specific_systematic_name,
+                variable_to_plot=job.var,
+            )
 
+            for available_systematic in systematics_dict.keys():
+                systematics[available_systematic] = systematics_dict[available_systematic]
+
+        # loop over systematics and replace weight_to_replace with weight
+        for syst in systematics.keys():
+            systematics[syst] = (
+                systematics[syst][0],
+                systematics[syst][1],
+                systematics[syst][2].replace("weight_to_replace", weight),
+                systematics[syst][3],
+                systematics[syst][4],
+                systematics[syst][5],
+            )
+    return systematics
+
+
+for job in jobs:
+    job.systematics = JobSystematics(job)
+    job.systematic_suffixes = []
+n_systematics = sum(len(job.systematics) for job in jobs)
 # ------------------------------------------------------------------------------------------------------------------------
 
 # Loop over systematics & run plotting, etc
-systematic_suffixes = []
-max_systematics_per_pass = 10
-
+# Each pass runs every remaining systematic that reads the same input folder
+# as the first one (e.g. all weight-only systematics on nominal), for all the
+# datacards, so that each tree is only traversed once for all of them, unless
+# the histograms of the pass would take more than args.max_pass_memory MB.
+# Each datacard has its own nodes in a SubAnalysis of the pass, and nodes
+# asking for the same histograms share their draws.
+
+
+def HistMemory(nodes, plot, draws):
+    """Estimated bytes for the sums of weights and squared weights of the
+    histograms requested by nodes. Identical (sample, variable, selection)
+    requests are drawn once, so only the ones not yet in draws, the set of
+    those in the pass, count, and they are added to it."""
+    manifest = []
+    for node in nodes:
+        node.AddRequests(manifest)
+    new_draws = {entry[0:3] for entry in manifest} - draws
+    draws |= new_draws
+    _, binnings, _ = ParseVariable(plot)
+    ncells = np.prod([len(b) + 1 for b in binnings])
+    return len(new_draws) * ncells * 16
+
+
+events_read = 0
+hists_filled = 0
+worker_memory_mb = 0.
+# shared by the passes, so that the size of the cache is only counted once
+hist_cache = None
+if args.hist_cache:
+    hist_cache = HistCache.HistCache(args.hist_cache, max_size=args.hist_cache_size * 1024 ** 3)
 if not args.bypass_plotter:
-    while len(systematics) > 0:
-        analysis = Analysis.Analysis()
-        analysis.nodes.AddNode(Analysis.ListNode(nodename))
+    while any(job.systematics for job in jobs):
+        analysis = Analysis.Analysis(n_workers=args.workers)
+        analysis.threads = args.threads
+        analysis.shards = args.shards
+        analysis.hist_cache = hist_cache
+        analysis.count_events = bool(args.resource_ledger)
+        analysis.compiled = args.compiled
+        analysis.backend = args.backend
+        analysis.output_subnodes = args.write_subnodes
         analysis.remaps = {}
 
         if args.channel in ["mm", "mt"]:
@@ -1162,123 +1308,145 @@ if not args.bypass_plotter:
         if args.channel == "tt":
             analysis.remaps["Tau"] = "data_obs"
 
-        previous_systematic_variation = None
-        for index, systematic in enumerate(
-            list(systematics.keys())[:max_systematics_per_pass]
-        ):
-            if (
-                previous_systematic_variation is not None
-                and systematics[systematic][0] != previous_systematic_variation
-            ):
-                continue
-            previous_systematic_variation = systematics[systematic][0]
-            print("Processing:", systematic)
-            print("")
-
-            sel = args.sel
-            plot = args.var if systematics[systematic][5] is None else systematics[systematic][5]
-            # use plot_unmodified and categories_unmodified in cases where the data and MC get different selections due to a systematic variation
-            plot_unmodified = plot
-            categories_unmodified = copy.deepcopy(categories)
-            systematic_folder_name = systematics[systematic][0]
-            systematic_suffix = systematics[systematic][1]
-            weight = systematics[systematic][2]
-            nodes_to_skip = systematics[systematic][3]
-            ff_syst = systematics[systematic][4]
-            if not isinstance(ff_syst, str): ff_syst = None
-
-            systematic_suffixes.append(systematic_suffix)
-
-            for sample_name in data_samples:
-                analysis.AddSamples(
-                    f"{args.input_folder}/{args.era}/{args.channel}/{sample_name}/nominal/merged.root",
-                    "ntuple",
-                    None,
-                    sample_name,
-                )
+        first_job = next(job for job in jobs if job.systematics)
+        systematic_folder_name = first_job.systematics[list(first_job.systematics.keys())[0]][0]
 
-            for sample_name in ztt_samples + zll_samples + top_samples + vv_samples + wjets_samples:
-                analysis.AddSamples(
-                    f"{args.input_folder}/{args.era}/{args.channel}/{sample_name}/{systematic_folder_name}/merged.root",
-                    "ntuple",
-                    None,
-                    sample_name,
-                )
+        for sample_name in data_samples:
+            analysis.AddSamples(
+                f"{args.input_folder}/{args.era}/{args.channel}/{sample_name}/nominal/merged.root",
+                "ntuple",
+                None,
+                sample_name,
+            )
 
-            for key, value in signal_samples.items():
-                if not isinstance(value, (list,)):
-                    value = [value]
-                for samp in value:
-                    for mass in masses:
-                        sample_name = samp.replace("*", mass)
-                        analysis.AddSamples(
-                            f"{args.input_folder}/{args.era}/{args.channel}/{sample_name}/{systematic_folder_name}/merged.root",
-                            "ntuple",
-                            None,
-                            sample_name,
-                        )
-
-            analysis.AddInfo(args.parameter_file, scaleTo="data_obs")
-
-            if systematic == "nominal":
-                do_data = True
-            else:
-                do_data = False
-            RunPlotting(
-                analysis,
-                nodename,
-                samples_dict,
-                gen_sels_dict,
-                ff_syst if ff_syst else systematic,
-                args.category,
-                categories,
-                categories_unmodified,
-                sel,
-                systematic_suffix,
-                weight,
-                do_data,
-                qcd_factor,
-                method,
-                nodes_to_skip,
+        for sample_name in ztt_samples + zll_samples + top_samples + vv_samples + wjets_samples:
+            analysis.AddSamples(
+                f"{args.input_folder}/{args.era}/{args.channel}/{sample_name}/{systematic_folder_name}/merged.root",
+                "ntuple",
+                None,
+                sample_name,
             )
 
-            del systematics[systematic]
+        for key, value in signal_samples.items():
+            if not isinstance(value, (list,)):
+                value = [value]
+            for samp in value:
+                for mass in masses:
+                    sample_name = samp.replace("*", mass)
+                    analysis.AddSamples(
+                        f"{args.input_folder}/{args.era}/{args.channel}/{sample_name}/{systematic_folder_name}/merged.root",
+                        "ntuple",
+                        None,
+                        sample_name,
+                    )
 
-        analysis.Run()
-        analysis.nodes.Output(outfile)
+        analysis.AddInfo(args.parameter_file, scaleTo="data_obs")
+
+        pass_draws = set()
+        pass_memory = 0
+        pass_jobs = []
+        for job in jobs:
+            if pass_memory > args.max_pass_memory * 1024 ** 2:
+                break
+            job_analysis = None
+            # the nodes of the job whose requests are in pass_draws
+            counted_nodes = set()
+            for systematic in list(job.systematics.keys()):
+                if job.systematics[systematic][0] != systematic_folder_name:
+                    continue
+                if pass_memory > args.max_pass_memory * 1024 ** 2:
+                    break
+                if job_analysis is None:
+                    job_analysis = Analysis.SubAnalysis(analysis, job.output_name)
+                    job_analysis.nodes.AddNode(Analysis.ListNode(job.node_name))
+                    pass_jobs.append((job, job_analysis))
+                if args.jobs:
+                    print("Processing:", systematic, "for", job.output_name)
+                else:
+                    print("Processing:", systematic)
+                print("")
+
+                sel = job.sel
+                plot = job.var if job.systematics[systematic][5] is None else job.systematics[systematic][5]
+                # use plot_unmodified and categories_unmodified in cases where the data and MC get different selections due to a systematic variation
+                plot_unmodified = plot
+                categories_unmodified = copy.deepcopy(job.categories)
+                systematic_suffix = job.systematics[systematic][1]
+                weight = job.systematics[systematic][2]
+                nodes_to_skip = job.systematics[systematic][3]
+                ff_syst = job.systematics[systematic][4]
+                if not isinstance(ff_syst, str): ff_syst = None
+
+                job.systematic_suffixes.append(systematic_suffix)
+
+                if systematic == "nominal":
+                    do_data = True
+                else:
+                    do_data = False
+                RunPlotting(
+                    job_analysis,
+                    job.node_name,
+                    samples_dict,
+                    gen_sels_dict,
+                    ff_syst if ff_syst else systematic,
+                    job.category,
+                    job.categories,
+                    categories_unmodified,
+                    sel,
+                    systematic_suffix,
+                    weight,
+                    do_data,
+                    qcd_factor,
+                    method,
+                    nodes_to_skip,
+                    var=job.var,
+                )
 
-        FixBins(analysis, nodename, outfile)
-        for suffix in systematic_suffixes:
-            GetTotals(analysis, nodename, suffix, samples_dict, outfile)
-        PrintSummary(
-            analysis,
-            nodename,
-            ["data_obs"],
-            add_names=systematic_suffixes,
-            channel=args.channel,
-            samples_dict=samples_dict,
-        )
+                new_nodes = [node for node in job_analysis.nodes[job.node_name].SubNodes() if id(node) not in counted_nodes]
+                counted_nodes.update(id(node) for node in new_nodes)
+                pass_memory += HistMemory(new_nodes, plot, pass_draws)
+
+                del job.systematics[systematic]
+
+        print("Pass over %s: %i datacards, %i histograms, ~%.0f MB" % (
+            systematic_folder_name, len(pass_jobs), len(pass_draws), pass_memory / 1024. ** 2))
+        analysis.Run(targets=args.targets.split(",") if args.targets else None)
+        events_read += analysis.events_read
+        hists_filled += analysis.hists_filled
+        worker_memory_mb = max(worker_memory_mb, analysis.worker_memory_mb)
+        for job, job_analysis in pass_jobs:
+            job_analysis.nodes.Output(job.writer)
+            job.writer.Flush()
+
+            FixBins(job_analysis, job.node_name, job.outfile)
+            for suffix in job.systematic_suffixes:
+                GetTotals(job_analysis, job.node_name, suffix, samples_dict, job.outfile)
+            PrintSummary(
+                job_analysis,
+                job.node_name,
+                ["data_obs"],
+                add_names=job.systematic_suffixes,
+                channel=args.channel,
+                samples_dict=samples_dict,
+            )
 # ------------------------------------------------------------------------------------------------------------------------
 
-# unroll 2D histograms into 1D histograms but store both versions
-
-if is_2d and args.do_unrolling:
-    x_lines = []
-    y_labels = []
-    first_hist = True
-    # loop over all TH2Ds and for each one unroll to produce TH1D and add to datacard
-    directory = outfile.Get(nodename)
-    outfile.cd(nodename)
-    hists_to_add = []
-    for key in directory.GetListOfKeys():
-        hist_name = key.GetName()
-        hist = directory.Get(hist_name).Clone()
-
-        if not isinstance(hist, ROOT.TDirectory):
-            include_of = False
-
-            h1d = UnrollHist2D(hist, include_of)
-            hists_to_add.append(h1d)
+
+def FinishDatacard(job):
+    """Unroll, add the uncertainty band, rebin and plot the histograms of
+    the datacard made by job, once all passes have been written"""
+    # unroll 2D histograms into 1D histograms but store both versions
+
+    if job.is_2d and job.do_unrolling:
+        x_lines = []
+        y_labels = []
+        first_hist = True
+        # loop over all TH2Ds and for each one unroll to produce TH1D and add to datacard
+        directory = job.outfile.Get(job.node_name)
+        job.outfile.cd(job.node_name)
+        include_of = False
+        unrolled = UnrollDirectory(directory, include_of)
+        for hist, h1d in unrolled:
             if first_hist:
                 first_hist = False
                 Nxbins = hist.GetNbinsX()
@@ -1295,138 +1463,156 @@ if is_2d and args.do_unrolling:
                     y_labels.append(
                         [hist.GetYaxis().GetBinLowEdge(hist.GetNbinsY() + 1), -1]
                     )
-    for hist in hists_to_add:
-        hist_2d = directory.Get(hist.GetName()).Clone()
-        hist_2d.SetName(hist.GetName() + "_2D")
-        hist_2d.Write("", ROOT.TObject.kOverwrite)
-        hist.Write("", ROOT.TObject.kOverwrite)
-
-# --------------------
-# Full Uncertainty Band
-
-directory = outfile.Get(nodename)
-keys = [key.GetName() for key in directory.GetListOfKeys()]
-
-h0 = directory.Get('total_bkg')
-hists=[]
-
-# first process systematics affecting normalisation
-normalisation_systematics = {}
-normalisation_systematics['lumi'] = ((0.014), ["ZTT", "ZL", "TTT", "VVT"])
-normalisation_systematics['dy_xs'] = ((0.016, 0.013), ["ZTT", "ZL"])
-normalisation_systematics['top_xs'] = ((0.05), ["TTT"])
-
-for norm_syst, (value, processes) in normalisation_systematics.items():
-    if isinstance(value, tuple) and len(value) == 2:
-        down_shift = value[0]
-        up_shift = value[1]
-    else:
-        down_shift = value
-        up_shift = value
-
-    h1 = h0.Clone()
-    h2 = h0.Clone()
-    h1.SetName(h0.GetName() + "_" + norm_syst + "Up")
-    h2.SetName(h0.GetName() + "_" + norm_syst + "Down")
-    for proc in processes:
-        if proc not in keys:
-            print(f"Process {proc} not found in the directory.")
-            if proc in ["TTT", "VVT"]:
-                proc = proc.replace("TTT", "TTL").replace("VVT", "VVL")
-                if proc not in keys:
-                    print(f"Process {proc} not found in the directory.")
-                    continue
-            else:
-                continue
-
-        hup = directory.Get(proc).Clone()
-        hdown = directory.Get(proc).Clone()
-
-        h1.Add(hup, -1.0)
-        h2.Add(hdown, -1.0)
-
-        hup.Scale(1+up_shift)
-        hdown.Scale(1-down_shift)
-
-        h1.Add(hup)
-        h2.Add(hdown)
-
-    hists.append(h1.Clone())
-    hists.append(h2.Clone())
-
-# now process systematics affecting shape
-for hist in directory.GetListOfKeys():
-    if ".subnodes" in hist.GetName():
-        continue
+        for hist, h1d in unrolled:
+            hist_2d = hist.Clone()
+            hist_2d.SetName(h1d.GetName() + "_2D")
+            hist_2d.Write("", ROOT.TObject.kOverwrite)
+            h1d.Write("", ROOT.TObject.kOverwrite)
+
+    # --------------------
+    # Full Uncertainty Band
+
+    directory = job.outfile.Get(job.node_name)
+    keys = [key.GetName() for key in directory.GetListOfKeys()]
+
+    h0 = directory.Get('total_bkg')
+    hists=[]
+
+    # first process systematics affecting normalisation
+    normalisation_systematics = {}
+    normalisation_systematics['lumi'] = ((0.014), ["ZTT", "ZL", "TTT", "VVT"])
+    normalisation_systematics['dy_xs'] = ((0.016, 0.013), ["ZTT", "ZL"])
+    normalisation_systematics['top_xs'] = ((0.05), ["TTT"])
+
+    for norm_syst, (value, processes) in normalisation_systematics.items():
+        if isinstance(value, tuple) and len(value) == 2:
+            down_shift = value[0]
+            up_shift = value[1]
+        else:
+            down_shift = value
+            up_shift = value
 
-    processes = ["ZTT", "ZL", "ZJ", "TTT", "TTJ","VVT","VVJ", "W", "QCD", "JetFakes", "JetFakesSublead"]
-    if hist.GetName().endswith("Up") or hist.GetName().endswith("Down"):
+        h1 = h0.Clone()
+        h2 = h0.Clone()
+        h1.SetName(h0.GetName() + "_" + norm_syst + "Up")
+        h2.SetName(h0.GetName() + "_" + norm_syst + "Down")
         for proc in processes:
-            if hist.GetName().startswith(proc + '_'):
-                print(f"Adding {hist.GetName()} to total uncertainty")
-                no_syst_name = proc
-                temp_hist = h0.Clone()
-                temp_hist.Add(directory.Get(no_syst_name),-1)
-                temp_hist.Add(directory.Get(hist.GetName()))
-                hists.append(temp_hist)
-
-(uncert, up, down) = Total_Uncertainty(h0, hists)
-outfile.cd(nodename)
-uncert.Write()
-up.Write()
-down.Write()
-
-# --------------------
-
-outfile.Close()
-plot_file = ROOT.TFile(output_name, "READ")
-
-if args.auto_rebin:
-    outfile_rebin = ROOT.TFile(
-        output_name.replace(".root", "_rebinned.root"), "RECREATE"
-    )
-    outfile_rebin.mkdir(nodename)
-    outfile_rebin.cd(nodename)
-    total_bkghist = plot_file.Get(nodename + "/total_bkg").Clone()
-    binning = FindRebinning(total_bkghist, BinThreshold=100, BinUncertFraction=0.5)
-
-    print("New binning:", binning)
-    hists_done = []
-    for i in plot_file.Get(nodename).GetListOfKeys():
-        if i.GetName() not in hists_done:
-            if ".subnodes" not in i.GetName():
-                RebinHist(
-                    plot_file.Get(nodename + "/" + i.GetName()).Clone(), binning
-                ).Write()
-                hists_done.append(i.GetName())
-
-    outfile_rebin.Close()
-    plot_file = ROOT.TFile(output_name.replace(".root", "_rebinned.root"))
-
-titles = Plotting.SetAxisTitles(args.var, args.channel)
-x_title = titles[0]
-y_title = titles[1]
-
-
-if args.rename_procs:
-    outfile = ROOT.TFile(output_name, "UPDATE")
-    if args.channel in ["mm", "ee"]:
-        RenameDatacards(outfile, nodename)
-    outfile.Close()
-
-# new plotting available for 1D histograms (NB only 2D unrolled histograms are supported)
-if (not is_2d) or (is_2d and args.do_unrolling):
-    Histo_Plotter = HTT_Histogram(
-        output_name,
-        nodename,
-        args.channel,
-        args.era,
-        args.var,
-        method,
-        blind=args.blind,
-        log_y=False,
-        is2Dunrolled=is_2d,
-    )
+            if proc not in keys:
+                print(f"Process {proc} not found in the directory.")
+                if proc in ["TTT", "VVT"]:
+                    proc = proc.replace("TTT", "TTL").replace("VVT", "VVL")
+                    if proc not in keys:
+                        print(f"Process {proc} not found in the directory.")
+                        continue
+                else:
+                    continue
 
-    Histo_Plotter.plot_1D_histo()
+            hup = directory.Get(proc).Clone()
+            hdown = directory.Get(proc).Clone()
+
+            h1.Add(hup, -1.0)
+            h2.Add(hdown, -1.0)
+
+            hup.Scale(1+up_shift)
+            hdown.Scale(1-down_shift)
+
+            h1.Add(hup)
+            h2.Add(hdown)
+
+        hists.append(h1.Clone())
+        hists.append(h2.Clone())
+
+    # now process systematics affecting shape
+    for hist in directory.GetListOfKeys():
+        if ".subnodes" in hist.GetName():
+            continue
+
+        processes = ["ZTT", "ZL", "ZJ", "TTT", "TTJ","VVT","VVJ", "W", "QCD", "JetFakes", "JetFakesSublead"]
+        if hist.GetName().endswith("Up") or hist.GetName().endswith("Down"):
+            for proc in processes:
+                if hist.GetName().startswith(proc + '_'):
+                    print(f"Adding {hist.GetName()} to total uncertainty")
+                    no_syst_name = proc
+                    temp_hist = h0.Clone()
+                    temp_hist.Add(directory.Get(no_syst_name),-1)
+                    temp_hist.Add(directory.Get(hist.GetName()))
+                    hists.append(temp_hist)
+
+    (uncert, up, down) = Total_Uncertainty(h0, hists)
+    job.outfile.cd(job.node_name)
+    uncert.Write()
+    up.Write()
+    down.Write()
+
+    # --------------------
+
+    # The rebinned datacard keeps the original process names, so it is
+    # written from the output before they are renamed
+    if job.auto_rebin:
+        outfile_rebin = ROOT.TFile(
+            job.output_name.replace(".root", "_rebinned.root"), "RECREATE"
+        )
+        outfile_rebin.mkdir(job.node_name)
+        outfile_rebin.cd(job.node_name)
+        total_bkghist = job.outfile.Get(job.node_name + "/total_bkg").Clone()
+        binning = FindRebinning(total_bkghist, BinThreshold=100, BinUncertFraction=0.5)
+
+        print("New binning:", binning)
+        hists_done = []
+        for i in job.outfile.Get(job.node_name).GetListOfKeys():
+            if i.GetName() not in hists_done:
+                if ".subnodes" not in i.GetName():
+                    RebinHist(
+                        job.outfile.Get(job.node_name + "/" + i.GetName()).Clone(), binning
+                    ).Write()
+                    hists_done.append(i.GetName())
+
+        outfile_rebin.Close()
+
+    # Renamed before closing, so that the output is only opened for writing once
+    if job.rename_procs and args.channel in ["mm", "ee"]:
+        RenameDatacards(job.outfile, job.node_name)
+    job.outfile.Close()
+
+    titles = Plotting.SetAxisTitles(job.var, args.channel)
+    x_title = titles[0]
+    y_title = titles[1]
+
+    # new plotting available for 1D histograms (NB only 2D unrolled histograms are supported)
+    if (not job.is_2d) or (job.is_2d and job.do_unrolling):
+        Histo_Plotter = HTT_Histogram(
+            job.output_name,
+            job.node_name,
+            args.channel,
+            args.era,
+            job.var,
+            method,
+            blind=job.blind,
+            log_y=False,
+            is2Dunrolled=job.is_2d,
+        )
 
+        Histo_Plotter.plot_1D_histo()
+
+
+for job in jobs:
+    FinishDatacard(job)
+
+if args.resource_ledger:
+    peak_rss_mb = ResourceLedger.PeakMemoryMB()
+    ResourceLedger.Record(
+        args.resource_ledger,
+        args.job_name if args.job_name else jobs[0].output_name,
+        era=args.era,
+        channel=args.channel,
+        datacards=len(jobs),
+        systematics=n_systematics,
+        workers=args.workers,
+        wall_time=time.time() - start_time,
+        # the workers all run at once, each with its own buffers and histograms
+        max_rss_mb=peak_rss_mb + args.workers * worker_memory_mb,
+        parent_rss_mb=peak_rss_mb,
+        worker_private_mb=worker_memory_mb,
+        events=events_read,
+        histograms=hists_filled,
+    )
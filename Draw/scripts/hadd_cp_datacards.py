@@ -1,178 +1,187 @@
-import ROOT
 import argparse
-import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import uproot
+from uproot.writing import identify
 from tqdm import tqdm
 from Draw.python.PlotHistograms import HTT_Histogram
 
-def hadd_root_files(input_files, output_file, dir_combinations, channel, exp_num=None):
+SYSTEMATIC_SUFFIXES = ('Up', 'Down', 'Up_2D', 'Down_2D')
+
+# members copied from the first histogram of a sum to the histogram written
+COPIED_MEMBERS = [
+    'fTitle', 'fXaxis', 'fYaxis', 'fZaxis', 'fScalefactor', 'fBarOffset', 'fBarWidth', 'fMaximum', 'fMinimum',
+    'fNormFactor', 'fOption', 'fBinStatErrOpt', 'fStatOverflows', 'fLineColor', 'fLineStyle', 'fLineWidth',
+    'fFillColor', 'fFillStyle', 'fMarkerColor', 'fMarkerStyle', 'fMarkerSize',
+]
+
+
+def is_systematic(hist_name):
+    return hist_name.endswith(SYSTEMATIC_SUFFIXES)
+
+
+def list_histograms(input_root):
+    """Names of the histograms in each directory of an open file, without
+    reading the histograms"""
+    contents = {}
+    for dir_name, classname in input_root.classnames(recursive=False, cycle=False).items():
+        if classname not in ('TDirectory', 'TDirectoryFile'):
+            continue
+        classnames = input_root[dir_name].classnames(recursive=False, cycle=False)
+        contents[dir_name] = [name for name, cls in classnames.items() if cls.startswith(('TH1', 'TH2', 'TH3'))]
+    return contents
+
+
+def nominal_index(hist_names):
+    """Map each systematic histogram name (ending in 'Up', 'Up_2D', 'Down' or
+    'Down_2D') to the nominal histogram added in its place from files that
+    don't have it: the nominal name (without '_2D') the systematic name
+    starts with, both 2D or neither. If several match the longest wins."""
+    prefixes = {}
+    for name in sorted(hist_names):
+        if not is_systematic(name):
+            prefixes.setdefault((name.replace('_2D', ''), name.endswith('_2D')), name)
+    index = {}
+    for name in hist_names:
+        if not is_systematic(name):
+            continue
+        is_2d = name.endswith('_2D')
+        for end in range(len(name), 0, -1):
+            nominal = prefixes.get((name[:end], is_2d))
+            if nominal is not None:
+                index[name] = nominal
+                break
+    return index
+
+
+def read_directory(input_root, dir_name, hist_names):
+    """{name: (histogram, contents, sums of squared weights)} for the given
+    histograms of a directory, the arrays over the global bins in ROOT order
+    (x fastest), flow bins included"""
+    hists = {}
+    for hist_name in hist_names:
+        hist = input_root[f"{dir_name}/{hist_name}"]
+        content = np.asarray(hist.values(flow=True)).T.ravel()
+        hists[hist_name] = (hist, content, np.asarray(hist.member('fSumw2')))
+    return hists
+
+
+class HistogramSum:
+    """Sum of histograms with the same binning, as TH1::Add makes it: the
+    contents, sums of squared weights, entries and statistics are added"""
+
+    def __init__(self, template):
+        self.template = template
+        self.content = 0.
+        self.sumw2 = 0.
+        self.has_sumw2 = False
+        self.stats = {k: 0. for k in template.all_members if k == 'fEntries' or k.startswith('fTsumw')}
+
+    def add(self, hist, content, sumw2):
+        self.content = self.content + content
+        # histograms without sums of squared weights have errors sqrt(content)
+        self.sumw2 = self.sumw2 + (sumw2 if len(sumw2) else content)
+        self.has_sumw2 = self.has_sumw2 or len(sumw2) > 0
+        for k in self.stats:
+            self.stats[k] += hist.member(k)
+
+    def writable(self, hist_name):
+        """The sum as an object uproot can write, of the class of the first
+        histogram added"""
+        members = self.template.all_members
+        to_hist = {'1': identify.to_TH1x, '2': identify.to_TH2x, '3': identify.to_TH3x}[self.template.classname[2]]
+        kwargs = {k: members[k] for k in COPIED_MEMBERS if k in members}
+        kwargs.update(self.stats)
+        dtype = self.template.values().dtype
+        return to_hist(
+            fName=hist_name,
+            data=np.asarray(self.content, dtype=dtype),
+            fSumw2=np.asarray(self.sumw2 if self.has_sumw2 else [], dtype=np.float64),
+            **kwargs,
+        )
+
+
+def hadd_root_files(input_files, output_file, dir_combinations, channel, exp_num=None, workers=4):
     """
     Combine ROOT files and merge specific directories by adding their histograms.
-    
+    The files are merged one output directory at a time: the directories going
+    into it are read from all files in parallel threads and added with numpy,
+    and the sums are written before the next directory is read, so only one
+    directory of each file is held in memory.
+
     Args:
         input_files (list of str): List of input ROOT files to combine.
         output_file (str): Name of the output ROOT file.
         dir_combinations (dict): Dictionary where keys are new directory names and values are lists
                                  of directories to combine.
                                  E.g., {'higgs_pirho': ['tt_higgs_pirho', 'tt_higgs_rhopi']}
+        exp_num (int): Number of files each histogram should be found in, histograms found in
+                       fewer are not written.
+        workers (int): Number of files read at the same time.
     """
-    # Create an empty output ROOT file
-    output = ROOT.TFile(output_file, "RECREATE")
+    input_roots = [uproot.open(file_name) for file_name in input_files]
+    executor = ThreadPoolExecutor(max_workers=max(1, int(workers)))
+    contents = list(executor.map(list_histograms, input_roots))
+    print("Listed histograms in input files")
+
+    # a systematic histogram might not exist in all files, in which case the
+    # nominal histogram from that file is added instead
+    index = nominal_index({name for file_contents in contents for names in file_contents.values() for name in names})
+
+    # the input directories going into each output directory
+    sources = {}
+    for file_contents in contents:
+        for dir_name in file_contents:
+            targets = [d for d, dirs in (dir_combinations or {}).items() if dir_name in dirs] or [dir_name]
+            for target in targets:
+                if dir_name not in sources.setdefault(target, []):
+                    sources[target].append(dir_name)
+
+    output = uproot.recreate(output_file)
     print("Created output file:", output_file)
-    # First, create a map of (hist_name, dir_name, file_name) to histogram
-    histogram_dir_file_map = {}
-
-    for file_name in tqdm(input_files):
-
-        input_root = ROOT.TFile.Open(file_name, "READ")
-        
-        # Loop over all the keys in the input file
-        for key in input_root.GetListOfKeys():
-
-            obj = key.ReadObj()
-
-            # Check if the object is a directory
-            if isinstance(obj, ROOT.TDirectoryFile):
-                dir_name = obj.GetName()
-
-                # Loop over all histograms in the directory
-                input_root.cd(dir_name)
-                for hist_key in ROOT.gDirectory.GetListOfKeys():
-                    hist_name = hist_key.GetName()
-                    hist = hist_key.ReadObj()
-                        
-                    # Check if it's a histogram
-                    if isinstance(hist, ROOT.TH1):
-                        out_key = (hist_name,dir_name,file_name)
-                        histogram_dir_file_map[out_key] = hist.Clone()
-                        histogram_dir_file_map[out_key].SetDirectory(0)
-    print("Mapped histograms from input files")
-
-    # now we convert this map into a histogram_dir_map with format (hist_name, dir_name) : hist
-    # we check that a histogram exists for all files, if it is a systematic histogram identifed by ending in 'Up', 'Up_2D', 'Down', or 'Down_2D' then it might not exist in all files
-    # in this case we will add the nominal histogram from that file instead
-
-    # first create empty histogram_dir_map by looping over the keys in histogram_dir_file_map
-    # we also get a set of the nominal histograms names which are these ones not ending in 'Up', 'Up_2D', 'Down', or 'Down_2D'
-    histogram_dir_map = {}
-    nominal_hist_names = set()
-
-    for (hist_name, dir_name, file_name) in histogram_dir_file_map.keys():
-        out_key = (hist_name, dir_name)
-        if out_key not in histogram_dir_map:
-            histogram_dir_map[out_key] = None
-        if not (hist_name.endswith('Up') or hist_name.endswith('Down') or hist_name.endswith('Up_2D') or hist_name.endswith('Down_2D')):
-            nominal_hist_names.add(hist_name)
-
-    print("Getting Keys")
-    for key in tqdm(histogram_dir_map.keys()):
-        hist_name, dir_name = key
-        hist = None
-        hist_count = 0
-        for file_name in input_files:
-            file_key = (hist_name, dir_name, file_name)
-        
-            if file_key in histogram_dir_file_map:
-                if hist is None:
-                    hist = histogram_dir_file_map[file_key].Clone()
-                    hist.SetDirectory(0)
-                    hist_count += 1
-                else:
-                    hist.Add(histogram_dir_file_map[file_key])
-                    hist_count += 1
-            else:
-                # check if the histogram is a systematic histogram
-                if hist_name.endswith('Up') or hist_name.endswith('Down') or hist_name.endswith('Up_2D') or hist_name.endswith('Down_2D'):
-                    # get the nominal histogram name, loop over the nominal_hist_names and find the one that matches
-                    nominal_hist_name = None
-                    for nh in nominal_hist_names:
-                        if hist_name.startswith(nh.replace('_2D','')) and (hist_name.endswith('_2D') == nh.endswith('_2D')):
-                            nominal_hist_name = nh
-                            break
-
-                    if nominal_hist_name is not None:
-                        # add the nominal histogram from this file instead
-
-                        nominal_file_key = (nominal_hist_name, dir_name, file_name)
-                        if nominal_file_key in histogram_dir_file_map:
-                            if hist is None:
-                                hist = histogram_dir_file_map[nominal_file_key].Clone()
-                                hist.SetDirectory(0)
-                                hist_count += 1
-                            else:
-                                hist.Add(histogram_dir_file_map[nominal_file_key])
-                                hist_count += 1
-                    
-        if hist is None:
-            print(f"Warning: Histogram {hist_name} in directory {dir_name} not found in any input files. Not adding to output.")
-        elif exp_num is None or (hist_count == exp_num):
-            histogram_dir_map[key] = hist
-        elif hist_count != exp_num:
-            print(f"Warning: Histogram {hist_name} in directory {dir_name} found in {hist_count} out of expected {exp_num} input files. Not adding to output.")
-
-    print("Processed Keys")
-
-    # now we take care of combining directories together if needed based on dir_combinations
-    if dir_combinations:
-        combined_histogram_dir_map = {}
-        for (hist_name, dir_name), hist in histogram_dir_map.items():
-            if hist is None: continue
-            combined = False
-            for combined_dir, dirs_to_combine in dir_combinations.items():
-                if dir_name in dirs_to_combine:
-                    combined = True
-                    out_key = (hist_name, combined_dir)
-                    if out_key not in combined_histogram_dir_map:
-                        combined_histogram_dir_map[out_key] = hist.Clone()
-                        combined_histogram_dir_map[out_key].SetDirectory(0)
-                    else:
-                        combined_histogram_dir_map[out_key].Add(hist)
-            if not combined:
-                out_key = (hist_name, dir_name)
-                if out_key not in combined_histogram_dir_map:
-                    combined_histogram_dir_map[out_key] = hist.Clone()
-                    combined_histogram_dir_map[out_key].SetDirectory(0)
-                else:
-                    combined_histogram_dir_map[out_key].Add(hist)
-        histogram_dir_map = combined_histogram_dir_map
-
     dir_names = []
-    print("Combined directories")
-
-    # now we write the histograms to the output file
-    for (hist_name, dir_name), hist in histogram_dir_map.items():
-        if hist is None: continue
-        # Create the directory in the output file if it doesn't exist
-        if not output.GetDirectory(dir_name):
-            output.mkdir(dir_name)
-            dir_names.append(dir_name)
-        output.cd(dir_name)
-        hist.SetName(hist_name)
-        hist.Write(hist_name)
-
-    # Uncomment the below if you want to manually create 'JetFakes' histograms by summing MC jet backgrounds
-    # if channel in ['mt', 'et']: # manually create jet fakes while without FFs
-    #     for key in output.GetListOfKeys():
-    #         if key.GetClassName() != "TDirectoryFile":
-    #             continue
-    #         dirname = key.GetName()
-    #         print(f"Processing directory: {dirname}")
-    #         dir_obj = output.GetDirectory(dirname)
-    #         hists = [dir_obj.Get(hn) for hn in ["TTJ", "VVJ", "W", "QCD", "ZJ"]]
-    #         hists_to_sum = [h for h in hists if h is not None]
-    #         if not hists_to_sum:
-    #             continue
-    #         # Clone first histo and add others
-    #         h_sum = hists_to_sum[0].Clone("JetFakes")
-    #         h_sum.Reset() # clear
-    #         for h in hists_to_sum:
-    #             h_sum.Add(h)
-    #         # Write to directory
-    #         dir_obj.cd()
-    #         h_sum.Write("JetFakes")
-
+    for out_dir, in_dirs in tqdm(sources.items()):
+        sums = {}
+        for dir_name in in_dirs:
+            per_file = list(executor.map(
+                lambda i: read_directory(input_roots[i], dir_name, contents[i].get(dir_name, [])),
+                range(len(input_roots)),
+            ))
+            hist_names = list(dict.fromkeys(name for hists in per_file for name in hists))
+            for hist_name in hist_names:
+                parts = []
+                for hists in per_file:
+                    if hist_name in hists:
+                        parts.append(hists[hist_name])
+                    elif index.get(hist_name) in hists:
+                        parts.append(hists[index[hist_name]])
+                if exp_num is not None and len(parts) != exp_num:
+                    print(f"Warning: Histogram {hist_name} in directory {dir_name} found in {len(parts)} out of expected {exp_num} input files. Not adding to output.")
+                    continue
+                for part in parts:
+                    sums.setdefault(hist_name, HistogramSum(part[0])).add(*part)
+        if not sums:
+            continue
+
+        # Uncomment the below if you want to manually create 'JetFakes' histograms by summing MC jet backgrounds
+        # if channel in ['mt', 'et']: # manually create jet fakes while without FFs
+        #     for hn in ["TTJ", "VVJ", "W", "QCD", "ZJ"]:
+        #         if hn not in sums:
+        #             continue
+        #         jet_fakes = sums.setdefault("JetFakes", HistogramSum(sums[hn].template))
+        #         jet_fakes.content = jet_fakes.content + sums[hn].content
+        #         jet_fakes.sumw2 = jet_fakes.sumw2 + sums[hn].sumw2
+        #         jet_fakes.has_sumw2 = True
+
+        for hist_name, hist_sum in sums.items():
+            output[f"{out_dir}/{hist_name}"] = hist_sum.writable(hist_name)
+        dir_names.append(out_dir)
+    executor.shutdown()
+    for input_root in input_roots:
+        input_root.close()
 
     # Close the output file
-    output.Close()
+    output.close()
 
 
     print("Written output file:", output_file)
@@ -216,6 +225,7 @@ if __name__ == "__main__":
     parser.add_argument('-o', '--output', required=True, help="Name of the output ROOT file")
     parser.add_argument('-e', '--expected', type=int, default=None, help="Expected number of input files each histogram should appear in i.e the number of eras")
     parser.add_argument('-c', '--channel', default='tt', help="Channel to process (default: 'tt')")
+    parser.add_argument('-j', '--workers', type=int, default=4, help="Number of input files read at the same time (default: 4)")
 
     # Parse arguments
     args = parser.parse_args()
@@ -271,5 +281,5 @@ if __name__ == "__main__":
 
 
     # Call the hadd function with the provided arguments
-    hadd_root_files(input_files, output_file, dir_combinations, ch, exp_num=exp_num)
+    hadd_root_files(input_files, output_file, dir_combinations, ch, exp_num=exp_num, workers=args.workers)
     # should be called added_histo_Run2Bins.root
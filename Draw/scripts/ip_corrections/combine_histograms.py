@@ -6,6 +6,7 @@ import logging
 from prettytable import PrettyTable
 from collections import defaultdict
 import os
+from Draw.python.Rebinning import FindRebinning
 
 
 # Setup logger
@@ -13,74 +14,6 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(
 logger = logging.getLogger(__name__)
 
 
-def FindRebinning(hist, BinThreshold=100, BinUncertFraction=0.5):
-    # Get initial binning
-    binning = [hist.GetBinLowEdge(i) for i in range(1, hist.GetNbinsX() + 2)]
-
-    def rebin_histogram(hist, binning, new_name_suffix):
-        """Helper function to rebin histograms and assign unique names."""
-        bin_array = array('d', binning)  # Convert to C-style array
-        rebinned_hist = hist.Rebin(len(bin_array) - 1, f"{hist.GetName()}_{new_name_suffix}", bin_array)
-        return rebinned_hist
-
-    # Remove outer bins with zero content and error
-    still_zero = True
-    for i in range(1, hist.GetNbinsX()):
-        if not (hist.GetBinContent(i) == 0 and hist.GetBinError(i) == 0):
-            still_zero = False
-        if still_zero:
-            binning.remove(min(binning, key=lambda x: abs(x - hist.GetBinLowEdge(i))))
-        else:
-            break
-    hist = rebin_histogram(hist, binning, "outer_left")
-
-    still_zero = True
-    for i in reversed(range(2, hist.GetNbinsX() + 1)):
-        if not (hist.GetBinContent(i) == 0 and hist.GetBinError(i) == 0):
-            still_zero = False
-        if still_zero:
-            binning.remove(min(binning, key=lambda x: abs(x - hist.GetBinLowEdge(i + 1))))
-        else:
-            break
-    hist = rebin_histogram(hist, binning, "outer_right")
-
-    # Rebin left to right based on uncertainty fraction and bin threshold
-    finished = False
-    k = 0
-    while not finished and k < 1000:
-        k += 1
-        for i in range(1, hist.GetNbinsX()):
-            if hist.GetBinContent(i) > 0:
-                uncert_frac = hist.GetBinError(i) / hist.GetBinContent(i)
-            else:
-                uncert_frac = BinUncertFraction + 1
-            if uncert_frac > BinUncertFraction and hist.GetBinContent(i) < BinThreshold:
-                binning.remove(min(binning, key=lambda x: abs(x - hist.GetBinLowEdge(i + 1))))
-                hist = rebin_histogram(hist, binning, f"left_{k}")
-                break
-            elif i + 1 == hist.GetNbinsX():
-                finished = True
-
-    # Rebin right to left based on uncertainty fraction and bin threshold
-    finished = False
-    k = 0
-    while not finished and k < 1000:
-        k += 1
-        for i in reversed(range(2, hist.GetNbinsX() + 1)):
-            if hist.GetBinContent(i) > 0:
-                uncert_frac = hist.GetBinError(i) / hist.GetBinContent(i)
-            else:
-                uncert_frac = BinUncertFraction + 1
-            if uncert_frac > BinUncertFraction and hist.GetBinContent(i) < BinThreshold:
-                binning.remove(min(binning, key=lambda x: abs(x - hist.GetBinLowEdge(i))))
-                hist = rebin_histogram(hist, binning, f"right_{k}")
-                break
-            elif i == 2:
-                finished = True
-
-    return binning
-
-
 def RebinHist(hist, binning, new_name_suffix="rebinned"):
     # Convert binning to a C-style array
     new_binning = array("f", map(float, binning))
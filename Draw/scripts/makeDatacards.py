@@ -1,9 +1,18 @@
 import argparse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import functools
+import glob
+import hashlib
+import json
 import yaml
 import numpy
 import subprocess
 import os
 import re
+import threading
+import time
+from Draw.python import ResourceLedger
 
 def create_bins(variable: str) -> str:
     if "(" in variable:
@@ -44,9 +53,40 @@ def create_bins(variable: str) -> str:
     return variable
 
 
+def get_request_cpus(channel: str = "", run_systematics: bool = False) -> int:
+    # et/mt with systematics get 3 cores, which the jobs use to draw samples in parallel
+    if run_systematics and channel in ["et", "mt"]:
+        return 3
+    return 1
+
+
+def get_workers(channel: str = "", run_systematics: bool = False, local_workers: int = 0) -> int:
+    # drawing processes of a job: one per requested cpu on condor, and with
+    # --local-workers no more than the share of the cores of this machine
+    # each of the jobs running at the same time gets
+    workers = get_request_cpus(channel, run_systematics)
+    if local_workers:
+        workers = max(1, min(workers, (os.cpu_count() or 1) // local_workers))
+    return workers
+
+
+def write_if_changed(path, text):
+    # leave the file and its modification time alone if the text is the same,
+    # so that run_local_jobs can tell when the options of a job changed
+    if os.path.exists(path):
+        with open(path) as f:
+            if f.read() == text:
+                return
+    with open(path, "w") as f:
+        f.write(text)
+
+
 def create_condor_submit_file(
-    logs_path: str, variable_name: str, submit_file: str, script_path: str, era: str = "", channel: str = "", run_systematics: bool = False
+    logs_path: str, variable_name: str, submit_file: str, script_path: str, era: str = "", channel: str = "", run_systematics: bool = False,
+    prediction=None,
 ):
+    # prediction is the (memory in MB, runtime in s) to request, from the
+    # resource ledger of earlier runs, used instead of the defaults below
     condor_template = f"""
 executable = {script_path}
 priority = 15
@@ -59,9 +99,15 @@ getenv = True
 +MaxRuntime = 10500
 queue
 """
-    if run_systematics and channel in ["et", "mt"]:
+    if prediction is not None:
+        memory, runtime = prediction
+        print(f"REQUESTING {memory} MB AND {runtime} s (from the resource ledger)")
+        condor_template = condor_template.replace("request_cpus = 1", f"request_cpus = {get_request_cpus(channel, run_systematics)}")
+        condor_template = condor_template.replace("request_memory = 8000", f"request_memory = {memory}")
+        condor_template = condor_template.replace("+MaxRuntime = 10500", f"+MaxRuntime = {runtime}")
+    elif run_systematics and channel in ["et", "mt"]:
         print("ASSIGNING EXTRA RUNTIME AND MEMORY (et/mt with systematics)")
-        condor_template = condor_template.replace("request_cpus = 1", "request_cpus = 3")
+        condor_template = condor_template.replace("request_cpus = 1", f"request_cpus = {get_request_cpus(channel, run_systematics)}")
         condor_template = condor_template.replace("request_memory = 8000", "request_memory = 12000")
         if era in ['Run3_2022EE']:
             condor_template = condor_template.replace("+MaxRuntime = 10500", "+MaxRuntime = 100000")
@@ -103,6 +149,11 @@ def create_shell_script(
     dy_NLO=False,
     use_filtered_DY=False,
     nodename="",
+    threads=1,
+    workers=1,
+    resource_ledger="",
+    job_name="",
+    fingerprint_files=None,
 ):
     shell_script = f"""
 #!/bin/bash
@@ -147,13 +198,304 @@ python3 Draw/scripts/HiggsTauTauPlot.py \\
         shell_script += " \\\n--use_filtered_DY"
     if nodename != "":
         shell_script += f" \\\n--nodename {nodename}"
+    if threads > 1:
+        shell_script += f" \\\n--threads {threads}"
+    if workers > 1:
+        shell_script += f" \\\n--workers {workers}"
+    if resource_ledger:
+        shell_script += f" \\\n--resource_ledger {resource_ledger} \\\n--job_name {job_name}"
+    if fingerprint_files:
+        # (pending, recorded): the fingerprints of the datacards of the job
+        # are recorded only once the job succeeded
+        shell_script += f" \\\n&& cp {fingerprint_files[0]} {fingerprint_files[1]}"
+
+    print(shell_script)
+    write_if_changed(script_path, shell_script)
+    os.system(f"chmod +x {script_path}")
+
 
-    with open(script_path, "w") as script_file:
-        print(shell_script)
-        script_file.write(shell_script)
+def create_fused_shell_script(
+    input_folder,
+    output_folder,
+    parameter_file,
+    channel,
+    era,
+    method,
+    jobs_file,
+    script_path,
+    run_systematics=False,
+    systematics_to_run=[],
+    aiso=False,
+    same_sign=False,
+    dy_LO=False,
+    dy_NLO=False,
+    use_filtered_DY=False,
+    threads=1,
+    workers=1,
+    resource_ledger="",
+    job_name="",
+    fingerprint_files=None,
+):
+    # one HiggsTauTauPlot.py run making all the datacards in jobs_file, with
+    # the options they share given here
+    shell_script = f"""
+#!/bin/bash
+source /cvmfs/sft.cern.ch/lcg/app/releases/ROOT/6.32.02/x86_64-almalinux9.4-gcc114-opt/bin/thisroot.sh
+python3 Draw/scripts/HiggsTauTauPlot.py \\
+--parameter_file {parameter_file} \\
+--input_folder {input_folder} \\
+--output_folder {output_folder} \\
+--channel {channel} \\
+--era {era} \\
+--method {method} \\
+--jobs {jobs_file}"""
+
+    if run_systematics:
+        if systematics_to_run:
+            shell_script += " \\\n--run_systematics"
+            for syst in systematics_to_run:
+                shell_script += f" \\\n--{syst}"
+    if aiso:
+        shell_script += " \\\n--do_aiso"
+    if same_sign:
+        shell_script += " \\\n--do_ss"
+    if dy_LO:
+        shell_script += " \\\n--LO_DY"
+    if dy_NLO:
+        shell_script += " \\\n--NLO_DY"
+    if use_filtered_DY:
+        shell_script += " \\\n--use_filtered_DY"
+    if threads > 1:
+        shell_script += f" \\\n--threads {threads}"
+    if workers > 1:
+        shell_script += f" \\\n--workers {workers}"
+    if resource_ledger:
+        shell_script += f" \\\n--resource_ledger {resource_ledger} \\\n--job_name {job_name}"
+    if fingerprint_files:
+        # (pending, recorded): the fingerprints of the datacards of the job
+        # are recorded only once the job succeeded
+        shell_script += f" \\\n&& cp {fingerprint_files[0]} {fingerprint_files[1]}"
+
+    print(shell_script)
+    write_if_changed(script_path, shell_script)
     os.system(f"chmod +x {script_path}")
 
 
+@functools.lru_cache(maxsize=None)
+def newest_ntuple(input_folder, era, channel):
+    # modification time of the most recently written input of a channel
+    files = glob.glob(f"{input_folder}/{era}/{channel}/*/*/merged.root")
+    return max((os.path.getmtime(f) for f in files), default=0)
+
+
+def local_job(name, script_path, logs, outputs, inputs, input_folder, era, channel):
+    return {
+        "name": name,
+        "script": script_path,
+        "log": os.path.join(logs, f"local_{os.path.basename(script_path)[:-3]}.log"),
+        "outputs": outputs,
+        "inputs": [script_path] + inputs,
+        "ntuples": (input_folder, era, channel),
+    }
+
+
+def is_up_to_date(job, runtimes):
+    # the last run of the job succeeded and none of its inputs changed since
+    if job["name"] not in runtimes:
+        return False
+    if not all(os.path.exists(f) for f in job["outputs"]):
+        return False
+    newest_input = max(
+        [os.path.getmtime(f) for f in job["inputs"] if os.path.exists(f)] + [newest_ntuple(*job["ntuples"])]
+    )
+    return min(os.path.getmtime(f) for f in job["outputs"]) > newest_input
+
+
+@functools.lru_cache(maxsize=None)
+def file_digest(path):
+    # sha256 of the content of a file, empty if there is none
+    if not os.path.exists(path):
+        return ""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def ntuples_digest(input_folder, era, channel):
+    # the ntuples are too large to read every time, so they are identified by
+    # their names, sizes and modification times
+    digest = hashlib.sha256()
+    for f in sorted(glob.glob(f"{input_folder}/{era}/{channel}/*/*/merged.root")):
+        stat = os.stat(f)
+        digest.update(f"{f} {stat.st_size} {stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def code_digest():
+    # the code the jobs run: HiggsTauTauPlot.py and what it imports from Draw
+    draw_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    files = [os.path.join(draw_dir, "scripts", "HiggsTauTauPlot.py")]
+    for pattern in ["python/*.py", "scripts/systematics/*.py", "src/*.cc", "interface/*.h"]:
+        files += sorted(glob.glob(os.path.join(draw_dir, pattern)))
+    digest = hashlib.sha256()
+    for f in files:
+        digest.update(f"{os.path.relpath(f, draw_dir)} {file_digest(f)}\n".encode())
+    return digest.hexdigest()
+
+
+def fingerprint(options, parameter_file, input_folder, era, channel):
+    """Fingerprint of a datacard, with a digest for each of the things it is
+    made from: its options (a dict of everything in the config that goes
+    into the HiggsTauTauPlot.py command for it), the parameter file, the
+    ntuples of its era and channel and the code"""
+    return {
+        "options": hashlib.sha256(json.dumps(options, sort_keys=True).encode()).hexdigest(),
+        "parameters": file_digest(parameter_file),
+        "ntuples": ntuples_digest(input_folder, era, channel),
+        "code": code_digest(),
+    }
+
+
+def load_fingerprints(path):
+    # fingerprints of the datacards as they were last made by a job, by
+    # datacard
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def rerun_reasons(output, new, old):
+    # why the datacard output with fingerprint new has to be made again,
+    # given the fingerprints old of the last run, none if it is up to date
+    if output not in old:
+        return ["never made"]
+    if not os.path.exists(output):
+        return ["datacard missing"]
+    return [f"{part} changed" for part in new if old[output].get(part) != new[part]]
+
+
+def print_plan(plan):
+    # plan is a list of (job name, datacard, reasons to make it again)
+    n_rerun = 0
+    for name, output, reasons in plan:
+        if reasons:
+            n_rerun += 1
+            print(f"RERUN      {name}: {os.path.basename(output)} ({', '.join(reasons)})")
+        else:
+            print(f"UP TO DATE {name}: {os.path.basename(output)}")
+    print(f"{n_rerun} of {len(plan)} datacards to make")
+
+
+def run_local_jobs(jobs, n_workers, runtimes_file, check_up_to_date=True):
+    """Run the scripts of the jobs in n_workers parallel processes, instead
+    of submitting them to condor. Whenever a worker is free it takes the
+    longest of the remaining jobs, going by their runtimes in earlier runs
+    (jobs that never ran go first). The output of each job goes to its log
+    file and to the terminal, prefixed with its name. Jobs that are up to
+    date (see is_up_to_date) are skipped, unless check_up_to_date is False.
+    The runtimes of successful jobs are saved to runtimes_file."""
+    runtimes = {}
+    if os.path.exists(runtimes_file):
+        with open(runtimes_file) as f:
+            runtimes = json.load(f)
+
+    todo = []
+    for job in jobs:
+        if check_up_to_date and is_up_to_date(job, runtimes):
+            print(f"Skipping {job['name']}, which is up to date")
+        else:
+            todo.append(job)
+    unknown = max(runtimes.values(), default=0) + 1
+    todo.sort(key=lambda job: runtimes.get(job["name"], unknown), reverse=True)
+    print(f"Running {len(todo)} of {len(jobs)} jobs with {n_workers} workers")
+
+    print_lock = threading.Lock()
+
+    def run(job):
+        start = time.time()
+        with open(job["log"], "w") as log:
+            proc = subprocess.Popen(
+                ["/bin/bash", job["script"]], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
+            )
+            for line in proc.stdout:
+                log.write(line)
+                with print_lock:
+                    print(f"[{job['name']}] {line}", end="")
+            proc.wait()
+        return proc.returncode, time.time() - start
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(run, job): job for job in todo}
+        for n_done, future in enumerate(as_completed(futures), 1):
+            job = futures[future]
+            returncode, runtime = future.result()
+            with print_lock:
+                if returncode == 0:
+                    runtimes[job["name"]] = runtime
+                    print(f"Finished {job['name']} in {runtime:.0f} s ({n_done}/{len(todo)})")
+                else:
+                    runtimes.pop(job["name"], None)
+                    failed.append(job)
+                    print(f"FAILED {job['name']} with exit code {returncode}, see {job['log']} ({n_done}/{len(todo)})")
+            # saved after every job, so that an interrupted run can be resumed
+            tmp_file = f"{runtimes_file}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(runtimes, f, indent=2, sort_keys=True)
+            os.replace(tmp_file, runtimes_file)
+
+    if failed:
+        print(f"{len(failed)} jobs failed:")
+        for job in failed:
+            print(f"  {job['name']}: {job['log']}")
+
+
+def submit_batch_jobs(jobs, pack_runtime, packs_dir):
+    """Submit the jobs to condor. The jobs predicted to take less than half
+    of pack_runtime are packed into condor jobs running several of them one
+    after the other, for up to pack_runtime in total, so that short jobs
+    don't each wait in the queue. Only jobs requesting the same number of
+    cpus are packed together."""
+    packed = defaultdict(list)
+    for job in jobs:
+        if pack_runtime and job["prediction"] is not None and job["prediction"][1] < pack_runtime / 2:
+            packed[get_request_cpus(job["channel"], job["run_systematics"])].append(job)
+        else:
+            subprocess.run(["condor_submit", job["submit_file"]])
+
+    for cpus, cpus_jobs in packed.items():
+        by_name = {job["name"]: job for job in cpus_jobs}
+        runtimes = {job["name"]: job["prediction"][1] for job in cpus_jobs}
+        for i, pack in enumerate(ResourceLedger.Pack(runtimes, pack_runtime)):
+            if len(pack) == 1:
+                subprocess.run(["condor_submit", by_name[pack[0]]["submit_file"]])
+                continue
+            os.makedirs(packs_dir, exist_ok=True)
+            pack_name = f"pack_{cpus}cpu_{i}"
+            lines = ["#!/bin/bash", "status=0"]
+            for name in pack:
+                job = by_name[name]
+                log = os.path.join(job["logs"], f"condor_{job['filename']}")
+                lines.append(f"/bin/bash {job['script']} > {log}.out 2> {log}.err || status=1")
+            lines.append("exit $status")
+            script_path = os.path.join(packs_dir, f"{pack_name}.sh")
+            write_if_changed(script_path, "\n".join(lines) + "\n")
+            os.system(f"chmod +x {script_path}")
+            print(f"{pack_name}: {len(pack)} jobs, ~{sum(runtimes[x] for x in pack)} s")
+            submit_file = os.path.join(packs_dir, f"submit_{pack_name}.sub")
+            first = by_name[pack[0]]
+            create_condor_submit_file(
+                packs_dir, pack_name, submit_file, script_path, first["era"], first["channel"], first["run_systematics"],
+                prediction=(max(by_name[x]["prediction"][0] for x in pack), sum(runtimes[x] for x in pack)),
+            )
+            subprocess.run(["condor_submit", submit_file])
+
+
 def format_first_selection(selection):
     # Extract the first condition using regex
     match = re.match(r'([^&|]+)', selection.strip())
@@ -181,10 +523,39 @@ if __name__ == "__main__":
 
     parser.add_argument("--config", type=str, help="Configuration file")
     parser.add_argument("--batch", action="store_true", help="Run in batch mode")
+    parser.add_argument(
+        "--fused",
+        action="store_true",
+        help="Make all datacards of an era, channel and scheme that share their samples and systematics in a single job, reading each tree once for all of them",
+    )
+    parser.add_argument(
+        "--pack_runtime",
+        type=int,
+        default=7000,
+        help="With --batch, run the jobs predicted by the resource ledger to take less than half of this many seconds together, in condor jobs of up to this long (0 to submit every job on its own)",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only make the datacards whose fingerprint (options in the config, parameter file, ntuples and code) changed since they were last made",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Print which datacards --incremental would make again and why, without writing, running or submitting any job",
+    )
+    parser.add_argument(
+        "--local-workers",
+        type=int,
+        default=0,
+        help="Run the jobs on this machine, this many at a time, skipping the ones that are up to date, instead of one after the other (or on condor with --batch). Each job then draws with at most (number of cores) / (this many) processes, so that all of them together don't use more processes than there are cores",
+    )
 
     args = parser.parse_args()
 
     config_file = args.config
+    if args.batch and args.local_workers:
+        raise ValueError("--batch and --local-workers can't be used together")
 
     # read config file which is a yaml file
     with open(config_file) as file:
@@ -220,6 +591,15 @@ if __name__ == "__main__":
                 f"Scheme {scheme} is not a valid scheme. Please choose from {available_schemes}"
             )
 
+    # jobs for run_local_jobs, with --local-workers
+    local_jobs = []
+    # jobs for submit_batch_jobs, with --batch
+    batch_jobs = []
+    # (job name, datacard, reasons to make it again), for --incremental and --plan
+    plan = []
+    # the jobs record their resources here, to size the requests of the next runs
+    resource_ledger = os.path.join(output_path, "resource_ledger.jsonl")
+    ledger = ResourceLedger.Load(resource_ledger)
     for era in eras:
         parameter_file = f"{parameter_path}/{era}/params.yaml"
         for channel in channels:
@@ -260,6 +640,8 @@ if __name__ == "__main__":
                                 for syst in common_systematics:
                                     systematics_to_run.append(f"{syst[0]}={syst[1]}")
 
+                # datacards made together with --fused, by the options they share
+                fused_groups = {}
                 for setting in settings[channel]:
                     method = setting.get("method", "1")
                     category = setting.get("category", "[inclusive]")
@@ -323,9 +705,66 @@ if __name__ == "__main__":
                                         nodename = "_" + nodename
 
                                 filename = f'{variable_name}_{cat}'
+                                job_name = f"{era}/{scheme}/{channel}/{filename}"
 
                                 logs = f"{output_folder}/logs"
                                 subprocess.run(["mkdir", "-p", logs])
+
+                                output = f"{output_folder}/datacard_{variable_name}_{cat}_{channel}_{era}.root"
+                                if same_sign:
+                                    output = output.replace(".root", "_ss.root")
+                                job = {
+                                    "var": variable,
+                                    "category": cat,
+                                    "sel": additional_selection,
+                                    "add_weight": additional_weight,
+                                    "datacard_name": variable_name,
+                                    "blind": blind,
+                                    "auto_rebin": auto_rebin,
+                                    "do_unrolling": unroll,
+                                    "rename_procs": rename_procs,
+                                }
+                                if alias:
+                                    job["set_alias"] = [alias]
+                                if nodename != "":
+                                    job["nodename"] = nodename
+                                options = dict(
+                                    job, method=method, aiso=aiso, same_sign=same_sign, dy_LO=dy_LO, dy_NLO=dy_NLO,
+                                    use_filtered_DY=use_filtered_DY, systematics=systematics_to_run if run_systematics else [],
+                                )
+                                new_fingerprint = fingerprint(options, parameter_file, input_folder, era, channel)
+
+                                if args.fused:
+                                    group_name = f"fused_method{method}"
+                                    for flag, enabled in [("aiso", aiso), ("ss", same_sign), ("dy_LO", dy_LO), ("dy_NLO", dy_NLO), ("filtered_DY", use_filtered_DY)]:
+                                        if enabled:
+                                            group_name += f"_{flag}"
+                                    group = fused_groups.setdefault(group_name, {
+                                        "parameter_file": parameter_file,
+                                        "method": method,
+                                        "aiso": aiso,
+                                        "same_sign": same_sign,
+                                        "dy_LO": dy_LO,
+                                        "dy_NLO": dy_NLO,
+                                        "use_filtered_DY": use_filtered_DY,
+                                        "jobs": [],
+                                        "fingerprints": {},
+                                    })
+                                    old_fingerprints = load_fingerprints(os.path.join(logs, f"{group_name}.fingerprint.json"))
+                                    reasons = rerun_reasons(output, new_fingerprint, old_fingerprints)
+                                    plan.append((f"{era}/{scheme}/{channel}/{group_name}", output, reasons))
+                                    group["fingerprints"][output] = new_fingerprint
+                                    if reasons or not args.incremental:
+                                        group["jobs"].append(job)
+                                    continue
+
+                                fingerprint_file = os.path.join(logs, f"{filename}.fingerprint.json")
+                                reasons = rerun_reasons(output, new_fingerprint, load_fingerprints(fingerprint_file))
+                                plan.append((job_name, output, reasons))
+                                if args.plan or (args.incremental and not reasons):
+                                    continue
+                                pending_file = os.path.join(logs, f"{filename}.fingerprint.pending.json")
+                                write_if_changed(pending_file, json.dumps({output: new_fingerprint}, indent=2))
                                 script_path = os.path.join(
                                     logs, f"{filename}.sh"
                                 )
@@ -355,16 +794,102 @@ if __name__ == "__main__":
                                     dy_NLO=dy_NLO,
                                     use_filtered_DY=use_filtered_DY,
                                     nodename=nodename,
+                                    workers=get_workers(channel, run_systematics, args.local_workers),
+                                    resource_ledger=resource_ledger,
+                                    job_name=job_name,
+                                    fingerprint_files=(pending_file, fingerprint_file),
                                 )
 
                                 submit_file = os.path.join(
                                 logs, f"submit_{filename}.sub"
                                 )
+                                prediction = ResourceLedger.Predict(ledger[job_name])
                                 create_condor_submit_file(
-                                logs, filename, submit_file, script_path, era, channel, run_systematics
+                                logs, filename, submit_file, script_path, era, channel, run_systematics, prediction
                                 )
                                 if args.batch:
-                                    subprocess.run(["condor_submit", submit_file])
+                                    batch_jobs.append({
+                                        "name": job_name, "script": script_path, "submit_file": submit_file,
+                                        "logs": logs, "filename": filename, "prediction": prediction,
+                                        "era": era, "channel": channel, "run_systematics": run_systematics,
+                                    })
+                                elif args.local_workers:
+                                    local_jobs.append(local_job(
+                                        job_name, script_path, logs,
+                                        [output], [parameter_file], input_folder, era, channel,
+                                    ))
                                 else:
                                     os.chmod(script_path, 0o755)
-                                    subprocess.run(["/bin/bash", script_path])
\ No newline at end of file
+                                    subprocess.run(["/bin/bash", script_path])
+
+                for group_name, group in fused_groups.items():
+                    if args.plan or not group["jobs"]:
+                        continue
+                    logs = f"{output_folder}/logs"
+                    # the fingerprints of all datacards of the group, also the
+                    # ones that are up to date and not made again
+                    fingerprint_file = os.path.join(logs, f"{group_name}.fingerprint.json")
+                    pending_file = os.path.join(logs, f"{group_name}.fingerprint.pending.json")
+                    write_if_changed(pending_file, json.dumps(group["fingerprints"], indent=2))
+                    jobs_file = os.path.join(logs, f"{group_name}.json")
+                    write_if_changed(jobs_file, json.dumps(group["jobs"], indent=2))
+                    print(f"{group_name}: {len(group['jobs'])} datacards")
+                    job_name = f"{era}/{scheme}/{channel}/{group_name}"
+                    script_path = os.path.join(logs, f"{group_name}.sh")
+                    create_fused_shell_script(
+                        input_folder,
+                        output_folder,
+                        group["parameter_file"],
+                        channel,
+                        era,
+                        group["method"],
+                        jobs_file,
+                        script_path,
+                        run_systematics=run_systematics,
+                        systematics_to_run=systematics_to_run,
+                        aiso=group["aiso"],
+                        same_sign=group["same_sign"],
+                        dy_LO=group["dy_LO"],
+                        dy_NLO=group["dy_NLO"],
+                        use_filtered_DY=group["use_filtered_DY"],
+                        workers=get_workers(channel, run_systematics, args.local_workers),
+                        resource_ledger=resource_ledger,
+                        job_name=job_name,
+                        fingerprint_files=(pending_file, fingerprint_file),
+                    )
+                    submit_file = os.path.join(logs, f"submit_{group_name}.sub")
+                    prediction = ResourceLedger.Predict(ledger[job_name])
+                    create_condor_submit_file(
+                        logs, group_name, submit_file, script_path, era, channel, run_systematics, prediction
+                    )
+                    if args.batch:
+                        batch_jobs.append({
+                            "name": job_name, "script": script_path, "submit_file": submit_file,
+                            "logs": logs, "filename": group_name, "prediction": prediction,
+                            "era": era, "channel": channel, "run_systematics": run_systematics,
+                        })
+                    elif args.local_workers:
+                        outputs = []
+                        for job in group["jobs"]:
+                            output = f"{output_folder}/datacard_{job['datacard_name']}_{job['category']}_{channel}_{era}.root"
+                            if group["same_sign"]:
+                                output = output.replace(".root", "_ss.root")
+                            outputs.append(output)
+                        local_jobs.append(local_job(
+                            job_name, script_path, logs,
+                            outputs, [group["parameter_file"], jobs_file], input_folder, era, channel,
+                        ))
+                    else:
+                        os.chmod(script_path, 0o755)
+                        subprocess.run(["/bin/bash", script_path])
+
+    if args.plan or args.incremental:
+        print_plan(plan)
+    if args.batch:
+        submit_batch_jobs(batch_jobs, args.pack_runtime, os.path.join(output_path, "packs"))
+    if args.local_workers and not args.plan:
+        # with --incremental the fingerprints already tell which jobs are up to date
+        run_local_jobs(
+            local_jobs, args.local_workers, os.path.join(output_path, "local_runtimes.json"),
+            check_up_to_date=not args.incremental,
+        )
@@ -0,0 +1,26 @@
+import pytest
+
+pytest.importorskip('uproot')
+pytest.importorskip('tqdm')
+pytest.importorskip('mplhep')
+
+from Draw.scripts.hadd_cp_datacards import nominal_index
+
+
+def test_nominal_index():
+    names = [
+        'ZTT', 'ZTT_2D', 'ZTT_CMS_scale_tUp', 'ZTT_CMS_scale_tDown', 'ZTT_CMS_scale_tUp_2D',
+        'ZTTembed', 'ZTTembed_CMS_effUp', 'data_obs', 'orphanDown',
+    ]
+    assert nominal_index(names) == {
+        'ZTT_CMS_scale_tUp': 'ZTT',
+        'ZTT_CMS_scale_tDown': 'ZTT',
+        # 2D systematics go with 2D nominals
+        'ZTT_CMS_scale_tUp_2D': 'ZTT_2D',
+        # The longest matching nominal wins
+        'ZTTembed_CMS_effUp': 'ZTTembed',
+    }
+
+
+def test_nominal_index_without_2d_nominal():
+    assert nominal_index(['ZTT', 'ZTT_CMS_scale_tUp_2D']) == {}
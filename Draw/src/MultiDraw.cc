@@ -1,81 +1,138 @@
 #include "MultiDraw.h"
 #include <iostream>
+#include "TBranch.h"
+#include "TArrayD.h"
+#include "TAxis.h"
+#include "TFile.h"
 #include "TH1D.h"
 #include "TH2F.h"
 #include "TH3F.h"
+#include "TROOT.h"
 #include "TStopwatch.h"
 #include "TTree.h"
 #include "TTreeFormula.h"
+#include "TTreeFormulaManager.h"
+#include <algorithm>
 #include <map>
+#include <memory>
+#include <string>
+#include <thread>
+#include <vector>
 
-void MultiDraw(TTree *inTree, TObjArray *Formulae, TObjArray *Weights,
-               TObjArray *Hists, UInt_t ListLen) {
-  unsigned long i = 0;
-  unsigned long NumEvents = inTree->GetEntries();
+namespace {
 
-  std::vector<TTreeFormula *> v_vars(ListLen, nullptr);
-  std::vector<TTreeFormula *> v_weights(ListLen, nullptr);
-  std::vector<TH1D *> v_hists(ListLen, nullptr);
-  std::vector<TH2F *> v_hists2d(ListLen, nullptr);
-  std::vector<TH3F *> v_hists3d(ListLen, nullptr);
+// The variables (as indices of the values computed per entry) and axes of
+// one or more histograms, x axis first
+struct BinGroup {
+  std::vector<unsigned> vars;
+  std::vector<TAxis const *> axes;
+};
 
-  std::vector<double> r_vars(ListLen, 0.);
-  std::vector<double> r_weights(ListLen, 0.);
-  std::vector<unsigned> i_vars(ListLen, 0);
-  std::vector<unsigned> i_weights(ListLen, 0);
-  std::map<std::string, unsigned> map_vars;
-  std::map<std::string, unsigned> map_weights;
+// Everything one event loop needs: the tree it reads, the formulae bound to
+// that tree and the histograms it fills. In multithreaded mode each worker
+// owns one of these, with its own tree, formula clones and histogram copies.
+// The weight of entry j of the draw list is the product of the factors
+// v_factors[factor_indices[k]] for k in [factor_offsets[j], factor_offsets[j+1]).
+struct DrawContext {
+  TTree *tree = nullptr;
+  std::vector<TTreeFormula *> v_vars;
+  std::vector<TTreeFormula *> v_factors;
+  std::vector<unsigned> factor_indices;
+  std::vector<unsigned> factor_offsets;
+  std::vector<unsigned> i_vars;
+  std::vector<unsigned> i_weights;
+  std::vector<TH1D *> v_hists;
+  std::vector<TH2F *> v_hists2d;
+  std::vector<TH3F *> v_hists3d;
+  // Histograms sharing the same variables and binning share a BinGroup, so
+  // the bin an entry falls in is found once for all of them. hist_group is
+  // the group of each entry of the draw list, or -1 if it has no histogram
+  std::vector<BinGroup> groups;
+  std::vector<int> hist_group;
+};
 
-  bool optimize = true;
-  for (unsigned idx = 0; idx < ListLen; ++idx) {
-    if (optimize) {
-      auto const& itv = map_vars.find(Formulae->At(idx)->GetTitle());
-      if (itv == map_vars.end()) {
-        map_vars[Formulae->At(idx)->GetTitle()] = idx;
-        v_vars[idx] = static_cast<TTreeFormula *>(Formulae->At(idx));
-        i_vars[idx] = idx;
-      } else {
-        i_vars[idx] = itv->second;
-      }
+// Number of cells, including under- and overflows, of histogram j
+Int_t NCells(DrawContext const &ctx, unsigned j) {
+  if (ctx.v_hists[j]) return ctx.v_hists[j]->GetNcells();
+  if (ctx.v_hists2d[j]) return ctx.v_hists2d[j]->GetNcells();
+  if (ctx.v_hists3d[j]) return ctx.v_hists3d[j]->GetNcells();
+  return 0;
+}
 
-      auto const& itw = map_weights.find(Weights->At(idx)->GetTitle());
-      if (itw == map_weights.end()) {
-        map_weights[Weights->At(idx)->GetTitle()] = idx;
-        v_weights[idx] = static_cast<TTreeFormula *>(Weights->At(idx));
-        i_weights[idx] = idx;
-      } else {
-        i_weights[idx] = itw->second;
-      }
-    } else {
-      v_vars[idx] = static_cast<TTreeFormula *>(Formulae->At(idx));
-      i_vars[idx] = idx;
-      v_weights[idx] = static_cast<TTreeFormula *>(Weights->At(idx));
-      i_weights[idx] = idx;
-    }
+TH1 *Hist(DrawContext const &ctx, unsigned j) {
+  if (ctx.v_hists[j]) return ctx.v_hists[j];
+  if (ctx.v_hists2d[j]) return ctx.v_hists2d[j];
+  return ctx.v_hists3d[j];
+}
+
+// Global bin of the current entry in the histograms of group g
+Int_t GroupBin(BinGroup const &g, std::vector<double> const &r_vars) {
+  Int_t bin = 0;
+  Int_t stride = 1;
+  for (unsigned a = 0; a < g.axes.size(); ++a) {
+    bin += stride * g.axes[a]->FindFixBin(r_vars[g.vars[a]]);
+    stride *= g.axes[a]->GetNbins() + 2;
+  }
+  return bin;
+}
 
-    v_hists[idx] = dynamic_cast<TH1D *>(Hists->At(idx));
-    v_hists2d[idx] = dynamic_cast<TH2F *>(Hists->At(idx));
-    v_hists3d[idx] = dynamic_cast<TH3F *>(Hists->At(idx));
+// Add sums of weights and of squared weights, indexed by global bin, to h
+void WriteSums(TH1 *h, std::vector<double> const &sumw,
+               std::vector<double> const &sumw2, Long64_t entries) {
+  if (!entries) return;
+  // Fill would have switched on Sumw2 at the first weight that isn't one
+  if (h->GetSumw2N() == 0 && sumw2 != sumw) h->Sumw2();
+  double oldEntries = h->GetEntries();
+  for (unsigned bin = 0; bin < sumw.size(); ++bin) {
+    if (!sumw[bin] && !sumw2[bin]) continue;
+    h->SetBinContent(bin, h->GetBinContent(bin) + sumw[bin]);
+    if (h->GetSumw2N()) h->GetSumw2()->fArray[bin] += sumw2[bin];
+  }
+  h->ResetStats();
+  h->SetEntries(oldEntries + entries);
+}
+
+void FillRange(DrawContext &ctx, Long64_t first, Long64_t last, bool progress) {
+  unsigned ListLen = ctx.v_vars.size();
+  TTree *inTree = ctx.tree;
+
+  std::vector<double> r_vars(ListLen, 0.);
+  std::vector<double> r_weights(ListLen, 0.);
+  // Factor values are computed on first use and then reused by every other
+  // weight of the same entry. f_entry records the entry each was computed for
+  std::vector<double> r_factors(ctx.v_factors.size(), 0.);
+  std::vector<Long64_t> f_entry(ctx.v_factors.size(), -1);
+  // Likewise for the bin of each group of histograms with the same binning
+  std::vector<Int_t> g_bin(ctx.groups.size(), 0);
+  std::vector<Long64_t> g_entry(ctx.groups.size(), -1);
+
+  // Rather than calling Fill, the weights are summed in flat arrays indexed
+  // by global bin, which are added to the histograms at the end
+  std::vector<std::vector<double>> sumw(ListLen), sumw2(ListLen);
+  std::vector<Long64_t> entries(ListLen, 0);
+  for (unsigned j = 0; j < ListLen; j++) {
+    sumw[j].assign(NCells(ctx, j), 0.);
+    sumw2[j].assign(NCells(ctx, j), 0.);
   }
 
-  double Value = 0.;
   double Weight = 0.;
   double commonWeight = 1.;
   double treeWeight = inTree->GetWeight();
   Int_t TreeNumber = -1;
+  Long64_t NumEvents = last - first;
 
   TStopwatch s;
-  for (i = 0; i < NumEvents; i++) {
+  for (Long64_t i = first; i < last; i++) {
     // Display progress every 20000 events
-    if (i % 20000 == 0) {
+    if (progress && (i - first) % 20000 == 0) {
       std::cout.precision(2);
 
-      double nTodo = NumEvents - i, perSecond = 20000 / s.RealTime();
+      double nTodo = last - i, perSecond = 20000 / s.RealTime();
       Int_t seconds = (Int_t)(nTodo / perSecond),
             minutes = (Int_t)(seconds / 60.);
       seconds -= (Int_t)(minutes * 60.);
 
-      std::cout << "Done " << (double(i) / (double(NumEvents)) * 100.0f)
+      std::cout << "Done " << (double(i - first) / (double(NumEvents)) * 100.0f)
                 << "% ";
       if (minutes) std::cout << minutes << " minutes ";
       std::cout << seconds << " seconds remain.                            \r";
@@ -94,28 +151,312 @@ void MultiDraw(TTree *inTree, TObjArray *Formulae, TObjArray *Weights,
     commonWeight *= treeWeight;
 
     for (unsigned j = 0; j < ListLen; j++) {
-      if (v_vars[j]) {
-        r_vars[j] = v_vars[j]->EvalInstance();
+      if (ctx.v_vars[j]) {
+        r_vars[j] = ctx.v_vars[j]->EvalInstance();
       }
-      if (v_weights[j]) {
-        r_weights[j] = v_weights[j]->EvalInstance();
+      if (ctx.i_weights[j] == j) {
+        double product = 1.;
+        for (unsigned k = ctx.factor_offsets[j]; k < ctx.factor_offsets[j + 1]; ++k) {
+          unsigned f = ctx.factor_indices[k];
+          if (f_entry[f] != i) {
+            r_factors[f] = ctx.v_factors[f]->EvalInstance();
+            f_entry[f] = i;
+          }
+          product *= r_factors[f];
+          // The remaining factors can't change a zero weight, and not
+          // evaluating them also saves reading their branches
+          if (!product) break;
+        }
+        r_weights[j] = product;
       }
-      Value = r_vars[i_vars[j]];
-      Weight = r_weights[i_weights[j]] * commonWeight;
-      if (v_hists[j] && Weight) {
-        v_hists[j]->Fill(Value, Weight);
+      Weight = r_weights[ctx.i_weights[j]] * commonWeight;
+      int g = ctx.hist_group[j];
+      if (g >= 0 && Weight) {
+        if (g_entry[g] != i) {
+          g_bin[g] = GroupBin(ctx.groups[g], r_vars);
+          g_entry[g] = i;
+        }
+        sumw[j][g_bin[g]] += Weight;
+        sumw2[j][g_bin[g]] += Weight * Weight;
+        ++entries[j];
+      }
+    }
+  }
+
+  for (unsigned j = 0; j < ListLen; j++) {
+    if (ctx.hist_group[j] >= 0) WriteSums(Hist(ctx, j), sumw[j], sumw2[j], entries[j]);
+  }
+}
+
+// Empty, directory-less copies of every histogram in Hists. Entries that are
+// not histograms (the placeholders for 2D/3D variables) become plain TObjects
+// so that indices line up with the original array.
+TObjArray *EmptyCopies(TObjArray *Hists) {
+  TObjArray *copies = new TObjArray(Hists->GetEntriesFast());
+  copies->SetOwner();
+  for (Int_t idx = 0; idx < Hists->GetEntriesFast(); ++idx) {
+    TH1 *h = dynamic_cast<TH1 *>(Hists->At(idx));
+    if (h) {
+      TH1 *copy = static_cast<TH1 *>(h->Clone());
+      copy->SetDirectory(nullptr);
+      copy->Reset();
+      copies->Add(copy);
+    } else {
+      copies->Add(new TObject());
+    }
+  }
+  return copies;
+}
+
+void MergeCopies(TObjArray *Hists, TObjArray *Copies) {
+  for (Int_t idx = 0; idx < Hists->GetEntriesFast(); ++idx) {
+    TH1 *h = dynamic_cast<TH1 *>(Hists->At(idx));
+    if (h) h->Add(static_cast<TH1 *>(Copies->At(idx)));
+  }
+}
+
+// Give a worker's own copy of the tree the same active branches and read
+// cache as the caller's tree
+void MirrorBranches(TTree *from, TTree *to) {
+  Long64_t cacheSize = from->GetCacheSize();
+  to->SetBranchStatus("*", 0);
+  if (cacheSize > 0) to->SetCacheSize(cacheSize);
+  TIter next(from->GetListOfBranches());
+  while (TBranch *br = static_cast<TBranch *>(next())) {
+    if (!from->GetBranchStatus(br->GetName())) continue;
+    to->SetBranchStatus(br->GetName(), 1);
+    if (cacheSize > 0) to->AddBranchToCache(br, true);
+  }
+  if (cacheSize > 0) to->StopCacheLearningPhase();
+}
+
+}  // namespace
+
+// Split [First, Last) into at most NRanges contiguous ranges whose
+// boundaries fall on TTree cluster boundaries, so that no two of them
+// decompress the same basket. Returns the NRanges + 1 (or fewer) bounds.
+std::vector<Long64_t> ClusterAlignedRanges(TTree *inTree, Long64_t First,
+                                           Long64_t Last, UInt_t NRanges) {
+  std::vector<Long64_t> starts;
+  TTree::TClusterIterator clusters = inTree->GetClusterIterator(First);
+  Long64_t start = 0;
+  while ((start = clusters()) < Last) {
+    if (start > First) starts.push_back(start);
+  }
+
+  std::vector<Long64_t> bounds = {First};
+  Long64_t target = (Last - First) / std::max(NRanges, 1u);
+  for (auto const &cluster_start : starts) {
+    if (bounds.size() == NRanges) break;
+    if (cluster_start - bounds.back() >= target) {
+      bounds.push_back(cluster_start);
+    }
+  }
+  bounds.push_back(Last);
+  return bounds;
+}
+
+void MultiDraw(TTree *inTree, TObjArray *Formulae, TObjArray *Factors,
+               const std::vector<unsigned> &FactorIndices,
+               const std::vector<unsigned> &FactorOffsets,
+               TObjArray *Hists, UInt_t ListLen, UInt_t NThreads,
+               Long64_t FirstEntry, Long64_t LastEntry) {
+  if (LastEntry < 0 || LastEntry > inTree->GetEntries()) LastEntry = inTree->GetEntries();
+
+  DrawContext main;
+  main.tree = inTree;
+  main.v_vars.assign(ListLen, nullptr);
+  main.v_factors.assign(Factors->GetEntriesFast(), nullptr);
+  for (Int_t f = 0; f < Factors->GetEntriesFast(); ++f) {
+    main.v_factors[f] = static_cast<TTreeFormula *>(Factors->At(f));
+  }
+  main.factor_indices = FactorIndices;
+  main.factor_offsets = FactorOffsets;
+  main.i_vars.assign(ListLen, 0);
+  main.i_weights.assign(ListLen, 0);
+  main.v_hists.assign(ListLen, nullptr);
+  main.v_hists2d.assign(ListLen, nullptr);
+  main.v_hists3d.assign(ListLen, nullptr);
+
+  std::map<std::string, unsigned> map_vars;
+  std::map<std::vector<unsigned>, unsigned> map_weights;
+
+  bool optimize = true;
+  for (unsigned idx = 0; idx < ListLen; ++idx) {
+    if (optimize) {
+      auto const& itv = map_vars.find(Formulae->At(idx)->GetTitle());
+      if (itv == map_vars.end()) {
+        map_vars[Formulae->At(idx)->GetTitle()] = idx;
+        main.v_vars[idx] = static_cast<TTreeFormula *>(Formulae->At(idx));
+        main.i_vars[idx] = idx;
+      } else {
+        main.i_vars[idx] = itv->second;
       }
-      // If this is a 2D hist the current Value will be the x variable
-      // and the previous one (without a histogram in the array) is
-      // the y variable
-      if (v_hists2d[j] && j >= 1 && Weight) {
-        v_hists2d[j]->Fill(Value, r_vars[i_vars[j-1]], Weight);
+
+      // Weights made of the same factors only need computing once
+      std::vector<unsigned> factors(
+          FactorIndices.begin() + FactorOffsets[idx],
+          FactorIndices.begin() + FactorOffsets[idx + 1]);
+      auto const& itw = map_weights.find(factors);
+      if (itw == map_weights.end()) {
+        map_weights[factors] = idx;
+        main.i_weights[idx] = idx;
+      } else {
+        main.i_weights[idx] = itw->second;
       }
+    } else {
+      main.v_vars[idx] = static_cast<TTreeFormula *>(Formulae->At(idx));
+      main.i_vars[idx] = idx;
+      main.i_weights[idx] = idx;
+    }
+
+    main.v_hists[idx] = dynamic_cast<TH1D *>(Hists->At(idx));
+    main.v_hists2d[idx] = dynamic_cast<TH2F *>(Hists->At(idx));
+    main.v_hists3d[idx] = dynamic_cast<TH3F *>(Hists->At(idx));
+  }
 
-      if (v_hists3d[j] && j >= 2 && Weight) {
-        v_hists3d[j]->Fill(Value, r_vars[i_vars[j-1]], r_vars[i_vars[j-2]], Weight);
+  // Group histograms by variables and binning. For a 1D histogram the
+  // variable is the current one; for a 2D histogram the current one is x
+  // and the previous one (without a histogram in the array) is y, and
+  // similarly for 3D. The axes are only read, so every worker can share
+  // those of the caller's histograms
+  std::map<std::pair<std::vector<unsigned>, std::vector<double>>, int> map_groups;
+  main.hist_group.assign(ListLen, -1);
+  for (unsigned idx = 0; idx < ListLen; ++idx) {
+    unsigned ndim = main.v_hists[idx] ? 1 : main.v_hists2d[idx] ? 2 : main.v_hists3d[idx] ? 3 : 0;
+    if (ndim == 0 || idx + 1 < ndim) continue;
+    TH1 *h = Hist(main, idx);
+    TAxis const *axes[3] = {h->GetXaxis(), h->GetYaxis(), h->GetZaxis()};
+    BinGroup group;
+    std::vector<double> edges;
+    for (unsigned a = 0; a < ndim; ++a) {
+      group.vars.push_back(main.i_vars[idx - a]);
+      group.axes.push_back(axes[a]);
+      edges.push_back(axes[a]->GetNbins());
+      for (Int_t b = 1; b <= axes[a]->GetNbins() + 1; ++b) {
+        edges.push_back(axes[a]->GetBinLowEdge(b));
       }
+    }
+    auto key = std::make_pair(group.vars, edges);
+    auto const& itg = map_groups.find(key);
+    if (itg == map_groups.end()) {
+      map_groups[key] = main.groups.size();
+      main.hist_group[idx] = main.groups.size();
+      main.groups.push_back(group);
+    } else {
+      main.hist_group[idx] = itg->second;
+    }
+  }
+
+  std::vector<Long64_t> bounds = {FirstEntry, LastEntry};
+  if (NThreads > 1 && LastEntry > FirstEntry) {
+    bounds = ClusterAlignedRanges(inTree, FirstEntry, LastEntry, NThreads);
+  }
+  unsigned NWorkers = bounds.size() - 1;
+
+  if (NWorkers <= 1) {
+    FillRange(main, FirstEntry, LastEntry, true);
+    return;
+  }
+
+  // Worker 0 reuses the caller's tree, formulae and histograms. Every other
+  // worker opens its own TFile and gets its own formula clones and empty
+  // histogram copies, which are merged into the caller's histograms at the
+  // end. Formulae are compiled here on the main thread since TTreeFormula
+  // construction goes through the interpreter.
+  ROOT::EnableThreadSafety();
+  std::string fileName = inTree->GetCurrentFile()->GetName();
+  std::vector<std::unique_ptr<TFile>> files;
+  std::vector<std::unique_ptr<TObjArray>> copies;
+  // Each manager is deleted by the last of its formulae to go away, so only
+  // the formula clones are owned here
+  std::vector<std::unique_ptr<TTreeFormula>> clones;
+  std::vector<DrawContext> workers(NWorkers);
+  workers[0] = main;
 
+  for (unsigned w = 1; w < NWorkers; ++w) {
+    files.emplace_back(TFile::Open(fileName.c_str(), "READ"));
+    copies.emplace_back(EmptyCopies(Hists));
+    DrawContext &ctx = workers[w];
+    ctx = main;
+    ctx.tree = files.back()->Get<TTree>(inTree->GetName());
+    MirrorBranches(inTree, ctx.tree);
+    TTreeFormulaManager *manager = new TTreeFormulaManager();
+    for (unsigned idx = 0; idx < ListLen; ++idx) {
+      if (main.v_vars[idx]) {
+        ctx.v_vars[idx] = new TTreeFormula(main.v_vars[idx]->GetName(),
+                                           main.v_vars[idx]->GetTitle(), ctx.tree);
+        ctx.v_vars[idx]->SetQuickLoad(true);
+        manager->Add(ctx.v_vars[idx]);
+        clones.emplace_back(ctx.v_vars[idx]);
+      }
+      ctx.v_hists[idx] = dynamic_cast<TH1D *>(copies.back()->At(idx));
+      ctx.v_hists2d[idx] = dynamic_cast<TH2F *>(copies.back()->At(idx));
+      ctx.v_hists3d[idx] = dynamic_cast<TH3F *>(copies.back()->At(idx));
     }
+    for (unsigned f = 0; f < main.v_factors.size(); ++f) {
+      ctx.v_factors[f] = new TTreeFormula(main.v_factors[f]->GetName(),
+                                          main.v_factors[f]->GetTitle(), ctx.tree);
+      ctx.v_factors[f]->SetQuickLoad(true);
+      manager->Add(ctx.v_factors[f]);
+      clones.emplace_back(ctx.v_factors[f]);
+    }
+    manager->Sync();
+    ctx.tree->SetNotify(manager);
+  }
+
+  std::vector<std::thread> threads;
+  for (unsigned w = 0; w < NWorkers; ++w) {
+    threads.emplace_back(FillRange, std::ref(workers[w]), bounds[w],
+                         bounds[w + 1], w == 0);
+  }
+  for (auto &t : threads) t.join();
+
+  for (unsigned w = 1; w < NWorkers; ++w) {
+    MergeCopies(Hists, copies[w - 1].get());
+    workers[w].tree->SetNotify(nullptr);
+  }
+  // Formula clones must go before the files that own their trees
+  clones.clear();
+}
+
+void MultiDrawKernel(TTree *inTree, TObjArray *Hists, UInt_t NThreads,
+                     MultiDrawFillFn Fill, Long64_t FirstEntry,
+                     Long64_t LastEntry) {
+  if (LastEntry < 0 || LastEntry > inTree->GetEntries()) LastEntry = inTree->GetEntries();
+  std::vector<Long64_t> bounds = {FirstEntry, LastEntry};
+  if (NThreads > 1 && LastEntry > FirstEntry) {
+    bounds = ClusterAlignedRanges(inTree, FirstEntry, LastEntry, NThreads);
+  }
+  unsigned NWorkers = bounds.size() - 1;
+
+  if (NWorkers <= 1) {
+    Fill(inTree, Hists, FirstEntry, LastEntry);
+    return;
+  }
+
+  // Same scheme as MultiDraw: worker 0 fills the caller's histograms from
+  // the caller's tree, the others fill private copies from their own TFile
+  ROOT::EnableThreadSafety();
+  std::string fileName = inTree->GetCurrentFile()->GetName();
+  std::vector<std::unique_ptr<TFile>> files;
+  std::vector<std::unique_ptr<TObjArray>> copies;
+  std::vector<std::thread> threads;
+  std::vector<TTree *> trees = {inTree};
+  for (unsigned w = 1; w < NWorkers; ++w) {
+    files.emplace_back(TFile::Open(fileName.c_str(), "READ"));
+    copies.emplace_back(EmptyCopies(Hists));
+    trees.push_back(files.back()->Get<TTree>(inTree->GetName()));
+    MirrorBranches(inTree, trees.back());
+  }
+  threads.emplace_back(Fill, inTree, Hists, bounds[0], bounds[1]);
+  for (unsigned w = 1; w < NWorkers; ++w) {
+    threads.emplace_back(Fill, trees[w], copies[w - 1].get(), bounds[w],
+                         bounds[w + 1]);
+  }
+  for (auto &t : threads) t.join();
+
+  for (unsigned w = 1; w < NWorkers; ++w) {
+    MergeCopies(Hists, copies[w - 1].get());
   }
 }